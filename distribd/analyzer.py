@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -145,11 +146,11 @@ async def recursive_analyze(mirrorer, repository, content_type, manifest):
     while dependencies:
         content_type, digest = dependencies.pop()
 
-        if digest not in state.graph.nodes:
+        if digest not in state:
             logger.debug(f"MANIFEST: {digest} missing")
             raise ManifestInvalid(reason=f"{digest} missing")
 
-        if repository not in state.graph.nodes[digest][ATTR_REPOSITORIES]:
+        if repository not in state[digest][ATTR_REPOSITORIES]:
             logger.debug(f"MANIFEST: {digest} missing from repo")
             raise ManifestInvalid(reason=f"{digest} missing")
 
@@ -168,7 +169,9 @@ async def recursive_analyze(mirrorer, repository, content_type, manifest):
             continue
 
         async with AIOFile(path, "r") as afp:
-            manifest = await afp.read()
+            # Clients disconnect part way through pushes, which cancels this.
+            # Let the read in flight finish so caio doesn't wedge.
+            manifest = await asyncio.shield(afp.read())
 
         try:
             results = analyze(content_type, manifest)
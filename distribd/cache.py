@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Manifests are small, so this holds a lot of them
+MANIFEST_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class ManifestCache:
+    """
+    A least recently used cache of manifest bodies, keyed by digest.
+
+    Manifests are content addressed so an entry never goes stale, it only has to
+    be dropped when the manifest is deleted from this node.
+    """
+
+    def __init__(self, max_bytes=MANIFEST_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self._manifests = OrderedDict()
+
+    def __len__(self):
+        return len(self._manifests)
+
+    def __contains__(self, digest):
+        return digest in self._manifests
+
+    def get(self, digest):
+        manifest = self._manifests.get(digest)
+        if manifest is not None:
+            self._manifests.move_to_end(digest)
+        return manifest
+
+    def put(self, digest, manifest):
+        if len(manifest) > self.max_bytes:
+            return
+
+        self.discard(digest)
+        self._manifests[digest] = manifest
+        self.size += len(manifest)
+
+        while self.size > self.max_bytes:
+            _, evicted = self._manifests.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, digest):
+        manifest = self._manifests.pop(digest, None)
+        if manifest is not None:
+            self.size -= len(manifest)
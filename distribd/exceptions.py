@@ -4,7 +4,7 @@ from aiohttp import web
 
 
 class JSONExceptionMixin:
-    def __init__(self, **kwargs):
+    def __init__(self, headers=None, **kwargs):
         error = {
             "code": self.code,
             "message": self.message,
@@ -13,9 +13,12 @@ class JSONExceptionMixin:
         if kwargs:
             error["detail"] = kwargs
 
+        response_headers = {"Content-Type": "application/json"}
+        if headers:
+            response_headers.update(headers)
+
         super().__init__(
-            headers={"Content-Type": "application/json"},
-            text=json.dumps({"errors": [error]}),
+            headers=response_headers, text=json.dumps({"errors": [error]}),
         )
 
 
@@ -115,6 +118,25 @@ class TagInvalid(JSONExceptionMixin, web.HTTPBadRequest):
     message = "manifest tag did not match URI"
 
 
+class WatchInvalid(JSONExceptionMixin, web.HTTPBadRequest):
+
+    """The parameters of a watch request were invalid."""
+
+    code = "WATCH_INVALID"
+    message = "watch parameters invalid"
+
+
+class TooManyRequests(JSONExceptionMixin, web.HTTPTooManyRequests):
+
+    """Returned when a client is being rate limited. Retry-After says when the client can try again."""
+
+    code = "TOOMANYREQUESTS"
+    message = "too many requests"
+
+    def __init__(self, retry_after, **kwargs):
+        super().__init__(headers={"Retry-After": str(retry_after)}, **kwargs)
+
+
 class Unauthorized(web.HTTPUnauthorized):
 
     """The access controller was unable to authenticate the client. Often this will be accompanied by a Www-Authenticate HTTP response header indicating how to authenticate."""
@@ -122,7 +144,9 @@ class Unauthorized(web.HTTPUnauthorized):
     code = "UNAUTHORIZED"
     message = "authentication required"
 
-    def __init__(self, realm, service, repository=None, actions=None):
+    def __init__(
+        self, realm, service, repository=None, actions=None, resource_type="repository"
+    ):
         details = None
 
         # If authenticate request has a repository and actions put it in details in the right format
@@ -131,7 +155,11 @@ class Unauthorized(web.HTTPUnauthorized):
             details = []
             for action in actions:
                 details.append(
-                    {"Type": "Repository", "Name": repository, "Action": action}
+                    {
+                        "Type": resource_type.title(),
+                        "Name": repository,
+                        "Action": action,
+                    }
                 )
 
         error = {
@@ -144,7 +172,7 @@ class Unauthorized(web.HTTPUnauthorized):
         scope = ""
         if repository and actions:
             action_str = ",".join(actions)
-            scope = f',scope="repository:{repository}:{action_str}"'
+            scope = f',scope="{resource_type}:{repository}:{action_str}"'
 
         super().__init__(
             headers={
@@ -178,3 +206,11 @@ class LeaderUnavailable(JSONExceptionMixin, web.HTTPServiceUnavailable):
 
     code = "LEADER_UNAVAILABLE"
     message = "There is no cluster leader so cannot perform this operation"
+
+
+class UploadOwnerUnavailable(JSONExceptionMixin, web.HTTPServiceUnavailable):
+
+    """The node that holds this upload session can't be reached right now."""
+
+    code = "UPLOAD_OWNER_UNAVAILABLE"
+    message = "The node handling this upload is unavailable"
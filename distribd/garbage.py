@@ -24,14 +24,16 @@ MINIMUM_GARBAGE_AGE = 60 * 60 * 12
 
 
 class GarbageCollector:
-    def __init__(self, image_directory, identifier, state, send_action):
+    def __init__(self, image_directory, identifier, state, send_action, manifest_cache):
         self.image_directory = image_directory
         self.identifier = identifier
         self.state = state
         self.send_action = send_action
+        self.manifest_cache = manifest_cache
 
         self.pool = WorkerPool()
         self._futures = {}
+        self._synced = False
 
         self._lock = asyncio.Lock()
 
@@ -90,46 +92,66 @@ class GarbageCollector:
 
         return True
 
-    async def garbage_collect(self, state):
-        async with self._lock:
-            actions = []
+    def collect(self, state):
+        """Unlink orphaned objects stored on this node and return the actions to record it."""
+        actions = []
+
+        for garbage_hash in state.get_orphaned_objects():
+            object = state[garbage_hash]
+
+            if self.identifier not in object[ATTR_LOCATIONS]:
+                continue
+
+            if object[ATTR_TYPE] == TYPE_BLOB:
+                path = get_blob_path(self.image_directory, garbage_hash)
+                if not self.cleanup_object(self.image_directory, path):
+                    continue
 
-            for garbage_hash in state.get_orphaned_objects():
-                object = state[garbage_hash]
+                actions.append(
+                    {
+                        "type": RegistryActions.BLOB_UNSTORED,
+                        "hash": garbage_hash,
+                        "location": self.identifier,
+                    }
+                )
 
-                if self.identifier not in object[ATTR_LOCATIONS]:
+            elif object[ATTR_TYPE] == TYPE_MANIFEST:
+                path = get_manifest_path(self.image_directory, garbage_hash)
+                if not self.cleanup_object(self.image_directory, path):
                     continue
 
-                if object[ATTR_TYPE] == TYPE_BLOB:
-                    path = get_blob_path(self.image_directory, garbage_hash)
-                    if not self.cleanup_object(self.image_directory, path):
-                        continue
-
-                    actions.append(
-                        {
-                            "type": RegistryActions.BLOB_UNSTORED,
-                            "hash": garbage_hash,
-                            "location": self.identifier,
-                        }
-                    )
-
-                elif object[ATTR_TYPE] == TYPE_MANIFEST:
-                    path = get_manifest_path(self.image_directory, garbage_hash)
-                    if not self.cleanup_object(self.image_directory, path):
-                        continue
-
-                    actions.append(
-                        {
-                            "type": RegistryActions.MANIFEST_UNSTORED,
-                            "hash": garbage_hash,
-                            "location": self.identifier,
-                        }
-                    )
+                actions.append(
+                    {
+                        "type": RegistryActions.MANIFEST_UNSTORED,
+                        "hash": garbage_hash,
+                        "location": self.identifier,
+                    }
+                )
+
+        return actions
+
+    async def garbage_collect(self, state):
+        async with self._lock:
+            # Touching the filesystem is slow so do it in a thread, against a view
+            # that won't change underneath it as more entries are applied
+            loop = asyncio.get_event_loop()
+            actions = await loop.run_in_executor(None, self.collect, state.view())
+
+            for action in actions:
+                if action["type"] == RegistryActions.MANIFEST_UNSTORED:
+                    self.manifest_cache.discard(action["hash"])
 
             if actions:
                 await self.send_action(actions)
 
     def dispatch_entries(self, state, entries):
+        if not self._synced:
+            # A collection that was running when we stopped won't be triggered
+            # again, so always collect once we have caught up
+            self._synced = True
+            self.pool.spawn(self.garbage_collect(state))
+            return
+
         if self.should_garbage_collect(entries):
             logger.critical("MEMEMEMEMEMEMEME")
             self.pool.spawn(self.garbage_collect(state))
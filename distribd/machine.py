@@ -49,6 +49,14 @@ ELECTION_TICK_LOW = 150
 ELECTION_TICK_HIGH = 300
 HEARTBEAT_TICK = (ELECTION_TICK_LOW / 20) / 1000
 
+# Smoothing factors for round trip time estimates (as used by TCP, RFC 6298)
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+
+# Heartbeat and election timeouts as a multiple of the round trip time
+HEARTBEAT_RTT_MULTIPLIER = 2
+ELECTION_RTT_MULTIPLIER = 10
+
 
 class Msg:
     def __init__(self, source, destination, message_type, term=0, **kwargs):
@@ -102,6 +110,26 @@ class Peer:
         self.next_index = 0
         self.match_index = 0
 
+        # Smoothed round trip time and its variation, in seconds
+        self.srtt = None
+        self.rttvar = None
+
+    def observe_rtt(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+            return
+
+        self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - sample)
+        self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+
+    @property
+    def rtt(self):
+        """A conservative round trip time that most exchanges will complete within."""
+        if self.srtt is None:
+            return 0
+        return self.srtt + 4 * self.rttvar
+
 
 class Log:
     def __init__(self):
@@ -168,6 +196,16 @@ class Machine:
         # volatile state
         self.commit_index = 0
 
+        # Bounds on our timeouts, in seconds. Within these bounds they are
+        # derived from the measured round trip time to our peers.
+        self.election_timeout_min = ELECTION_TICK_LOW / SCALE
+        self.election_timeout_max = ELECTION_TICK_HIGH / SCALE
+        self.heartbeat_interval_min = HEARTBEAT_TICK
+        self.heartbeat_interval_max = self.election_timeout_min / 10
+
+        # The round trip time advertised by our leader
+        self.leader_rtt = 0
+
         self.loop = asyncio.get_event_loop()
 
     def start(self):
@@ -235,12 +273,49 @@ class Machine:
     def current_tick(self):
         return self.loop.time()
 
+    @property
+    def rtt(self):
+        """
+        The round trip time used to derive our timeouts.
+
+        A leader uses the slowest of its peers. Followers don't exchange
+        AppendEntries with each other so use the value their leader advertises.
+        """
+        if self.state == NodeState.LEADER:
+            return max((peer.rtt for peer in self.peers.values()), default=0)
+        return self.leader_rtt
+
+    @property
+    def heartbeat_interval(self):
+        interval = HEARTBEAT_RTT_MULTIPLIER * self.rtt
+        interval = max(interval, self.heartbeat_interval_min)
+        return min(interval, self.heartbeat_interval_max)
+
+    @property
+    def election_timeout(self):
+        """
+        The shortest election timeout.
+
+        Actual timeouts are randomized up to 2x, but never past the configured
+        maximum.
+        """
+        timeout = ELECTION_RTT_MULTIPLIER * self.rtt
+        timeout = max(timeout, self.election_timeout_min)
+        return min(timeout, self.election_timeout_max)
+
     def _reset_election_tick(self):
-        random_tick = random.randrange(ELECTION_TICK_LOW, ELECTION_TICK_HIGH) / SCALE
+        timeout = self.election_timeout
+
+        # Keep some spread when the timeout is already at the upper bound, so
+        # followers still don't all stand for election at once
+        high = min(timeout * 2, self.election_timeout_max)
+        low = max(min(timeout, high / 2), self.election_timeout_min)
+
+        random_tick = random.uniform(low, high)
         self.tick = self.current_tick() + random_tick
 
     def _reset_heartbeat_tick(self):
-        self.tick = self.current_tick() + HEARTBEAT_TICK
+        self.tick = self.current_tick() + self.heartbeat_interval
 
     def _become_follower(self, term, leader=None):
         logger.debug("Became follower %s %s", self.identifier, leader)
@@ -383,7 +458,12 @@ class Machine:
 
         if message.type == Message.AppendEntries:
             if not self.is_append_entries_valid(message):
-                self.reply(message, self.term, reject=True)
+                self.reply(
+                    message,
+                    self.term,
+                    reject=True,
+                    sent_at=message.kwargs.get("sent_at"),
+                )
                 return
 
             if self.state != NodeState.FOLLOWER:
@@ -394,6 +474,7 @@ class Machine:
             self.obedient = True
 
             self.leader = message.source
+            self.leader_rtt = message.kwargs.get("rtt", 0)
 
             # If leader sends us a batch of entries we already have we can avoid truncating
             # if they are actually consistent
@@ -415,7 +496,13 @@ class Machine:
                 commit_index = min(message.leader_commit, self.log.last_index)
                 self.commit_index = commit_index
 
-            self.reply(message, self.term, reject=False, log_index=self.log.last_index)
+            self.reply(
+                message,
+                self.term,
+                reject=False,
+                log_index=self.log.last_index,
+                sent_at=message.kwargs.get("sent_at"),
+            )
 
         if self.state == NodeState.FOLLOWER:
             self.step_follower(message)
@@ -518,6 +605,9 @@ class Machine:
         elif message.type == Message.AppendEntriesReply:
             peer = self.peers[message.source]
 
+            if message.kwargs.get("sent_at") is not None:
+                peer.observe_rtt(self.current_tick() - message.sent_at)
+
             if message.reject:
                 if peer.next_index > 1:
                     peer.next_index -= 1
@@ -550,6 +640,10 @@ class Machine:
             "prev_term": prev_term,
             "entries": entries,
             "leader_commit": self.commit_index,
+            # Echoed back by the follower so we can measure the round trip time
+            "sent_at": self.current_tick(),
+            # Let followers derive their election timeouts from our measurements
+            "rtt": self.rtt,
         }
 
         self.send(peer, Message.AppendEntries, self.term, **payload)
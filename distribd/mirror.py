@@ -2,8 +2,6 @@ import asyncio
 import hashlib
 import logging
 import os
-import random
-import uuid
 
 from aiofile import AIOFile, Writer
 import aiohttp
@@ -11,24 +9,122 @@ import ujson
 
 from .actions import RegistryActions
 from .jobs import WorkerPool
-from .state import ATTR_LOCATIONS, ATTR_REPOSITORIES
+from .state import ATTR_LOCATIONS, ATTR_REPOSITORIES, ATTR_TYPE, TYPE_BLOB
+from .utils.aio import open_for_writing
 from .utils.registry import get_blob_path, get_manifest_path
 from .utils.tokengetter import TokenGetter
 
 logger = logging.getLogger(__name__)
 
 
+class TransferFailed(Exception):
+    pass
+
+
+class Transfer:
+    """
+    A download that is in progress.
+
+    Requests for an object that hasn't been mirrored yet follow the download as
+    it is written to disk, so any number of clients share a single fetch from a
+    peer.
+    """
+
+    def __init__(self, path, destination):
+        self.path = path
+        self.destination = destination
+
+        # Bytes at the start of `path` that are safe to read
+        self.written = 0
+        self.started = False
+
+        self.done = False
+        self.succeeded = False
+
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def progress(self, written):
+        self.written = written
+        self.started = True
+        self._notify()
+
+    def finish(self, succeeded):
+        self.done = True
+        self.succeeded = succeeded
+        self._notify()
+
+    async def follow(self, chunk_size=1024 * 1024):
+        """
+        Yield the object a chunk at a time as it arrives.
+
+        Raises TransferFailed if the download fails or doesn't match its digest.
+        The last chunk isn't yielded until the object has been verified and moved
+        into place, so a reader never sees all of a corrupt object.
+        """
+        while not self.started and not self.done:
+            await self._changed.wait()
+
+        if self.done and not self.succeeded:
+            raise TransferFailed()
+
+        # The open file survives the rename to `destination` when the download
+        # completes, so only look at `destination` once that has happened
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            fd = os.open(self.destination, os.O_RDONLY)
+
+        loop = asyncio.get_event_loop()
+        offset = 0
+
+        try:
+            while True:
+                if offset < self.written:
+                    size = min(chunk_size, self.written - offset)
+                    chunk = await loop.run_in_executor(None, os.pread, fd, size, offset)
+                    offset += len(chunk)
+                    yield chunk
+                    continue
+
+                if self.done:
+                    if not self.succeeded:
+                        raise TransferFailed()
+                    return
+
+                await self._changed.wait()
+
+        finally:
+            os.close(fd)
+
+
 class Mirrorer:
-    def __init__(self, config, peers, image_directory, identifier, state, send_action):
+    def __init__(
+        self,
+        config,
+        peers,
+        image_directory,
+        identifier,
+        state,
+        send_action,
+        manifest_cache,
+    ):
         self.peers = peers
         self.image_directory = image_directory
         self.identifier = identifier
         self.state = state
         self.send_action = send_action
+        self.manifest_cache = manifest_cache
 
         self.session = aiohttp.ClientSession(json_serialize=ujson.dumps)
         self.pool = WorkerPool()
 
+        # Downloads that a client is waiting on don't queue behind the backlog
+        self.read_through_pool = WorkerPool()
+
         self.token_getter = None
         if config["mirroring"]["realm"].exists():
             self.token_getter = TokenGetter(
@@ -41,8 +137,14 @@ class Mirrorer:
 
         self._futures = {}
 
+        # Transfer objects for hashes that are being downloaded right now
+        self._transfers = {}
+
+        # Whether we've started downloading everything we were missing at startup
+        self._synced = False
+
     async def wait_for_blob(self, digest):
-        if self.identifier in self.state.graph.nodes[digest][ATTR_LOCATIONS]:
+        if self.identifier in self.state[digest][ATTR_LOCATIONS]:
             return get_blob_path(self.image_directory, digest)
 
         fut = asyncio.Future()
@@ -52,70 +154,183 @@ class Mirrorer:
 
     async def close(self):
         await self.pool.close()
+        await self.read_through_pool.close()
         await self.session.close()
 
-    async def _do_transfer(self, hash, repo, urls, destination):
+    def _start_transfer(self, hash):
+        if self.state[hash][ATTR_TYPE] == TYPE_BLOB:
+            destination = get_blob_path(self.image_directory, hash)
+        else:
+            destination = get_manifest_path(self.image_directory, hash)
+
+        transfer = Transfer(self._partial_path(hash), destination)
+        self._transfers[hash] = transfer
+        return transfer
+
+    def read_through(self, hash):
+        """
+        Return a Transfer for an object that is known to the cluster but hasn't been
+        mirrored here yet, starting a download if there isn't one already.
+
+        Returns None if there is nothing to download.
+        """
+        if hash in self._transfers:
+            return self._transfers[hash]
+
+        if not self.download_needed(hash):
+            return None
+
+        transfer = self._start_transfer(hash)
+
+        if self.state[hash][ATTR_TYPE] == TYPE_BLOB:
+            self.read_through_pool.spawn(self.do_download_blob(hash, transfer=transfer))
+        else:
+            self.read_through_pool.spawn(
+                self.do_download_manifest(hash, transfer=transfer)
+            )
+
+        return transfer
+
+    def _partial_path(self, hash):
+        _, digest = hash.split(":", 1)
+        return self.image_directory / "uploads" / f"mirror-{digest}"
+
+    async def _resume_digest(self, path, digest):
+        """Feed an interrupted download back into `digest`, returning its size."""
+        offset = 0
+        async with AIOFile(path, "rb") as fp:
+            while True:
+                # Let each read finish if we are cancelled, so caio doesn't wedge
+                chunk = await asyncio.shield(fp.read_bytes(1024 * 1024, offset))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                offset += len(chunk)
+        return offset
+
+    async def _do_transfer(self, hash, urls_for, transfer):
+        succeeded = False
+        try:
+            succeeded = await self._transfer(hash, urls_for, transfer)
+            return succeeded
+        finally:
+            del self._transfers[hash]
+            transfer.finish(succeeded)
+
+    async def _transfer(self, hash, urls_for, transfer):
+        destination = transfer.destination
+        repo, urls = urls_for(hash)
+
         if destination.exists():
             logger.debug("%s already exists, not requesting", destination)
+            transfer.progress(destination.stat().st_size)
             return True
 
         if not urls:
             logger.debug("No urls for hash %s yet", hash)
             return False
 
-        url = random.choice(urls)
+        url = urls[0]
         logger.critical("Starting download from %s to %s", url, destination)
 
         if not destination.parent.exists():
             os.makedirs(destination.parent)
 
-        temporary_path = self.image_directory / "uploads" / str(uuid.uuid4())
+        # Downloads go to a predictable path so an interrupted one can be resumed
+        temporary_path = transfer.path
         if not temporary_path.parent.exists():
             os.makedirs(temporary_path.parent)
 
         digest = hashlib.sha256()
+        offset = 0
 
         headers = {}
 
+        if temporary_path.exists():
+            offset = await self._resume_digest(temporary_path, digest)
+            logger.info("Resuming download of %s from byte %d", hash, offset)
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = f'"{hash}"'
+
         # If auth is turned on we need to supply a JWT token
         if self.token_getter:
             token = await self.token_getter.get_token(repo, ["pull"])
             headers["Authorization"] = f"Bearer {token}"
 
         async with self.session.get(url, headers=headers) as resp:
-            if resp.status != 200:
+            if resp.status == 416 and offset:
+                # We already have every byte, the final rename never happened
+                pass
+
+            elif resp.status == 206:
+                content_range = resp.headers.get("Content-Range", "")
+                if not content_range.startswith(f"bytes {offset}-"):
+                    logger.error("Unexpected range from %s: %s", url, content_range)
+                    os.unlink(temporary_path)
+                    return False
+                # Bytes from an earlier attempt can't be trusted until the
+                # whole object verifies, so readers wait for the end
+                await self._receive(resp, transfer, "ab", digest, offset, False)
+
+            elif resp.status == 200:
+                # The peer sent the whole thing, so start again
+                digest = hashlib.sha256()
+                await self._receive(resp, transfer, "wb", digest, 0)
+
+            else:
                 logger.error("Failed to retrieve: %s, status %s", url, resp.status)
                 return False
-            async with AIOFile(temporary_path, "wb") as fp:
-                writer = Writer(fp)
-                chunk = await resp.content.read(1024 * 1024)
-                while chunk:
-                    await writer(chunk)
-                    digest.update(chunk)
-                    chunk = await resp.content.read(1024 * 1024)
-                await fp.fsync()
 
         mirrored_hash = "sha256:" + digest.hexdigest()
 
         if mirrored_hash != hash:
             os.unlink(temporary_path)
+
+            if offset:
+                logger.warning("Resumed download of %s is corrupt, restarting", hash)
+                return await self._transfer(hash, urls_for, transfer)
+
             return False
 
         os.rename(temporary_path, destination)
 
+        # Now that it has been verified, release the last chunk to readers
+        transfer.progress(os.path.getsize(destination))
+
         for fut in self._futures.get(hash, []):
             fut.set_result(destination)
 
         return True
 
+    async def _receive(self, resp, transfer, mode, digest, offset, release=True):
+        async with open_for_writing(transfer.path, mode) as fp:
+            if release:
+                transfer.progress(offset)
+            writer = Writer(fp)
+            chunk = await resp.content.read(1024 * 1024)
+            while chunk:
+                # Downloads are cancelled when the node shuts down. caio can't
+                # cope with a cancelled write still completing in the kernel and
+                # stops delivering other results, including for the journal, so
+                # let each write finish.
+                await asyncio.shield(writer(chunk))
+                digest.update(chunk)
+                offset += len(chunk)
+                chunk = await resp.content.read(1024 * 1024)
+                if chunk and release:
+                    # The last chunk is held back until the object is verified
+                    transfer.progress(offset)
+            await asyncio.shield(fp.fsync())
+
     def urls_for_blob(self, hash):
-        node = self.state.graph.nodes[hash]
+        node = self.state[hash]
 
         repo = next(iter(node[ATTR_REPOSITORIES]))
 
         urls = []
 
-        for location in node[ATTR_LOCATIONS]:
+        # Peers that are most likely to be up are tried first
+        for location in self.peers.rank_peers(node[ATTR_LOCATIONS]):
             if location not in self.peers:
                 continue
 
@@ -126,14 +341,14 @@ class Mirrorer:
 
         return repo, urls
 
-    async def do_download_blob(self, hash, retry_count=0):
-        if not self.download_needed(hash):
-            return
+    async def do_download_blob(self, hash, retry_count=0, transfer=None):
+        if not transfer:
+            if not self.download_needed(hash):
+                return
+            transfer = self._start_transfer(hash)
 
         try:
-            destination = get_blob_path(self.image_directory, hash)
-            repo, urls = self.urls_for_blob(hash)
-            if await self._do_transfer(hash, repo, urls, destination):
+            if await self._do_transfer(hash, self.urls_for_blob, transfer):
                 await self.send_action(
                     [
                         {
@@ -162,13 +377,14 @@ class Mirrorer:
         )
 
     def urls_for_manifest(self, hash):
-        node = self.state.graph.nodes[hash]
+        node = self.state[hash]
 
         repo = next(iter(node[ATTR_REPOSITORIES]))
 
         urls = []
 
-        for location in node[ATTR_LOCATIONS]:
+        # Peers that are most likely to be up are tried first
+        for location in self.peers.rank_peers(node[ATTR_LOCATIONS]):
             if location not in self.peers:
                 continue
 
@@ -179,14 +395,18 @@ class Mirrorer:
 
         return repo, urls
 
-    async def do_download_manifest(self, hash, retry_count=0):
-        if not self.download_needed(hash):
-            return
+    async def do_download_manifest(self, hash, retry_count=0, transfer=None):
+        if not transfer:
+            if not self.download_needed(hash):
+                return
+            transfer = self._start_transfer(hash)
 
         try:
-            destination = get_manifest_path(self.image_directory, hash)
-            repo, urls = self.urls_for_manifest(hash)
-            if await self._do_transfer(hash, repo, urls, destination):
+            if await self._do_transfer(hash, self.urls_for_manifest, transfer):
+                async with AIOFile(transfer.destination, "rb") as fp:
+                    manifest = await asyncio.shield(fp.read())
+                self.manifest_cache.put(hash, manifest)
+
                 await self.send_action(
                     [
                         {
@@ -212,11 +432,11 @@ class Mirrorer:
         )
 
     def download_needed(self, hash):
-        if hash not in self.state.graph.nodes:
+        if hash not in self.state:
             # It was deleted or never existed in the first place
             return False
 
-        node = self.state.graph.nodes[hash]
+        node = self.state[hash]
 
         if len(node[ATTR_REPOSITORIES]) == 0:
             # It's pending deletion
@@ -230,12 +450,31 @@ class Mirrorer:
             # Already downloaded it
             return False
 
+        if hash in self._transfers:
+            # Already downloading it
+            return False
+
         return True
 
     def dispatch_entries(self, state, entries):
         manifests = set()
         blobs = set()
 
+        if not self._synced:
+            # Retries don't survive a restart, and entries we've already seen won't
+            # be replayed to us, so catch up with our whole backlog first
+            self._synced = True
+            for hash in state.get_missing_objects(self.identifier):
+                if state[hash][ATTR_TYPE] == TYPE_BLOB:
+                    blobs.add(hash)
+                else:
+                    manifests.add(hash)
+            logger.info(
+                "Replication backlog is %d blobs and %d manifests",
+                len(blobs),
+                len(manifests),
+            )
+
         for term, entry in entries:
             if "type" not in entry:
                 continue
@@ -1,6 +1,11 @@
 from aiohttp import web
 from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
-from prometheus_client.core import CollectorRegistry, GaugeMetricFamily
+from prometheus_client.core import (
+    CollectorRegistry,
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    SummaryMetricFamily,
+)
 import ujson
 
 from .utils.web import run_server
@@ -9,11 +14,13 @@ routes = web.RouteTableDef()
 
 
 class MetricsCollector:
-    def __init__(self, raft):
+    def __init__(self, raft, upload_sessions):
         self.raft = raft
+        self.upload_sessions = upload_sessions
         self.machine = raft.machine
         self.identifier = self.machine.identifier
         self.reducers = raft.reducers
+        self.queue = raft.queue
 
     def collect(self):
         last_applied = GaugeMetricFamily(
@@ -64,6 +71,198 @@ class MetricsCollector:
         current_state.add_metric([self.identifier, str(self.machine.state)], 1)
         yield current_state
 
+        queue_depth = GaugeMetricFamily(
+            "distribd_raft_queue_depth",
+            "Number of raft messages waiting to be processed",
+            labels=["identifier", "priority"],
+        )
+        for priority, depth in self.queue.depth.items():
+            queue_depth.add_metric([self.identifier, priority.name.lower()], depth)
+        yield queue_depth
+
+        queue_wait = SummaryMetricFamily(
+            "distribd_raft_queue_wait_seconds",
+            "Time raft messages spent queued before being processed",
+            labels=["identifier", "priority"],
+        )
+        for priority in self.queue.depth:
+            queue_wait.add_metric(
+                [self.identifier, priority.name.lower()],
+                self.queue.wait_count[priority],
+                self.queue.wait_seconds[priority],
+            )
+        yield queue_wait
+
+        pending_entries = GaugeMetricFamily(
+            "distribd_raft_pending_entries",
+            "Number of proposed entries that have not been applied yet",
+            labels=["identifier"],
+        )
+        pending_entries.add_metric([self.identifier], self.raft.outstanding_entries)
+        yield pending_entries
+
+        pending_bytes = GaugeMetricFamily(
+            "distribd_raft_pending_bytes",
+            "Size of proposals made through this node that have not been applied yet",
+            labels=["identifier"],
+        )
+        pending_bytes.add_metric([self.identifier], self.raft.pending_bytes)
+        yield pending_bytes
+
+        pressure = GaugeMetricFamily(
+            "distribd_raft_pressure",
+            "How close this node is to rejecting proposals (0 to 1)",
+            labels=["identifier"],
+        )
+        pressure.add_metric([self.identifier], self.raft.pressure)
+        yield pressure
+
+        throughput = GaugeMetricFamily(
+            "distribd_raft_commit_throughput",
+            "Entries applied per second",
+            labels=["identifier"],
+        )
+        throughput.add_metric([self.identifier], self.reducers.throughput)
+        yield throughput
+
+        waiters = GaugeMetricFamily(
+            "distribd_commit_waiters",
+            "Number of clients waiting for their proposals to be applied",
+            labels=["identifier"],
+        )
+        waiters.add_metric([self.identifier], self.reducers.waiting)
+        yield waiters
+
+        lag = GaugeMetricFamily(
+            "distribd_subscriber_lag",
+            "Number of applied entries a side effect has yet to process",
+            labels=["identifier", "subscriber"],
+        )
+        for name, subscriber in self.reducers.subscribers.items():
+            lag.add_metric([self.identifier, name], subscriber.lag)
+        yield lag
+
+        rejected = CounterMetricFamily(
+            "distribd_raft_rejected_proposals",
+            "Number of proposals turned away because of backpressure",
+            labels=["identifier"],
+        )
+        rejected.add_metric([self.identifier], self.raft.rejected_proposals)
+        yield rejected
+
+        liveness = GaugeMetricFamily(
+            "distribd_peer_liveness",
+            "Whether a peer is believed to be alive, suspect or dead",
+            labels=["identifier", "peer", "state"],
+        )
+        for peer in self.raft.peers.peers:
+            state = self.raft.peers.liveness(peer)
+            liveness.add_metric([self.identifier, peer, state.name.lower()], 1)
+        yield liveness
+
+        peer_rtt = GaugeMetricFamily(
+            "distribd_peer_rtt_seconds",
+            "Smoothed round trip time of AppendEntries to a peer",
+            labels=["identifier", "peer"],
+        )
+        for peer in self.machine.peers.values():
+            if peer.srtt is not None:
+                peer_rtt.add_metric([self.identifier, peer.identifier], peer.srtt)
+        yield peer_rtt
+
+        heartbeat_interval = GaugeMetricFamily(
+            "distribd_heartbeat_interval_seconds",
+            "Current interval between heartbeats when leader",
+            labels=["identifier"],
+        )
+        heartbeat_interval.add_metric(
+            [self.identifier], self.machine.heartbeat_interval
+        )
+        yield heartbeat_interval
+
+        election_timeout = GaugeMetricFamily(
+            "distribd_election_timeout_seconds",
+            "Current minimum election timeout (randomized up to twice this)",
+            labels=["identifier"],
+        )
+        election_timeout.add_metric([self.identifier], self.machine.election_timeout)
+        yield election_timeout
+
+        usage = self.reducers.state.get_storage_usage()
+
+        logical = GaugeMetricFamily(
+            "distribd_storage_logical_bytes",
+            "Size of every object, counted once for each repository it is in",
+            labels=["identifier"],
+        )
+        logical.add_metric([self.identifier], usage["logical"])
+        yield logical
+
+        physical = GaugeMetricFamily(
+            "distribd_storage_physical_bytes",
+            "Size of every object in the cluster, counted once",
+            labels=["identifier"],
+        )
+        physical.add_metric([self.identifier], usage["physical"])
+        yield physical
+
+        stored = GaugeMetricFamily(
+            "distribd_storage_location_bytes",
+            "Size of the objects stored on each node",
+            labels=["identifier", "location"],
+        )
+        for location, size in usage["locations"].items():
+            stored.add_metric([self.identifier, location], size)
+        yield stored
+
+        backlog = GaugeMetricFamily(
+            "distribd_replication_backlog",
+            "Number of objects each node has yet to replicate",
+            labels=["identifier", "location"],
+        )
+        state = self.reducers.state
+        for location, missing in state.get_replication_backlog().items():
+            backlog.add_metric([self.identifier, location], missing)
+        yield backlog
+
+        sessions = self.upload_sessions
+
+        ingested = CounterMetricFamily(
+            "distribd_upload_ingest_bytes",
+            "Bytes of blob uploads received by this node",
+            labels=["identifier"],
+        )
+        ingested.add_metric([self.identifier], sessions.ingest_bytes)
+        yield ingested
+
+        ingest_time = SummaryMetricFamily(
+            "distribd_upload_ingest_seconds",
+            "Time spent receiving, hashing and writing each upload request body",
+            labels=["identifier"],
+        )
+        ingest_time.add_metric(
+            [self.identifier], sessions.ingest_count, sessions.ingest_seconds
+        )
+        yield ingest_time
+
+        ingest_throughput = SummaryMetricFamily(
+            "distribd_upload_ingest_throughput_bytes_per_second",
+            "Throughput of each upload request body",
+            labels=["identifier"],
+        )
+        ingest_throughput.add_metric(
+            [self.identifier], sessions.ingest_count, sessions.ingest_throughput
+        )
+        yield ingest_throughput
+
+        coalesced = CounterMetricFamily(
+            "distribd_upload_coalesced",
+            "Uploads of blobs that this node had already stored",
+            labels=["identifier"],
+        )
+        coalesced.add_metric([self.identifier], sessions.coalesced)
+        yield coalesced
+
 
 @routes.get("/metrics")
 async def metrics(request):
@@ -73,14 +272,37 @@ async def metrics(request):
     )
 
 
+@routes.get("/storage")
+async def storage(request):
+    registry_state = request.app["registry_state"]
+    usage = registry_state.get_storage_usage()
+    usage["applied_index"] = registry_state.applied_index
+    return web.json_response(usage, dumps=ujson.dumps)
+
+
+@routes.get("/referrers/{digest}")
+async def referrers(request):
+    registry_state = request.app["registry_state"]
+    digest = request.match_info["digest"]
+
+    try:
+        users = registry_state.get_users(digest)
+    except KeyError:
+        raise web.HTTPNotFound()
+
+    return web.json_response({"digest": digest, "users": users}, dumps=ujson.dumps)
+
+
 @routes.get("/healthz")
 async def ok(request):
     return web.json_response({"ok": True}, dumps=ujson.dumps)
 
 
-async def run_prometheus(raft, config, identifier, registry_state, images_directory):
+async def run_prometheus(
+    raft, config, identifier, registry_state, images_directory, upload_sessions
+):
     registry = CollectorRegistry()
-    collector = MetricsCollector(raft)
+    collector = MetricsCollector(raft, upload_sessions)
     registry.register(collector)
 
     return await run_server(
@@ -1,6 +1,8 @@
 import asyncio
+import collections
+import enum
 import logging
-import random
+import math
 
 import aiohttp
 from aiohttp import web
@@ -24,26 +26,218 @@ class RaftAccessLog(AbstractAccessLogger):
         pass
 
 
+class Priority(enum.IntEnum):
+
+    # Elections and leader liveness - must never wait behind client traffic
+    CONTROL = 1
+
+    # Acknowledgements needed to advance the commit index
+    REPLICATION = 2
+
+    # Client proposals
+    PROPOSAL = 3
+
+
+PRIORITIES = {
+    Message.StateChanged: Priority.CONTROL,
+    Message.Tick: Priority.CONTROL,
+    Message.Vote: Priority.CONTROL,
+    Message.VoteReply: Priority.CONTROL,
+    Message.PreVote: Priority.CONTROL,
+    Message.PreVoteReply: Priority.CONTROL,
+    Message.AppendEntries: Priority.CONTROL,
+    Message.AppendEntriesReply: Priority.REPLICATION,
+    Message.AddEntries: Priority.PROPOSAL,
+}
+
+
+# How many times in a row a waiting priority class can be passed over
+STARVATION_LIMIT = 16
+
+# Default cap on proposals that have been accepted but not yet applied
+MAX_PENDING_ENTRIES = 10000
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+# How long to wait for a peer to answer a gossip exchange
+GOSSIP_TIMEOUT = aiohttp.ClientTimeout(total=1.0)
+
+# Bounds on the Retry-After given to clients that are turned away
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 30
+
+
+def priority_for(raw_msg):
+    message_type = getattr(Message, raw_msg["type"].split(".")[1])
+    return PRIORITIES.get(message_type, Priority.REPLICATION)
+
+
+class MessageQueue:
+    """
+    The inbound raft pipeline.
+
+    Messages are processed in priority order, and in FIFO order within a priority
+    class. This means votes, heartbeats and ticks are never stuck behind a backlog
+    of client proposals. A lower class that has been passed over
+    `starvation_limit` times in a row is served next so it still makes progress.
+    """
+
+    def __init__(self, starvation_limit=STARVATION_LIMIT):
+        self.starvation_limit = starvation_limit
+        self.loop = asyncio.get_event_loop()
+
+        self._queues = {priority: collections.deque() for priority in Priority}
+        self._skipped = {priority: 0 for priority in Priority}
+        self._not_empty = asyncio.Event()
+
+        self.wait_count = {priority: 0 for priority in Priority}
+        self.wait_seconds = {priority: 0.0 for priority in Priority}
+
+    @property
+    def depth(self):
+        return {priority: len(queue) for priority, queue in self._queues.items()}
+
+    def qsize(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def put_nowait(self, payload):
+        msg, _ = payload
+        self._queues[priority_for(msg)].append((self.loop.time(), payload))
+        self._not_empty.set()
+
+    async def put(self, payload):
+        self.put_nowait(payload)
+
+    def _select(self):
+        waiting = [priority for priority in Priority if self._queues[priority]]
+
+        selected = waiting[0]
+        for priority in waiting[1:]:
+            if self._skipped[priority] >= self.starvation_limit:
+                selected = priority
+                break
+
+        for priority in waiting:
+            if priority == selected:
+                self._skipped[priority] = 0
+            elif priority > selected:
+                self._skipped[priority] += 1
+
+        return selected
+
+    async def get(self):
+        while not self.qsize():
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        priority = self._select()
+        queued_at, payload = self._queues[priority].popleft()
+
+        self.wait_count[priority] += 1
+        self.wait_seconds[priority] += self.loop.time() - queued_at
+
+        return payload
+
+
 class Raft:
     def __init__(self, config, machine: Machine, storage: Storage, reducers: Reducers):
         self.config = config
         self.machine = machine
         self.storage = storage
         self.reducers = reducers
-        self.queue = asyncio.Queue()
+        self.queue = MessageQueue()
         self.peers = None
 
+        self.max_pending_entries = MAX_PENDING_ENTRIES
+        if config["raft"]["max_pending_entries"].exists():
+            self.max_pending_entries = config["raft"]["max_pending_entries"].get(int)
+
+        self.max_pending_bytes = MAX_PENDING_BYTES
+        if config["raft"]["max_pending_bytes"].exists():
+            self.max_pending_bytes = config["raft"]["max_pending_bytes"].get(int)
+
+        # Proposals made through this node that are waiting to be applied
+        self.pending_entries = 0
+        self.pending_bytes = 0
+        self.rejected_proposals = 0
+
+        # List of (index, entry_count, size) for proposals forwarded to us by
+        # followers. They are pending until the leader has applied them.
+        self._remote_proposals = collections.deque()
+
         self._closed = False
 
         self._ticker = Tick(self._tick)
 
-    async def append(self, entries):
-        if self.machine.state == NodeState.LEADER:
-            index, term = await self._append_local(entries)
-        else:
-            index, term = await self._append_remote(entries)
+    @property
+    def outstanding_entries(self):
+        unapplied = self.machine.log.last_index - self.reducers.applied_index
+        return max(self.pending_entries, unapplied)
+
+    @property
+    def pressure(self):
+        """How close this node is to turning away proposals, from 0 to 1."""
+        return min(
+            1.0,
+            max(
+                self.outstanding_entries / self.max_pending_entries,
+                self.pending_bytes / self.max_pending_bytes,
+            ),
+        )
+
+    @property
+    def retry_after(self):
+        """Estimate how many seconds until the current backlog is applied."""
+        throughput = self.reducers.throughput
+        if throughput <= 0:
+            return MAX_RETRY_AFTER
+        seconds = math.ceil(self.outstanding_entries / throughput)
+        return max(MIN_RETRY_AFTER, min(MAX_RETRY_AFTER, seconds))
+
+    def check_admission(self, entry_count=0, size=0):
+        """Raise TooManyRequests if accepting more work would exceed our caps."""
+        entries_ok = self.outstanding_entries + entry_count <= self.max_pending_entries
+        bytes_ok = self.pending_bytes + size <= self.max_pending_bytes
+
+        if entries_ok and bytes_ok:
+            return
+
+        self.rejected_proposals += 1
+        logger.warning(
+            "Rejecting proposal: %d entries and %d bytes outstanding",
+            self.outstanding_entries,
+            self.pending_bytes,
+        )
+        raise exceptions.TooManyRequests(self.retry_after)
+
+    def _release_remote_proposals(self):
+        while (
+            self._remote_proposals
+            and self._remote_proposals[0][0] <= self.reducers.applied_index
+        ):
+            _, entry_count, size = self._remote_proposals.popleft()
+            self.pending_entries -= entry_count
+            self.pending_bytes -= size
+
+    async def append(self, entries, timeout=None):
+        entry_count = len(entries)
+        size = len(ujson.dumps(entries))
+
+        self.check_admission(entry_count, size)
+
+        self.pending_entries += entry_count
+        self.pending_bytes += size
+
+        try:
+            if self.machine.state == NodeState.LEADER:
+                index, term = await self._append_local(entries)
+            else:
+                index, term = await self._append_remote(entries)
+
+            return await self.reducers.wait_for_commit(term, index, timeout)
 
-        return await self.reducers.wait_for_commit(term, index)
+        finally:
+            self.pending_entries -= entry_count
+            self.pending_bytes -= size
 
     async def _append_local(self, entries):
         logger.critical("_append_local: %s", self.machine.identifier)
@@ -115,6 +309,7 @@ class Raft:
                     logger.exception("Unhandled error while sending message")
 
         await self.reducers.step(self.machine)
+        self._release_remote_proposals()
 
         self.peers.step(self.machine, msg)
 
@@ -145,8 +340,6 @@ class Raft:
                 if task_complete:
                     task_complete.set_result(self.machine)
 
-            self.queue.task_done()
-
     async def run_forever(self):
         queue_worker = self._process_queue()
         listener = self._run_listener()
@@ -186,8 +379,15 @@ class HttpRaft(Raft):
             )
             raise exceptions.LeaderUnavailable()
 
+        if self.machine.leader not in self.peers:
+            logger.debug("Leader %s has not been discovered yet", self.machine.leader)
+            raise exceptions.LeaderUnavailable()
+
         url = self.url_for_peer(self.machine.leader)
         async with self.session.post(url / "append", json=entries) as resp:
+            if resp.status == 429:
+                retry_after = resp.headers.get("Retry-After", MAX_RETRY_AFTER)
+                raise exceptions.TooManyRequests(retry_after)
             if resp.status != 200:
                 logger.critical(resp.status, await resp.text())
                 raise RuntimeError("Remote append failed")
@@ -199,6 +399,10 @@ class HttpRaft(Raft):
             # We don't know where this peer is, drop the message
             return
 
+        if not self.peers.should_contact(message.destination):
+            # Peer is believed dead and isn't due a probe yet
+            return
+
         body = message.to_dict()
 
         try:
@@ -206,43 +410,65 @@ class HttpRaft(Raft):
             async with self.session.post(url / "rpc", json=body) as resp:
                 if resp.status != 200:
                     logger.debug("Message rejected")
+            self.peers.mark_alive(message.destination)
         except aiohttp.ClientError:
             # Message wasn't delivered - client broken or netsplit
-            pass
+            self.peers.mark_failed(message.destination)
 
-    async def spread(self, gossip):
-        async with aiohttp.ClientSession(json_serialize=ujson.dumps) as session:
-            url = URL(random.choice(self.config["seeding"]["urls"].get(list)))
-            try:
-                async with session.post(url / "gossip", json=gossip) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-            except aiohttp.ClientError:
-                pass
-        return {}
+    async def spread(self, url, payload):
+        try:
+            async with self.session.post(
+                URL(url) / "gossip", json=payload, timeout=GOSSIP_TIMEOUT
+            ) as resp:
+                if resp.status == 200:
+                    return await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        return None
 
     async def _receive_message(self, request):
         payload = await request.json()
+        self.peers.mark_alive(payload["source"])
         await self.queue.put((payload, None))
         return web.json_response({}, dumps=ujson.dumps)
 
     async def _receive_append(self, request):
-        entries = await request.json()
+        body = await request.read()
+        entries = ujson.loads(body)
         if self.machine.state != NodeState.LEADER:
             raise exceptions.LeaderUnavailable()
-        index, term = await self._append_local(entries)
+
+        self.check_admission(len(entries), len(body))
+
+        self.pending_entries += len(entries)
+        self.pending_bytes += len(body)
+        try:
+            index, term = await self._append_local(entries)
+        except Exception:
+            self.pending_entries -= len(entries)
+            self.pending_bytes -= len(body)
+            raise
+
+        self._remote_proposals.append((index, len(entries), len(body)))
+
         return web.json_response({"index": index, "term": term}, dumps=ujson.dumps)
 
     async def _receive_gossip(self, request):
         gossip = await request.json()
-        reply = self.peers.exchange_gossip(gossip)
+        if "digest" in gossip or "rumours" in gossip:
+            reply = self.peers.exchange_digest(gossip)
+        else:
+            # Full gossip maps from nodes that predate digest exchange
+            reply = self.peers.exchange_gossip(gossip)
         return web.json_response(reply, dumps=ujson.dumps)
 
     async def _receive_status(self, request):
         stable = self.machine.log.last_index == self.reducers.applied_index
         stable = stable and self.machine.leader_active
+        # A follower can hear from the leader before gossip has told it where the
+        # leader is, and until then it can't forward anything to it
         stable = stable and (
-            self.machine.state == NodeState.LEADER or self.machine.leader is not None
+            self.machine.state == NodeState.LEADER or self.machine.leader in self.peers
         )
 
         payload = {
@@ -251,6 +477,8 @@ class HttpRaft(Raft):
             "log_last_term": self.machine.log.last_term,
             "applied_index": self.reducers.applied_index,
             "committed_index": self.machine.commit_index,
+            "pending_entries": self.outstanding_entries,
+            "pending_bytes": self.pending_bytes,
             # No unapplied log entries
             "stable": stable,
             # DEPRECATED
@@ -1,27 +1,266 @@
 import asyncio
+import collections
+import heapq
+import itertools
 import logging
+import os
 
 from .machine import Machine
 
 logger = logging.getLogger(__name__)
 
+# How far back (in seconds) to look when estimating commit throughput
+THROUGHPUT_WINDOW = 10.0
+
+# Abandoned waiters are dropped from the heap once there are at least this many
+# and they make up more than half of it
+COMPACT_THRESHOLD = 64
+
+# The most committed entries a subscriber is handed at once
+SUBSCRIBER_BATCH_SIZE = 1000
+
+# How often (in seconds) a subscriber persists its cursor while it is busy
+CURSOR_SAVE_INTERVAL = 1.0
+
+
+class Subscriber:
+    """
+    Feeds committed log entries to a side effect at its own pace.
+
+    Each subscriber keeps a cursor of the last entry it has processed. The raft
+    step loop only wakes it up, so a slow subscriber lags behind the log rather
+    than holding up consensus. Entries are read straight from the log in batches
+    of at most `batch_size`, so a subscriber that falls behind doesn't buffer
+    anything. If `path` is set then the cursor is persisted there so that after a
+    restart the subscriber carries on from where it left off instead of
+    processing the whole log again.
+
+    The callback is handed a view of the state, so it doesn't change underneath
+    it while it is awaited. The view is taken just before each batch, so it
+    always includes the entries in it.
+
+    The cursor moves on once the callback returns, even if it spawned work that
+    is still running. Once the state has caught up with the cursor the callback
+    is called with no entries. This gives it a chance to reconcile anything it
+    missed while stopped, including work that was cut short.
+    """
+
+    def __init__(
+        self, name, callback, reducers, path=None, batch_size=SUBSCRIBER_BATCH_SIZE
+    ):
+        self.name = name
+        self.callback = callback
+        self.reducers = reducers
+        self.path = path
+        self.batch_size = batch_size
+
+        self.cursor = self._load_cursor()
+        self.saved_cursor = self.cursor
+        self.caught_up = False
+
+        self._wakeup = asyncio.Event()
+        self._save_handle = None
+        self._task = None
+
+    @property
+    def lag(self):
+        """The number of applied entries this subscriber has yet to process."""
+        return max(0, self.reducers.applied_index - self.cursor)
+
+    def _load_cursor(self):
+        if not self.path or not self.path.exists():
+            return 0
+
+        try:
+            cursor = int(self.path.read_text())
+        except ValueError:
+            logger.warning("Ignoring corrupt cursor for subscriber %s", self.name)
+            return 0
+
+        # If the journal has been thrown away then so has our position in it
+        if cursor > self.reducers.machine.log.last_index:
+            logger.warning("Cursor for subscriber %s is ahead of the log", self.name)
+            return 0
+
+        return cursor
+
+    def save(self):
+        """Atomically persist the cursor."""
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
+
+        if not self.path or self.saved_cursor == self.cursor:
+            return
+
+        if not self.path.parent.exists():
+            os.makedirs(self.path.parent)
+
+        temporary_path = self.path.with_suffix(".tmp")
+        temporary_path.write_text(str(self.cursor))
+        os.replace(temporary_path, self.path)
+
+        self.saved_cursor = self.cursor
+
+    def _schedule_save(self):
+        if self._save_handle or not self.path:
+            return
+        self._save_handle = self.reducers.loop.call_later(
+            CURSOR_SAVE_INTERVAL, self.save
+        )
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        if not self._task:
+            self._task = self.reducers.loop.create_task(self.run())
+        self.notify()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.save()
+
+    async def _dispatch(self, state, entries, end):
+        try:
+            result = self.callback(state, entries)
+            if asyncio.iscoroutine(result):
+                await result
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(
+                "Subscriber %s failed to process entries %d to %d",
+                self.name,
+                self.cursor + 1,
+                end,
+            )
+
+    async def process(self):
+        """Hand every entry that has been applied to the callback, a batch at a time."""
+        if not self.caught_up and self.reducers.applied_index >= self.cursor:
+            self.caught_up = True
+            await self._dispatch(self.reducers.state.view(), [], self.cursor)
+
+        while self.cursor < self.reducers.applied_index:
+            state = self.reducers.state.view()
+            end = min(self.cursor + self.batch_size, state.applied_index)
+            entries = self.reducers.machine.log[self.cursor + 1 : end + 1]
+
+            await self._dispatch(state, entries, end)
+
+            self.cursor = end
+            self._schedule_save()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self.process()
+
 
 class Reducers:
-    def __init__(self, machine: Machine, state):
+    def __init__(self, machine: Machine, state, cursors_directory=None):
         # Entries that are safely committed
         self.applied_index = 0
 
-        # Functions to call with changes that are safe to apply to replicated data structures.
-        self._callbacks = []
+        # Side effects that are fed changes once they have been applied to the state
+        self.cursors_directory = cursors_directory
+        self.subscribers = {}
+
+        # Called with every batch of entries as soon as it has been applied
+        self.listeners = []
 
-        # List of (commit_index, event)
+        # A min-heap of (commit_index, sequence, future)
         self._waiters = []
+        self._sequence = itertools.count()
+
+        # Number of waiters in the heap that were cancelled or timed out
+        self._abandoned = 0
+
+        # List of (time, entry_count) for recently applied batches
+        self._applied_batches = collections.deque()
 
         self.machine = machine
         self.state = state
+        self.loop = asyncio.get_event_loop()
+
+    def add_side_effects(self, name, callback):
+        """
+        Subscribe `callback` to entries once they have been applied to the state.
+
+        The callback is called with the state and a batch of entries and can be a
+        normal function or a coroutine function. It runs in its own task so it
+        doesn't block the raft log.
+        """
+        path = None
+        if self.cursors_directory:
+            path = self.cursors_directory / name
+
+        subscriber = Subscriber(name, callback, self, path)
+        self.subscribers[name] = subscriber
+        subscriber.start()
+        return subscriber
+
+    def add_listener(self, callback):
+        """
+        Call `callback` with each batch of entries and its last index as it is applied.
+
+        Unlike side effects this runs inline in the apply path, so it must be cheap
+        and must not block. It is for in-memory indexes that have to be up to date
+        as soon as the state is.
+        """
+        self.listeners.append(callback)
+
+    async def close(self):
+        await asyncio.gather(*(s.close() for s in self.subscribers.values()))
+
+    def _expire_batches(self, now):
+        while (
+            self._applied_batches
+            and self._applied_batches[0][0] < now - THROUGHPUT_WINDOW
+        ):
+            self._applied_batches.popleft()
+
+    @property
+    def waiting(self):
+        """The number of clients waiting for an index to be committed."""
+        return len(self._waiters) - self._abandoned
+
+    def _waiter_done(self, future):
+        if not future.cancelled():
+            return
 
-    def add_side_effects(self, callback):
-        self._callbacks.append(callback)
+        self._abandoned += 1
+
+        if self._abandoned >= COMPACT_THRESHOLD and self._abandoned * 2 > len(
+            self._waiters
+        ):
+            self._waiters = [w for w in self._waiters if not w[2].done()]
+            heapq.heapify(self._waiters)
+            self._abandoned = 0
+
+    def _wake_waiters(self, index):
+        """Wake everyone waiting on an index up to and including `index`."""
+        while self._waiters and self._waiters[0][0] <= index:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                self._abandoned -= 1
+                continue
+            future.set_result(None)
+
+    @property
+    def throughput(self):
+        """Number of entries applied per second, averaged over a short window."""
+        self._expire_batches(self.loop.time())
+        applied = sum(count for _, count in self._applied_batches)
+        return applied / THROUGHPUT_WINDOW
 
     async def step(self, machine: Machine):
         """Indexes up to `commit_index` can now be applied to the state machine."""
@@ -30,32 +269,43 @@ class Reducers:
 
         logger.critical("Safe to apply log up to index %d", machine.commit_index)
 
-        entries = self.machine.log[self.applied_index : machine.commit_index + 1]
+        entries = self.machine.log[self.applied_index + 1 : machine.commit_index + 1]
 
-        self.state.dispatch_entries(entries)
+        self.state.dispatch_entries(entries, machine.commit_index)
 
-        for callback in self._callbacks:
-            callback(self.state, entries)
-
-        waiters = []
-        for waiter_index, ev in self._waiters:
-            if waiter_index <= machine.commit_index:
-                ev.set()
-                continue
-            waiters.append((waiter_index, ev))
-        self._waiters = waiters
+        now = self.loop.time()
+        self._applied_batches.append((now, machine.commit_index - self.applied_index))
+        self._expire_batches(now)
 
         logger.debug("Applied index %d", machine.commit_index)
         self.applied_index = machine.commit_index
 
-    async def wait_for_commit(self, term, index):
+        for listener in self.listeners:
+            try:
+                listener(entries, machine.commit_index)
+            except Exception:
+                logger.exception(
+                    "Listener failed to process index %d", self.applied_index
+                )
+
+        self._wake_waiters(machine.commit_index)
+
+        for subscriber in self.subscribers.values():
+            subscriber.notify()
+
+    async def wait_for_commit(self, term, index, timeout=None):
+        """
+        Wait until `index` has been applied.
+
+        Returns True if the entry that was applied is the one from `term`. Raises
+        asyncio.TimeoutError if that doesn't happen within `timeout` seconds. If the
+        caller is cancelled or times out the waiter is discarded.
+        """
         if index <= self.applied_index:
             return self.machine.log[index][0] == term
 
         logger.critical("Waiting for commit %s %s", term, index)
-        ev = asyncio.Event()
-        self._waiters.append((index, ev))
-        await ev.wait()
+        await self.wait_for_applied(index, timeout)
         logger.critical(
             "Commit availalbe for waiter %s %s %s",
             term,
@@ -63,3 +313,17 @@ class Reducers:
             self.machine.log[index][0] == term,
         )
         return self.machine.log[index][0] == term
+
+    async def wait_for_applied(self, index, timeout=None):
+        """
+        Wait until `index` has been applied, whichever term it came from.
+
+        Raises asyncio.TimeoutError if that doesn't happen within `timeout` seconds.
+        """
+        if index <= self.applied_index:
+            return
+
+        future = self.loop.create_future()
+        future.add_done_callback(self._waiter_done)
+        heapq.heappush(self._waiters, (index, next(self._sequence), future))
+        await asyncio.wait_for(future, timeout)
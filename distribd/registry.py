@@ -1,9 +1,12 @@
+import asyncio
 import hashlib
 import logging
+import math
 import os
 import uuid
 
 from aiofile import AIOFile, Writer
+import aiohttp
 from aiohttp import web
 import ujson
 from yarl import URL
@@ -11,16 +14,28 @@ from yarl import URL
 from . import exceptions
 from .actions import RegistryActions
 from .analyzer import recursive_analyze
+from .mirror import TransferFailed
 from .raft import Raft
-from .state import ATTR_CONTENT_TYPE
+from .state import ATTR_CONTENT_TYPE, ATTR_SIZE
+from .utils.aio import open_for_writing
 from .utils.registry import get_blob_path, get_manifest_path
 from .utils.tokenchecker import TokenChecker
-from .utils.web import run_server
+from .utils.web import peer_url, proxy_request, run_server
+from .watch import MAX_WATCH_TIMEOUT, WATCH_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
 routes = web.RouteTableDef()
 
+# Blobs are streamed to clients in chunks of this size
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+# Set on upload requests that have been forwarded to the node that owns the session
+FORWARDED_HEADER = "Distribd-Forwarded-By"
+
+# Lists the byte ranges of an upload that haven't been received yet
+MISSING_RANGES_HEADER = "Distribd-Missing-Ranges"
+
 
 @routes.get("/v2")
 async def handle_bare_v2(request):
@@ -33,6 +48,36 @@ async def handle_v2_root(request):
     return web.Response(text="")
 
 
+@routes.get("/v2/_catalog")
+async def list_repositories(request):
+    registry_state = request.app["registry_state"]
+
+    request.app["token_checker"].authenticate(
+        request, "catalog", ["*"], resource_type="registry"
+    )
+
+    last = request.query.get("last", None)
+
+    n = request.query.get("n", None)
+    if n is not None:
+        n = int(n)
+
+    repositories, include_link = registry_state.get_catalog_page(last, n)
+
+    headers = {}
+
+    if include_link and repositories:
+        url = URL("/v2/_catalog")
+        if n is not None:
+            url = url.update_query({"n": str(n)})
+        url = url.update_query({"last": repositories[-1]})
+        headers["Link"] = f'{url}; rel="next"'
+
+    return web.json_response(
+        {"repositories": repositories}, headers=headers, dumps=ujson.dumps
+    )
+
+
 @routes.get("/v2/{repository:[^{}]+}/tags/list")
 async def list_images_in_repository(request):
     registry_state = request.app["registry_state"]
@@ -40,31 +85,20 @@ async def list_images_in_repository(request):
 
     request.app["token_checker"].authenticate(request, repository, ["pull"])
 
-    try:
-        tags = registry_state.get_tags(repository)
-    except KeyError:
-        raise exceptions.NameUnknown(repository=repository)
-
-    tags.sort()
-
-    include_link = False
-
     last = request.query.get("last", None)
-    if last:
-        start = tags.index(last)
-        tags = tags[start:]
 
     n = request.query.get("n", None)
     if n is not None:
         n = int(n)
-        if n < len(tags):
-            include_link = True
 
-        tags = tags[:n]
+    try:
+        tags, include_link = registry_state.get_tags_page(repository, last, n)
+    except KeyError:
+        raise exceptions.NameUnknown(repository=repository)
 
     headers = {}
 
-    if include_link:
+    if include_link and tags:
         url = URL(f"/v2/{repository}/tags/list")
         if n is not None:
             url = url.update_query({"n": str(n)})
@@ -76,14 +110,140 @@ async def list_images_in_repository(request):
     )
 
 
-async def _manifest_head_by_hash(
-    images_directory, repository: str, hash: str, content_type: str
-):
+@routes.get("/v2/{repository:[^{}]+}/tags/watch")
+async def watch_tags(request):
+    """
+    Long poll for tags in a repository being pointed at a new manifest.
+
+    Blocks until a tag is changed by an entry after the raft index `since`, or
+    `timeout` seconds pass. Only `tag` is watched if it is given. The response
+    includes the index to pass as `since` next time.
+    """
+    registry_state = request.app["registry_state"]
+    tag_watchers = request.app["tag_watchers"]
+    repository = request.match_info["repository"]
+
+    request.app["token_checker"].authenticate(request, repository, ["pull"])
+
+    tag = request.query.get("tag", None)
+
+    try:
+        since = int(request.query.get("since", registry_state.applied_index))
+        timeout = float(request.query.get("timeout", WATCH_TIMEOUT))
+    except ValueError:
+        raise exceptions.WatchInvalid()
+
+    if since < 0 or not 0 <= timeout <= MAX_WATCH_TIMEOUT:
+        raise exceptions.WatchInvalid(since=since, timeout=timeout)
+
+    changes = await tag_watchers.wait(repository, since, tag, timeout)
+
+    tags = {}
+    for changed in sorted(changes):
+        try:
+            tags[changed] = registry_state.get_tag(repository, changed)
+        except KeyError:
+            # It has since been deleted along with its manifest
+            tags[changed] = None
+
+    return web.json_response(
+        {"name": repository, "index": registry_state.applied_index, "tags": tags},
+        dumps=ujson.dumps,
+    )
+
+
+def _read_through_size(request, hash):
+    """
+    The size of an object that isn't stored here yet but can be fetched from a peer.
+
+    A HEAD is usually followed by a GET, so this starts the download early.
+    """
+    size = request.app["registry_state"][hash].get(ATTR_SIZE)
+    if size is None or not request.app["mirrorer"].read_through(hash):
+        return None
+    return size
+
+
+def _local_size(request, path, hash):
+    """
+    The size of an object stored on this node, or None if it isn't stored here.
+
+    This comes from the registry state so that it doesn't cost a syscall, unless
+    `verify_local_objects` is turned on or the size was never recorded.
+    """
+    registry_state = request.app["registry_state"]
+
+    if not registry_state.is_stored(hash, request.app["identifier"]):
+        return None
+
+    size = registry_state.get_size(hash)
+    if size is not None and not request.app["verify_local_objects"]:
+        return size
+
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        logger.warning("%s is recorded as stored here but is missing", hash)
+        return None
+
+
+async def _load_manifest(request, images_directory, hash: str):
+    """Return the body of a manifest stored on this node, or None if it isn't."""
+    manifest_cache = request.app["manifest_cache"]
+
+    manifest = manifest_cache.get(hash)
+    if manifest is not None:
+        return manifest
+
+    if not request.app["registry_state"].is_stored(hash, request.app["identifier"]):
+        return None
+
     manifest_path = get_manifest_path(images_directory, hash)
-    if not manifest_path.is_file():
-        raise exceptions.ManifestUnknown(hash=hash)
+    try:
+        async with AIOFile(manifest_path, "rb") as fp:
+            # Clients disconnect part way through requests, which cancels this.
+            # Let the read in flight finish so caio doesn't wedge.
+            manifest = await asyncio.shield(fp.read())
+    except FileNotFoundError:
+        logger.warning("%s is recorded as stored here but is missing", hash)
+        return None
+
+    manifest_cache.put(hash, manifest)
+    return manifest
+
+
+def _manifest_not_modified(request, hash: str, content_type: str):
+    if not _etag_matches(request.headers.get("If-None-Match", ""), f'"{hash}"'):
+        return None
 
-    size = os.path.getsize(manifest_path)
+    return web.Response(
+        status=304,
+        headers={
+            "Docker-Content-Digest": hash,
+            "Content-Type": content_type,
+            "ETag": f'"{hash}"',
+        },
+    )
+
+
+async def _manifest_head_by_hash(
+    request, images_directory, repository: str, hash: str, content_type: str
+):
+    not_modified = _manifest_not_modified(request, hash, content_type)
+    if not_modified is not None:
+        return not_modified
+
+    manifest = request.app["manifest_cache"].get(hash)
+    if manifest is not None:
+        size = len(manifest)
+    else:
+        manifest_path = get_manifest_path(images_directory, hash)
+        size = _local_size(request, manifest_path, hash)
+
+    if size is None:
+        size = _read_through_size(request, hash)
+        if size is None:
+            raise exceptions.ManifestUnknown(hash=hash)
 
     return web.Response(
         status=200,
@@ -91,10 +251,94 @@ async def _manifest_head_by_hash(
             "Content-Length": str(size),
             "Docker-Content-Digest": f"{hash}",
             "Content-Type": content_type,
+            "ETag": f'"{hash}"',
+        },
+    )
+
+
+@routes.get("/v2/{repository:[^{}]+}/referrers/sha256:{hash}")
+async def list_referrers(request):
+    registry_state = request.app["registry_state"]
+    repository = request.match_info["repository"]
+    hash = "sha256:" + request.match_info["hash"]
+
+    request.app["token_checker"].authenticate(request, repository, ["pull"])
+
+    try:
+        referrers = registry_state.get_referrers(hash)
+    except KeyError:
+        referrers = set()
+
+    manifests = []
+    for digest in sorted(referrers):
+        if not registry_state.is_manifest_available(repository, digest):
+            continue
+
+        manifest = registry_state[digest]
+        manifests.append(
+            {
+                "mediaType": manifest[ATTR_CONTENT_TYPE],
+                "digest": digest,
+                "size": manifest.get(ATTR_SIZE, 0),
+            }
+        )
+
+    return web.json_response(
+        {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.index.v1+json",
+            "manifests": manifests,
         },
+        content_type="application/vnd.oci.image.index.v1+json",
+        dumps=ujson.dumps,
     )
 
 
+async def _send_transfer(request, transfer, digest, content_type, size, unknown):
+    """
+    Stream an object to the client while it is being mirrored from a peer.
+
+    `unknown` is raised if the download fails before anything has been sent.
+    Failing after that drops the connection so a client never accepts a
+    truncated or corrupt object.
+    """
+    chunks = transfer.follow(BLOB_CHUNK_SIZE)
+
+    try:
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            chunk = b""
+        except TransferFailed:
+            raise unknown
+
+        response = web.StreamResponse(
+            headers={
+                "Docker-Content-Digest": digest,
+                "Content-Type": content_type,
+                "ETag": f'"{digest}"',
+            }
+        )
+        if size is not None:
+            response.content_length = size
+        await response.prepare(request)
+
+        await response.write(chunk)
+
+        try:
+            async for chunk in chunks:
+                await response.write(chunk)
+        except TransferFailed:
+            logger.warning("Read through of %s failed part way through", digest)
+            raise
+
+    finally:
+        await chunks.aclose()
+
+    await response.write_eof()
+    return response
+
+
 @routes.head("/v2/{repository:[^{}]+}/manifests/sha256:{hash}")
 async def head_manifest_by_hash(request):
     images_directory = request.app["images_directory"]
@@ -109,7 +353,7 @@ async def head_manifest_by_hash(request):
 
     content_type = registry_state[hash][ATTR_CONTENT_TYPE]
     return await _manifest_head_by_hash(
-        images_directory, repository, hash, content_type
+        request, images_directory, repository, hash, content_type
     )
 
 
@@ -134,26 +378,40 @@ async def head_manifest_by_tag(request):
 
     content_type = registry_state[hash][ATTR_CONTENT_TYPE]
     return await _manifest_head_by_hash(
-        images_directory, repository, hash, content_type
+        request, images_directory, repository, hash, content_type
     )
 
 
 async def _manifest_by_hash(
-    images_directory, repository: str, hash: str, content_type: str
+    request, images_directory, repository: str, hash: str, content_type: str
 ):
-    manifest_path = get_manifest_path(images_directory, hash)
-    if not manifest_path.is_file():
-        raise exceptions.ManifestUnknown(hash=hash)
-
-    size = os.path.getsize(manifest_path)
+    not_modified = _manifest_not_modified(request, hash, content_type)
+    if not_modified is not None:
+        return not_modified
+
+    manifest = await _load_manifest(request, images_directory, hash)
+    if manifest is None:
+        transfer = request.app["mirrorer"].read_through(hash)
+        if not transfer:
+            raise exceptions.ManifestUnknown(hash=hash)
+
+        size = request.app["registry_state"][hash].get(ATTR_SIZE)
+        return await _send_transfer(
+            request,
+            transfer,
+            hash,
+            content_type,
+            size,
+            exceptions.ManifestUnknown(hash=hash),
+        )
 
-    return web.FileResponse(
+    return web.Response(
+        body=manifest,
         headers={
             "Docker-Content-Digest": f"{hash}",
             "Content-Type": content_type,
-            "Content-Length": str(size),
+            "ETag": f'"{hash}"',
         },
-        path=manifest_path,
     )
 
 
@@ -170,7 +428,9 @@ async def get_manifest_by_hash(request):
         raise exceptions.ManifestUnknown(hash=hash)
 
     content_type = registry_state[hash][ATTR_CONTENT_TYPE]
-    return await _manifest_by_hash(images_directory, repository, hash, content_type)
+    return await _manifest_by_hash(
+        request, images_directory, repository, hash, content_type
+    )
 
 
 @routes.get("/v2/{repository:[^{}]+}/manifests/{tag}")
@@ -193,7 +453,9 @@ async def get_manifest_by_tag(request):
         raise exceptions.ManifestUnknown(hash=hash)
 
     content_type = registry_state[hash][ATTR_CONTENT_TYPE]
-    return await _manifest_by_hash(images_directory, repository, hash, content_type)
+    return await _manifest_by_hash(
+        request, images_directory, repository, hash, content_type
+    )
 
 
 @routes.delete("/v2/{repository:[^{}]+}/manifests/sha256:{hash}")
@@ -203,6 +465,7 @@ async def delete_manifest_by_hash(request):
     hash = "sha256:" + request.match_info["hash"]
 
     request.app["token_checker"].authenticate(request, repository, ["push"])
+    request.app["raft"].check_admission()
 
     if not registry_state.is_manifest_available(repository, hash):
         raise exceptions.ManifestUnknown(hash=hash)
@@ -248,10 +511,11 @@ async def head_blob(request):
         raise exceptions.BlobUnknown(hash=hash)
 
     hash_path = get_blob_path(images_directory, hash)
-    if not hash_path.is_file():
-        raise exceptions.BlobUnknown(hash=hash)
-
-    size = hash_path.stat().st_size
+    size = _local_size(request, hash_path, hash)
+    if size is None:
+        size = _read_through_size(request, hash)
+        if size is None:
+            raise exceptions.BlobUnknown(hash=hash)
 
     return web.Response(
         status=200,
@@ -259,10 +523,112 @@ async def head_blob(request):
             "Content-Length": f"{size}",
             "Docker-Content-Digest": hash,
             "Content-Type": "application/octet-stream",
+            "Accept-Ranges": "bytes",
+            "ETag": f'"{hash}"',
         },
     )
 
 
+def _etag_matches(header, etag):
+    """Weak comparison of an `If-None-Match` header against `etag`."""
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in (etag, "*"):
+            return True
+    return False
+
+
+def _requested_range(request, etag, size):
+    """
+    Work out which part of a blob a GET is asking for.
+
+    Returns a `(start, end)` pair where `end` is exclusive, or None if the whole
+    blob should be sent. Blobs are content addressed, so the digest is a strong
+    validator and an `If-Range` that doesn't match it means the client holds
+    something else and needs the whole blob.
+    """
+    if "Range" not in request.headers:
+        return None
+
+    if_range = request.headers.get("If-Range")
+    if if_range is not None and if_range != etag:
+        return None
+
+    try:
+        rng = request.http_range
+    except ValueError:
+        # Multiple or malformed ranges. A server is allowed to ignore these.
+        return None
+
+    start = rng.start
+    if start < 0:
+        start = max(0, size + start)
+
+    end = size if rng.stop is None else min(rng.stop, size)
+
+    if start >= size:
+        raise web.HTTPRequestRangeNotSatisfiable(
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+
+    return start, end
+
+
+async def _send_blob(request, path, digest, content_type, size):
+    etag = f'"{digest}"'
+
+    headers = {
+        "Docker-Content-Digest": digest,
+        "Content-Type": content_type,
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+    }
+
+    if _etag_matches(request.headers.get("If-None-Match", ""), etag):
+        return web.Response(status=304, headers=headers)
+
+    if "Range" not in request.headers:
+        # Most reads are for the whole blob, so let aiohttp use sendfile. It
+        # only opens the file after this returns, so check it is there first.
+        if not path.exists():
+            raise FileNotFoundError(path)
+        return web.FileResponse(path, headers=headers)
+
+    # aiohttp only understands If-Range dates, so ranges are sent by hand
+    start, end = 0, size
+    status = 200
+
+    requested = _requested_range(request, etag, size)
+    if requested:
+        start, end = requested
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+
+        loop = asyncio.get_event_loop()
+        offset = start
+        while offset < end:
+            length = min(BLOB_CHUNK_SIZE, end - offset)
+            chunk = await loop.run_in_executor(None, os.pread, fd, length, offset)
+            if not chunk:
+                break
+            await response.write(chunk)
+            offset += len(chunk)
+
+    finally:
+        os.close(fd)
+
+    await response.write_eof()
+    return response
+
+
 @routes.get("/v2/{repository:[^{}]+}/blobs/sha256:{hash}")
 async def get_blob_by_hash(request):
     images_directory = request.app["images_directory"]
@@ -277,19 +643,29 @@ async def get_blob_by_hash(request):
         raise exceptions.BlobUnknown(hash=hash)
 
     hash_path = get_blob_path(images_directory, hash)
-    if not hash_path.is_file():
-        raise exceptions.BlobUnknown(hash=hash)
-
-    size = os.path.getsize(hash_path)
+    size = _local_size(request, hash_path, hash)
+    if size is None:
+        # Known to the cluster but not mirrored here yet, so fetch it from a peer
+        transfer = request.app["mirrorer"].read_through(hash)
+        if not transfer:
+            raise exceptions.BlobUnknown(hash=hash)
+
+        return await _send_transfer(
+            request,
+            transfer,
+            hash,
+            "application/octet-stream",
+            registry_state[hash].get(ATTR_SIZE),
+            exceptions.BlobUnknown(hash=hash),
+        )
 
-    return web.FileResponse(
-        headers={
-            "Docker-Content-Digest": hash,
-            "Content-Type": "application/octet-stream",
-            "Content-Length": str(size),
-        },
-        path=hash_path,
-    )
+    try:
+        return await _send_blob(
+            request, hash_path, hash, "application/octet-stream", size
+        )
+    except FileNotFoundError:
+        logger.warning("%s is recorded as stored here but is missing", hash)
+        raise exceptions.BlobUnknown(hash=hash)
 
 
 @routes.delete("/v2/{repository:[^{}]+}/blobs/sha256:{hash}")
@@ -300,6 +676,7 @@ async def delete_blob_by_hash(request):
     hash = "sha256:" + request.match_info["hash"]
 
     request.app["token_checker"].authenticate(request, repository, ["push"])
+    request.app["raft"].check_admission()
 
     if not registry_state.is_blob_available(repository, hash):
         raise exceptions.BlobUnknown(hash=hash)
@@ -323,15 +700,93 @@ async def delete_blob_by_hash(request):
     return web.Response(status=202, headers={"Content-Length": "0"})
 
 
+def _blob_stored(request, digest):
+    """Returns True if this node has a complete, recorded copy of a blob."""
+    registry_state = request.app["registry_state"]
+
+    if not registry_state.is_stored(digest, request.app["identifier"]):
+        return False
+
+    if registry_state.get_size(digest) is None:
+        return False
+
+    return get_blob_path(request.app["images_directory"], digest).exists()
+
+
+async def _store_blob(request, repository, digest, upload_path, size):
+    """
+    Move a finished upload into place and record it in the journal.
+
+    If this node already stores the blob then the upload is thrown away instead.
+    Only the actions that would change something are proposed, so pushing a
+    layer that is already in the repository doesn't touch the journal at all.
+    If the journal turns the proposal away with TooManyRequests then nothing was
+    recorded, and the upload is left at `upload_path`.
+    Call this while holding `sessions.storing(digest)`.
+    """
+    registry_state = request.app["registry_state"]
+    identifier = request.app["identifier"]
+
+    actions = []
+
+    if not registry_state.is_blob_available(repository, digest):
+        actions.append(
+            {
+                "type": RegistryActions.BLOB_MOUNTED,
+                "hash": digest,
+                "repository": repository,
+                "user": request["user"],
+            }
+        )
+
+    if registry_state.get_size(digest) is None:
+        actions.append(
+            {"type": RegistryActions.BLOB_STAT, "hash": digest, "size": size}
+        )
+
+    coalesced = _blob_stored(request, digest)
+
+    if not coalesced:
+        blob_path = get_blob_path(request.app["images_directory"], digest)
+        blob_dir = blob_path.parent
+        if not blob_dir.exists():
+            os.makedirs(blob_dir)
+
+        os.rename(upload_path, blob_path)
+
+        actions.append(
+            {
+                "type": RegistryActions.BLOB_STORED,
+                "hash": digest,
+                "location": identifier,
+                "user": request["user"],
+            }
+        )
+
+    try:
+        if actions and not await request.app["send_action"](actions):
+            raise exceptions.BlobUploadInvalid()
+    except exceptions.TooManyRequests:
+        # Nothing was proposed, so put the upload back for the caller
+        if not coalesced:
+            os.rename(blob_path, upload_path)
+        raise
+
+    if coalesced:
+        logger.debug("Upload of %s coalesced with the stored copy", digest)
+        request.app["sessions"].coalesced += 1
+        if upload_path:
+            upload_path.unlink()
+
+
 @routes.post("/v2/{repository:[^{}]+}/blobs/uploads/")
 async def start_upload(request):
-    images_directory = request.app["images_directory"]
-
     repository = request.match_info["repository"]
     mount_digest = request.query.get("mount", "")
     mount_repository = request.query.get("from", "")
 
     request.app["token_checker"].authenticate(request, repository, ["push"])
+    request.app["raft"].check_admission()
 
     if mount_digest and mount_repository:
         request.app["token_checker"].authenticate(request, mount_repository, ["pull"])
@@ -376,72 +831,53 @@ async def start_upload(request):
                 },
             )
 
-    session_id = str(uuid.uuid4())
-
-    session = request.app["sessions"][session_id] = {
-        "hasher": hashlib.sha256(),
-        "size": 0,
-    }
+    sessions = request.app["sessions"]
 
     expected_digest = request.query.get("digest", None)
     if expected_digest:
-        uploads = images_directory / "uploads"
-        if not uploads.exists():
-            os.makedirs(uploads)
-
-        upload_path = uploads / session_id
-
-        async with AIOFile(upload_path, "ab") as fp:
-            writer = Writer(fp)
-            chunk = await request.content.read(1024 * 1024)
-            while chunk:
-                await writer(chunk)
-                session["hasher"].update(chunk)
-                session["size"] += len(chunk)
-                chunk = await request.content.read(1024 * 1024)
-            await fp.fsync()
-
-        hash = session["hasher"].hexdigest()
-        digest = f"sha256:{hash}"
+        registry_state = request.app["registry_state"]
+        if registry_state.is_blob_available(
+            repository, expected_digest
+        ) and _blob_stored(request, expected_digest):
+            # This repository already has the layer, so there is nothing to hash,
+            # write or record. Read the body so the client isn't cut off
+            # mid-request.
+            while await request.content.read(BLOB_CHUNK_SIZE):
+                pass
 
-        if expected_digest != digest:
-            raise exceptions.BlobUploadInvalid()
+            sessions.coalesced += 1
 
-        blob_path = get_blob_path(images_directory, digest)
-        blob_dir = blob_path.parent
-        if not blob_dir.exists():
-            os.makedirs(blob_dir)
+            return web.Response(
+                status=201,
+                headers={
+                    "Location": f"/v2/{repository}/blobs/{expected_digest}",
+                    "Docker-Content-Digest": expected_digest,
+                },
+            )
 
-        os.rename(upload_path, blob_path)
+        session = sessions.create(repository)
+        upload_path = session.path
 
-        send_action = request.app["send_action"]
-        identifier = request.app["identifier"]
+        await session.ingest(request.content)
 
-        success = await send_action(
-            [
-                {
-                    "type": RegistryActions.BLOB_MOUNTED,
-                    "hash": digest,
-                    "repository": repository,
-                    "user": request["user"],
-                },
-                {
-                    "type": RegistryActions.BLOB_STAT,
-                    "hash": digest,
-                    "size": session["size"],
-                },
-                {
-                    "type": RegistryActions.BLOB_STORED,
-                    "hash": digest,
-                    "location": identifier,
-                    "user": request["user"],
-                },
-            ]
-        )
+        sessions.discard(session.session_id)
 
-        if not success:
+        hash = session.hasher.hexdigest()
+        digest = f"sha256:{hash}"
+
+        if expected_digest != digest:
             raise exceptions.BlobUploadInvalid()
 
+        async with sessions.storing(digest):
+            try:
+                await _store_blob(
+                    request, repository, digest, upload_path, session.size
+                )
+            except exceptions.TooManyRequests:
+                # There is no session to finish later, so don't leave it behind
+                upload_path.unlink()
+                raise
+
         return web.Response(
             status=201,
             headers={
@@ -450,6 +886,9 @@ async def start_upload(request):
             },
         )
 
+    session = sessions.create(repository)
+    session_id = session.session_id
+
     return web.Response(
         status=202,
         headers={
@@ -460,54 +899,112 @@ async def start_upload(request):
     )
 
 
+async def _forward_upload(request, session_id):
+    """
+    Stream an upload request to the node that owns its session and relay the reply.
+
+    Neither the request body nor the response is buffered, so a chunk can be
+    sent to any node behind a load balancer.
+    """
+    owner = request.app["sessions"].owner(session_id)
+    peers = request.app["peers"]
+
+    if FORWARDED_HEADER in request.headers or owner not in peers:
+        # Either the owner doesn't think it owns the session or it isn't a node we
+        # know about. Don't bounce the request around the cluster.
+        raise exceptions.BlobUploadUnknown(session=session_id)
+
+    url = f"{peer_url(peers[owner]['registry'])}{request.rel_url}"
+
+    logger.debug("Forwarding %s %s to %s", request.method, request.path, owner)
+
+    # Borrow the client session used to talk to peers for mirroring
+    client = request.app["mirrorer"].session
+
+    try:
+        return await proxy_request(
+            client, request, url, {FORWARDED_HEADER: request.app["identifier"]}
+        )
+    except aiohttp.ClientError:
+        logger.exception("Unable to forward upload %s to %s", session_id, owner)
+        raise exceptions.UploadOwnerUnavailable(session=session_id)
+
+
+def _parse_content_range(request):
+    """
+    Returns the (offset, length) of a chunk from its `Content-Range` header.
+
+    Both are None if the client didn't say where the chunk goes.
+    """
+    content_range = request.headers.get("Content-Range", "")
+    if not content_range:
+        return None, None
+
+    if content_range.startswith("bytes "):
+        content_range = content_range[6:]
+
+    try:
+        left, right = content_range.split("-")
+        left, right = int(left), int(right)
+    except ValueError:
+        raise exceptions.BlobUploadInvalid(range=content_range)
+
+    if left < 0 or right < left:
+        raise exceptions.BlobUploadInvalid(range=content_range)
+
+    return left, right - left + 1
+
+
+def _missing_ranges(session):
+    missing = session.missing()
+    if not missing:
+        return {}
+    ranges = ",".join(f"{start}-{end - 1}" for start, end in missing)
+    return {MISSING_RANGES_HEADER: ranges}
+
+
+def _upload_range_not_satisfiable(repository, session):
+    return web.HTTPRequestRangeNotSatisfiable(
+        headers={
+            "Location": f"/v2/{repository}/blobs/uploads/{session.session_id}",
+            "Range": f"0-{session.contiguous}",
+            "Blob-Upload-Session-ID": session.session_id,
+            **_missing_ranges(session),
+        },
+        text="",
+    )
+
+
 @routes.patch("/v2/{repository:[^{}]+}/blobs/uploads/{session_id}")
 async def upload_chunk_by_patch(request):
-    images_directory = request.app["images_directory"]
     repository = request.match_info["repository"]
     session_id = request.match_info["session_id"]
 
     request.app["token_checker"].authenticate(request, repository, ["push"])
 
-    session = request.app["sessions"].get(session_id, None)
-    if not session:
-        raise exceptions.BlobUploadInvalid(session=session_id)
+    if request.app["sessions"].owner(session_id) != request.app["identifier"]:
+        return await _forward_upload(request, session_id)
 
-    uploads = images_directory / "uploads"
-    if not uploads.exists():
-        os.makedirs(uploads)
+    session = await request.app["sessions"].get(session_id)
+    if not session or session.repository != repository:
+        raise exceptions.BlobUploadInvalid(session=session_id)
 
-    upload_path = uploads / session_id
+    offset, length = _parse_content_range(request)
+    if offset is None:
+        offset = session.contiguous
 
-    content_range = request.headers.get("Content-Range", "")
-    if content_range:
-        size = 0
-        if os.path.exists(upload_path):
-            size = os.path.getsize(upload_path)
+    if length is None:
+        length = request.content_length
 
-        content_range = request.headers["Content-Range"]
-        left, right = content_range.split("-")
+    end = math.inf if length is None else offset + length
+    if not session.writable(offset, end):
+        raise _upload_range_not_satisfiable(repository, session)
 
-        if int(left) != size:
-            raise web.HTTPRequestRangeNotSatisfiable(
-                headers={
-                    "Location": f"/v2/{repository}/blobs/uploads/{session_id}",
-                    "Range": f"0-{size}",
-                    "Content-Length": "0",
-                    "Blob-Upload-Session-ID": session_id,
-                }
-            )
+    await session.ingest(request.content, offset, length)
 
-    async with AIOFile(upload_path, "ab") as fp:
-        writer = Writer(fp)
-        chunk = await request.content.read(1024 * 1024)
-        while chunk:
-            await writer(chunk)
-            session["hasher"].update(chunk)
-            session["size"] += len(chunk)
-            chunk = await request.content.read(1024 * 1024)
-        await fp.fsync()
+    session.checkpoint()
 
-    size = os.stat(upload_path).st_size - 1
+    size = session.contiguous - 1
 
     return web.Response(
         status=202,
@@ -515,80 +1012,76 @@ async def upload_chunk_by_patch(request):
             "Location": f"/v2/{repository}/blobs/uploads/{session_id}",
             "Blob-Upload-Session-ID": session_id,
             "Range": f"0-{size}",
+            **_missing_ranges(session),
         },
     )
 
 
 @routes.put("/v2/{repository:[^{}]+}/blobs/uploads/{session_id}")
 async def upload_finish(request):
-    images_directory = request.app["images_directory"]
     repository = request.match_info["repository"]
     session_id = request.match_info["session_id"]
     expected_digest = request.query.get("digest", "")
 
     request.app["token_checker"].authenticate(request, repository, ["push"])
+    request.app["raft"].check_admission()
 
-    session = request.app["sessions"].get(session_id, None)
-    if not session:
-        raise exceptions.BlobUploadInvalid(session=session_id)
+    sessions = request.app["sessions"]
+    if sessions.owner(session_id) != request.app["identifier"]:
+        return await _forward_upload(request, session_id)
 
-    uploads = images_directory / "uploads"
-    if not uploads.exists():
-        os.makedirs(uploads)
+    session = await sessions.get(session_id)
+    if not session or session.repository != repository:
+        raise exceptions.BlobUploadInvalid(session=session_id)
 
-    upload_path = uploads / session_id
+    upload_path = session.path
 
-    async with AIOFile(upload_path, "ab") as fp:
-        writer = Writer(fp)
-        chunk = await request.content.read(1024 * 1024)
-        while chunk:
-            await writer(chunk)
-            session["hasher"].update(chunk)
-            session["size"] += len(chunk)
-            chunk = await request.content.read(1024 * 1024)
-        await fp.fsync()
-
-    hash = session["hasher"].hexdigest()
-    digest = f"sha256:{hash}"
+    # The last chunk goes after everything else that has been received
+    offset, length = _parse_content_range(request)
+    if offset is None:
+        offset = session.end
 
-    if expected_digest != digest:
-        raise exceptions.BlobUploadInvalid()
+    if length is None:
+        length = request.content_length
 
-    blob_path = get_blob_path(images_directory, digest)
-    blob_dir = blob_path.parent
-    if not blob_dir.exists():
-        os.makedirs(blob_dir)
+    end = math.inf if length is None else offset + length
+    if not session.writable(offset, end):
+        raise _upload_range_not_satisfiable(repository, session)
 
-    os.rename(upload_path, blob_path)
+    await session.ingest(request.content, offset, length)
 
-    send_action = request.app["send_action"]
-    identifier = request.app["identifier"]
+    # Chunks still being written might fill a gap or be half written, so the
+    # client has to wait for them before finishing
+    if session.writing or await session.assemble():
+        # Keep the session so the client can send the gaps and try again
+        session.checkpoint()
+        raise _upload_range_not_satisfiable(repository, session)
 
-    success = await send_action(
-        [
-            {
-                "type": RegistryActions.BLOB_MOUNTED,
-                "hash": digest,
-                "repository": repository,
-                "user": request["user"],
-            },
-            {
-                "type": RegistryActions.BLOB_STAT,
-                "hash": digest,
-                "size": session["size"],
-            },
-            {
-                "type": RegistryActions.BLOB_STORED,
-                "hash": digest,
-                "location": identifier,
-                "user": request["user"],
-            },
-        ]
-    )
+    hash = session.hasher.hexdigest()
+    digest = f"sha256:{hash}"
 
-    if not success:
+    if expected_digest != digest:
+        sessions.discard(session_id)
         raise exceptions.BlobUploadInvalid()
 
+    async with sessions.storing(digest):
+        if await sessions.get(session_id) is not session:
+            # Another request finished this session while we waited
+            raise exceptions.BlobUploadInvalid(session=session_id)
+
+        rejected = False
+        try:
+            await _store_blob(request, repository, digest, upload_path, session.size)
+        except exceptions.TooManyRequests:
+            # The upload is back in place, so the client can finish it again
+            # once the journal has caught up
+            rejected = True
+            session.checkpoint()
+            raise
+        finally:
+            if not rejected:
+                sessions.discard(session_id)
+
     return web.Response(
         status=201,
         headers={
@@ -601,17 +1094,19 @@ async def upload_finish(request):
 
 @routes.get("/v2/{repository:[^{}]+}/blobs/uploads/{session_id}")
 async def upload_status(request):
-    images_directory = request.app["images_directory"]
     session_id = request.match_info["session_id"]
     repository = request.match_info["repository"]
 
     request.app["token_checker"].authenticate(request, repository, ["push"])
 
-    upload_path = images_directory / "uploads" / session_id
-    if not upload_path.exists():
+    if request.app["sessions"].owner(session_id) != request.app["identifier"]:
+        return await _forward_upload(request, session_id)
+
+    session = await request.app["sessions"].get(session_id)
+    if not session or session.repository != repository:
         raise exceptions.BlobUploadUnknown()
 
-    size = os.path.getsize(upload_path)
+    size = session.contiguous
 
     return web.Response(
         status=204,
@@ -619,24 +1114,30 @@ async def upload_status(request):
             "Content-Length": "0",
             "Location": f"/v2/{repository}/blobs/uploads/{session_id}",
             "Range": f"0-{size}",
+            **_missing_ranges(session),
         },
     )
 
 
 @routes.delete("/v2/{repository:[^{}]+}/blobs/uploads/{session_id}")
 async def cancel_upload(request):
-    images_directory = request.app["images_directory"]
     repository = request.match_info["repository"]
     session_id = request.match_info["session_id"]
 
     request.app["token_checker"].authenticate(request, repository, ["push"])
 
-    upload_path = images_directory / "uploads" / session_id
-    if not upload_path.exists():
+    sessions = request.app["sessions"]
+    if sessions.owner(session_id) != request.app["identifier"]:
+        return await _forward_upload(request, session_id)
+
+    session = await sessions.get(session_id)
+    if not session or session.repository != repository:
         raise exceptions.BlobUploadUnknown()
 
+    sessions.discard(session_id)
+
     try:
-        upload_path.unlink()
+        session.path.unlink()
     except Exception:
         pass
 
@@ -651,6 +1152,7 @@ async def put_manifest(request):
     tag = request.match_info["tag"]
 
     request.app["token_checker"].authenticate(request, repository, ["push"])
+    request.app["raft"].check_admission()
 
     content_type = request.headers.get("Content-Type", "")
     if not content_type:
@@ -677,10 +1179,14 @@ async def put_manifest(request):
     if not os.path.exists(manifests_dir):
         os.makedirs(manifests_dir)
 
-    async with AIOFile(manifest_path, "wb") as fp:
+    async with open_for_writing(manifest_path, "wb") as fp:
+        # Clients disconnect part way through pushes, which cancels this. Let
+        # the write in flight finish so caio doesn't wedge.
         writer = Writer(fp)
-        await writer(manifest)
-        await fp.fsync()
+        await asyncio.shield(writer(manifest))
+        await asyncio.shield(fp.fsync())
+
+    request.app["manifest_cache"].put(prefixed_hash, manifest)
 
     send_action = request.app["send_action"]
     identifier = request.app["identifier"]
@@ -762,29 +1268,66 @@ async def put_manifest(request):
     )
 
 
-async def run_registry(
+def registry_context(
     raft: Raft,
-    name,
     config,
     identifier,
     registry_state,
     images_directory,
     mirrorer,
     wh_manager,
+    upload_sessions,
+    manifest_cache,
+    tag_watchers,
 ):
+    """The objects that the handlers of a registry listener find on the app."""
     token_checker = TokenChecker(config)
 
-    return await run_server(
+    # Check the disk as well as the registry state when serving local objects
+    verify_local_objects = False
+    if config["verify_local_objects"].exists():
+        verify_local_objects = config["verify_local_objects"].get(bool)
+
+    return {
+        "identifier": identifier,
+        "registry_state": registry_state,
+        "send_action": raft.append,
+        "images_directory": images_directory,
+        "sessions": upload_sessions,
+        "manifest_cache": manifest_cache,
+        "tag_watchers": tag_watchers,
+        "verify_local_objects": verify_local_objects,
+        "token_checker": token_checker,
+        "mirrorer": mirrorer,
+        "wh_manager": wh_manager,
+        "peers": raft.peers,
+    }
+
+
+async def run_registry(
+    raft: Raft,
+    name,
+    config,
+    identifier,
+    registry_state,
+    images_directory,
+    mirrorer,
+    wh_manager,
+    upload_sessions,
+    manifest_cache,
+    tag_watchers,
+):
+    context = registry_context(
         raft,
-        f"registry.{name}",
         config,
-        routes,
-        identifier=identifier,
-        registry_state=registry_state,
-        send_action=raft.append,
-        images_directory=images_directory,
-        sessions={},
-        token_checker=token_checker,
-        mirrorer=mirrorer,
-        wh_manager=wh_manager,
+        identifier,
+        registry_state,
+        images_directory,
+        mirrorer,
+        wh_manager,
+        upload_sessions,
+        manifest_cache,
+        tag_watchers,
     )
+
+    return await run_server(raft, f"registry.{name}", config, routes, **context)
@@ -1,10 +1,51 @@
 import asyncio
+import enum
 import logging
+import random
+import time
+
+from yarl import URL
 
 from .machine import Machine, Message, Msg
+from .utils.web import peer_url
 
 logger = logging.getLogger(__name__)
 
+# Gossip rounds start this often, and back off to the maximum while they are
+# not teaching anyone anything new
+GOSSIP_INTERVAL_MIN = 0.1
+GOSSIP_INTERVAL_MAX = 5.0
+
+# How long a peer can be suspected before it is considered dead
+SUSPICION_TIMEOUT = 5.0
+
+# How often a dead peer is probed to see if it has come back
+DEAD_PROBE_INTERVAL = 1.0
+
+# Every change to what we announce bumps our generation, and after a restart it
+# has to start above anything we announced before. So each session gets a block
+# of generations this big.
+GENERATIONS_PER_SESSION = 2 ** 32
+
+# Announced to peers that can exchange a digest of generations rather than the
+# full gossip map. Older nodes would take the "digest" key for a node name.
+CAPABILITY_DIGEST = "digest"
+
+
+class Liveness(enum.IntEnum):
+
+    ALIVE = 1
+    SUSPECT = 2
+    DEAD = 3
+
+
+class PeerHealth:
+    def __init__(self):
+        self.state = Liveness.ALIVE
+        self.last_seen = None
+        self.suspected_at = None
+        self.last_failure = None
+
 
 class Seeder:
     def __init__(self, config, session, spread):
@@ -12,10 +53,15 @@ class Seeder:
         self.spread = spread
         self.identifier = config["node"]["identifier"].get(str)
 
-        self.current_state = {"generation": session}
+        self.current_state = {
+            "generation": session * GENERATIONS_PER_SESSION,
+            "capabilities": [CAPABILITY_DIGEST],
+        }
         self.peers = {}
+        self.health = {}
 
         self.is_gossiping = False
+        self.interval = GOSSIP_INTERVAL_MIN
 
         self._task = None
 
@@ -28,20 +74,126 @@ class Seeder:
             except asyncio.CancelledError:
                 pass
 
+    @property
+    def digest(self):
+        """A map of node to the generation of the rumour we hold about it."""
+        digest = {node: rumour["generation"] for node, rumour in self.peers.items()}
+        if self.current_state_valid():
+            digest[self.identifier] = self.current_state["generation"]
+        return digest
+
+    def rumour_for(self, node):
+        if node == self.identifier:
+            return self.current_state
+        return self.peers[node]
+
+    def _url_for_rumour(self, rumour):
+        raft = rumour.get("raft", {})
+        if "address" not in raft or "port" not in raft:
+            return None
+        return peer_url(raft)
+
+    def understands_digest(self, node):
+        """Whether `node` has told us it can exchange digests."""
+        if node not in self.peers:
+            return False
+        return CAPABILITY_DIGEST in self.peers[node].get("capabilities", ())
+
     @property
     def current_gossip(self):
-        gossip = {self.identifier: self.current_state}
-        gossip.update(self.peers)
+        gossip = dict(self.peers)
+        if self.current_state_valid():
+            gossip[self.identifier] = self.current_state
         return gossip
 
+    def gossip_targets(self):
+        """
+        Returns a map of url to node for everywhere we could gossip with.
+
+        The node is None for a seed url that isn't a known peer. We never gossip
+        with ourselves, and dead peers are only included when they are due a probe.
+        """
+        own_url = self._url_for_rumour(self.current_state)
+
+        targets = {}
+        for url in self.config["seeding"]["urls"].get(list):
+            targets[str(URL(url))] = None
+
+        for node, rumour in self.peers.items():
+            url = self._url_for_rumour(rumour)
+            if url:
+                targets[url] = node
+
+        for url, node in list(targets.items()):
+            if url == own_url:
+                del targets[url]
+            elif node and not self.should_contact(node):
+                del targets[url]
+
+        return targets
+
+    async def gossip_round(self):
+        """
+        Exchange rumours with a single peer.
+
+        If the peer can exchange digests then we only send a digest of
+        generations. The peer replies with any rumours that are newer than ours,
+        plus a list of rumours it wants from us. Anyone else, including a seed we
+        don't know yet, is sent the full gossip map and replies with its own.
+        Returns True if either side learned something.
+        """
+        targets = self.gossip_targets()
+        if not targets:
+            return False
+
+        url = random.choice(list(targets))
+        node = targets[url]
+
+        digest = self.understands_digest(node)
+        if digest:
+            reply = await self.spread(url, {"digest": self.digest})
+        else:
+            reply = await self.spread(url, self.current_gossip)
+
+        if reply is None:
+            if node:
+                self.mark_failed(node)
+            return False
+
+        if node:
+            self.mark_alive(node)
+
+        if not digest:
+            # We can't tell what the peer learned from our map, but it had never
+            # heard from us if it was a seed we didn't know yet
+            before = self.digest
+            self.update_from_gossip(reply)
+            return node is None or self.digest != before
+
+        before = self.digest
+        self.update_from_gossip(reply.get("rumours", {}))
+        learned = self.digest != before
+
+        wanted = [
+            node
+            for node in reply.get("wanted", [])
+            if node == self.identifier or node in self.peers
+        ]
+        if wanted:
+            rumours = {node: self.rumour_for(node) for node in wanted}
+            await self.spread(url, {"rumours": rumours})
+            learned = True
+
+        return learned
+
     async def _gossip(self):
         while True:
-            resp = await self.spread(self.current_gossip)
-            # We use a boot-count aware merge function in
-            # case we have got tastier gossip in the meantime
-            self.update_from_gossip(resp)
+            if await self.gossip_round():
+                self.interval = GOSSIP_INTERVAL_MIN
+            else:
+                self.interval = min(self.interval * 2, GOSSIP_INTERVAL_MAX)
 
-            await asyncio.sleep(0.1)
+            await asyncio.sleep(self.interval)
 
     def start_gossiping(self):
         self._task = asyncio.ensure_future(self._gossip())
@@ -85,7 +237,10 @@ class Seeder:
                 continue
 
             if rumour["generation"] > self.peers[node]["generation"]:
+                # A newer generation means the node has restarted, which
+                # refutes any suspicion we had about it
                 self.peers[node] = rumour
+                self.mark_alive(node)
                 continue
 
             stale.add(node)
@@ -107,6 +262,85 @@ class Seeder:
 
         return response
 
+    def exchange_digest(self, payload):
+        """
+        Respond to a digest-driven gossip exchange.
+
+        Merges any rumours we have been pushed, and if we were sent a digest then
+        replies with the rumours that are newer than the sender's and the list of
+        nodes where the sender has better gossip than us.
+        """
+        self.update_from_gossip(payload.get("rumours", {}))
+
+        if "digest" not in payload:
+            return {}
+
+        theirs = payload["digest"]
+        ours = self.digest
+
+        rumours = {}
+        for node, generation in ours.items():
+            if node not in theirs or theirs[node] < generation:
+                rumours[node] = self.rumour_for(node)
+
+        wanted = []
+        for node, generation in theirs.items():
+            if node == self.identifier:
+                continue
+            if node not in ours or ours[node] < generation:
+                wanted.append(node)
+
+        return {"rumours": rumours, "wanted": wanted}
+
+    def _health(self, node):
+        if node not in self.health:
+            self.health[node] = PeerHealth()
+        return self.health[node]
+
+    def liveness(self, node):
+        if node not in self.health:
+            return Liveness.ALIVE
+        return self.health[node].state
+
+    def mark_alive(self, node):
+        health = self._health(node)
+        health.state = Liveness.ALIVE
+        health.last_seen = time.monotonic()
+        health.suspected_at = None
+
+    def mark_failed(self, node):
+        """
+        Record that we failed to talk to a node.
+
+        A failure makes a live node suspect. A node that stays suspect for longer
+        than SUSPICION_TIMEOUT is considered dead until we hear from it again.
+        """
+        health = self._health(node)
+        now = time.monotonic()
+        health.last_failure = now
+
+        if health.state == Liveness.ALIVE:
+            logger.debug("Peer %s is now suspect", node)
+            health.state = Liveness.SUSPECT
+            health.suspected_at = now
+
+        elif health.state == Liveness.SUSPECT:
+            if now - health.suspected_at >= SUSPICION_TIMEOUT:
+                logger.warning("Peer %s is now considered dead", node)
+                health.state = Liveness.DEAD
+
+    def should_contact(self, node):
+        health = self.health.get(node)
+        if not health or health.state != Liveness.DEAD:
+            return True
+        return time.monotonic() - health.last_failure >= DEAD_PROBE_INTERVAL
+
+    def rank_peers(self, nodes):
+        """Order nodes so that the ones most likely to respond come first."""
+        nodes = list(nodes)
+        random.shuffle(nodes)
+        return sorted(nodes, key=self.liveness)
+
     def all_peers_known(self):
         for node in self.config["peers"].get(list):
             if node not in self.peers:
@@ -133,6 +367,12 @@ class Seeder:
         return False
 
     def process_state_change(self, discovery_info):
+        # We have something new to tell people
+        self.interval = GOSSIP_INTERVAL_MIN
+
+        # A new generation is what tells peers that our rumour has changed
+        self.current_state["generation"] += 1
+
         if "raft" in discovery_info:
             raft = self.current_state.setdefault("raft", {})
             raft.update(discovery_info["raft"])
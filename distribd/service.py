@@ -7,6 +7,7 @@ import coloredlogs
 import confuse
 import verboselogs
 
+from .cache import ManifestCache
 from .garbage import GarbageCollector
 from .machine import Machine
 from .mirror import Mirrorer
@@ -16,7 +17,10 @@ from .reducers import Reducers
 from .registry import run_registry
 from .state import RegistryState
 from .storage import Storage
+from .uploads import UploadSessions
+from .watch import TagWatchers
 from .webhook import WebhookManager
+from .worker import run_registry_workers
 
 logger = logging.getLogger(__name__)
 
@@ -59,13 +63,26 @@ async def main(argv=None, config=None):
         if identifier != other_identifier:
             machine.add_peer(other_identifier)
 
+    for setting in (
+        "election_timeout_min",
+        "election_timeout_max",
+        "heartbeat_interval_min",
+        "heartbeat_interval_max",
+    ):
+        if config["raft"][setting].exists():
+            setattr(machine, setting, config["raft"][setting].as_number())
+
     machine.start()
 
     registry_state = RegistryState()
-    reducers = Reducers(machine, registry_state)
+    reducers = Reducers(machine, registry_state, images_directory / "cursors")
 
     raft = HttpRaft(config, machine, storage, reducers)
 
+    manifest_cache = ManifestCache()
+    if config["manifest_cache"]["max_bytes"].exists():
+        manifest_cache.max_bytes = config["manifest_cache"]["max_bytes"].get(int)
+
     mirrorer = Mirrorer(
         config,
         raft.peers,
@@ -73,27 +90,51 @@ async def main(argv=None, config=None):
         machine.identifier,
         registry_state,
         raft.append,
+        manifest_cache,
     )
 
     garbage_collector = GarbageCollector(
-        images_directory, machine.identifier, registry_state, raft.append,
+        images_directory,
+        machine.identifier,
+        registry_state,
+        raft.append,
+        manifest_cache,
     )
 
     wh_manager = WebhookManager(config)
 
-    reducers.add_side_effects(mirrorer.dispatch_entries)
-    reducers.add_side_effects(garbage_collector.dispatch_entries)
+    upload_sessions = UploadSessions(images_directory, machine.identifier)
+    for setting in ("ingest_chunk_size", "ingest_buffers"):
+        if config["uploads"][setting].exists():
+            setattr(upload_sessions, setting, config["uploads"][setting].get(int))
+
+    tag_watchers = TagWatchers()
+    reducers.add_listener(tag_watchers.dispatch_entries)
+
+    reducers.add_side_effects("mirror", mirrorer.dispatch_entries)
+    reducers.add_side_effects("garbage", garbage_collector.dispatch_entries)
 
     services = [
         raft.run_forever(),
         run_prometheus(
-            raft, config, machine.identifier, registry_state, images_directory,
+            raft,
+            config,
+            machine.identifier,
+            registry_state,
+            images_directory,
+            upload_sessions,
         ),
+        upload_sessions.run_forever(),
     ]
 
     for listener in config["registry"]:
+        run = run_registry
+        workers = config["registry"][listener]["workers"]
+        if workers.exists() and workers.get(int) > 0:
+            run = run_registry_workers
+
         services.append(
-            run_registry(
+            run(
                 raft,
                 listener,
                 config["registry"][listener],
@@ -102,6 +143,9 @@ async def main(argv=None, config=None):
                 images_directory,
                 mirrorer,
                 wh_manager,
+                upload_sessions,
+                manifest_cache,
+                tag_watchers,
             )
         )
 
@@ -112,6 +156,11 @@ async def main(argv=None, config=None):
         pass
 
     finally:
+        await reducers.close()
         await asyncio.gather(
-            raft.close(), storage.close(), mirrorer.close(), wh_manager.close()
+            raft.close(),
+            storage.close(),
+            mirrorer.close(),
+            garbage_collector.close(),
+            wh_manager.close(),
         )
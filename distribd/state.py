@@ -1,6 +1,9 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+import copy
+import functools
 import logging
-
-from networkx import DiGraph, subgraph_view
+import weakref
 
 from .actions import RegistryActions
 
@@ -21,189 +24,1000 @@ TYPE_MANIFEST = "manifest"
 TYPE_BLOB = "blob"
 TYPE_TAG = "tag"
 
+# Containers in RegistryState that are shared with views until they are written to
+SHARED_CONTAINERS = (
+    "_tags",
+    "_sorted_tags",
+    "_orphans",
+    "_repository_refs",
+    "_catalog",
+    "_repository_bytes",
+    "_location_bytes",
+    "_live",
+    "_missing",
+)
+
+# Containers with an item for every object. These are too big to copy when a view
+# is taken, so views read them through a Snapshot instead.
+SNAPSHOT_CONTAINERS = ("_records", "_ids")
+
+# Record ids are split into pages of this many, so that copying a PagedSet only
+# copies the pages that are written to
+PAGE_BITS = 10
+
+# Saved in an UndoLog for a key that didn't exist
+MISSING = object()
+
+
+@functools.lru_cache(maxsize=1024)
+def location_ids(locations):
+    """Returns the ids of the locations in a bitmask, lowest first."""
+    ids = []
+    id = 0
+    while locations:
+        if locations & 1:
+            ids.append(id)
+        locations >>= 1
+        id += 1
+    return tuple(ids)
+
+
+class PagedSet:
+    """
+    A set of record ids that copies share until they write to it.
+
+    Copying only copies the page table. After a copy neither side owns any pages,
+    so whichever writes to a page first copies it.
+    """
+
+    __slots__ = ("_pages", "_owned", "_len")
+
+    def __init__(self):
+        self._pages = {}
+        self._owned = set()
+        self._len = 0
+
+    def __copy__(self):
+        other = PagedSet()
+        other._pages = dict(self._pages)
+        other._len = self._len
+        self._owned = set()
+        return other
+
+    def _page(self, number):
+        page = self._pages.get(number)
+        if page is None:
+            page = self._pages[number] = set()
+            self._owned.add(number)
+        elif number not in self._owned:
+            page = self._pages[number] = set(page)
+            self._owned.add(number)
+        return page
+
+    def __contains__(self, id):
+        page = self._pages.get(id >> PAGE_BITS)
+        return page is not None and id in page
+
+    def __iter__(self):
+        for page in self._pages.values():
+            yield from page
+
+    def __len__(self):
+        return self._len
+
+    def add(self, id):
+        if id not in self:
+            self._page(id >> PAGE_BITS).add(id)
+            self._len += 1
+
+    def discard(self, id):
+        if id in self:
+            self._page(id >> PAGE_BITS).discard(id)
+            self._len -= 1
+
+
+class UndoLog:
+    """
+    The values that SNAPSHOT_CONTAINERS had before they were changed.
+
+    Each view has a log, which is written to until the next view is taken, and
+    `next` links it to that view's log. Only the first change to a key is saved.
+    """
+
+    __slots__ = ("_records", "_ids", "next", "__weakref__")
+
+    def __init__(self):
+        self._records = {}
+        self._ids = {}
+        self.next = None
+
+
+class Snapshot:
+    """
+    A read-only copy of one of SNAPSHOT_CONTAINERS, as it was when a view was taken.
+
+    The live container is read first and then replaced with the oldest value saved
+    since the view was taken, if there is one. The state saves a value before it
+    changes the container, so this is safe to read while entries are applied in
+    another thread.
+    """
+
+    __slots__ = ("_live", "_log", "_name")
+
+    def __init__(self, live, log, name):
+        self._live = live
+        self._log = log
+        self._name = name
+
+    def __getitem__(self, key):
+        try:
+            value = self._live[key]
+        except (IndexError, KeyError):
+            value = MISSING
+
+        log = self._log
+        while log is not None:
+            changes = getattr(log, self._name)
+            if key in changes:
+                value = changes[key]
+                break
+            log = log.next
+
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class Interner:
+    """Maps strings that are repeated many times in the index to small ints."""
+
+    __slots__ = ("_ids", "_names")
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+
+    def intern(self, name):
+        id = self._ids.get(name)
+        if id is None:
+            id = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return id
+
+    def lookup(self, name):
+        return self._ids.get(name)
+
+    def __getitem__(self, id):
+        return self._names[id]
+
+    def __len__(self):
+        return len(self._names)
+
+    def names(self, ids):
+        return {self._names[id] for id in ids}
+
+    def copy(self):
+        interner = Interner()
+        interner._ids = dict(self._ids)
+        interner._names = list(self._names)
+        return interner
+
+
+class Record:
+    """
+    A blob or manifest in the registry index.
+
+    Records that have a `type` of None are placeholders. Those are digests that
+    something depends on or that a tag points at, but that haven't been pushed
+    (or have been deleted) yet.
+
+    Repositories are a sorted tuple of interned ids. Locations are a bitmask of
+    interned ids. Dependencies and referrers are arrays of record ids, or None
+    if the record has none. Tags are a tuple of (repository id, tag) pairs that
+    point at the record.
+
+    `orphan` and `live` say whether the record is in the state's orphan and live
+    sets, so that those don't have to be searched every time a record changes.
+
+    A record is never changed once a view can see it. `epoch` is the view
+    generation the record was created in, and a record from an earlier one is
+    copied before it is written to.
+    """
+
+    __slots__ = (
+        "digest",
+        "type",
+        "repositories",
+        "locations",
+        "content_type",
+        "size",
+        "dependencies",
+        "referrers",
+        "tags",
+        "orphan",
+        "live",
+        "epoch",
+    )
+
+    def __init__(self, digest, epoch=0):
+        self.digest = digest
+        self.type = None
+        self.repositories = ()
+        self.locations = 0
+        self.content_type = None
+        self.size = None
+        self.dependencies = None
+        self.referrers = None
+        self.tags = ()
+        self.orphan = False
+        self.live = False
+        self.epoch = epoch
+
+    def copy(self, epoch):
+        record = copy.copy(self)
+        if self.dependencies is not None:
+            record.dependencies = array("q", self.dependencies)
+        if self.referrers is not None:
+            record.referrers = array("q", self.referrers)
+        record.epoch = epoch
+        return record
+
+    @property
+    def orphaned(self):
+        return self.type is not None and not self.referrers and not self.tags
+
+    @property
+    def unused(self):
+        return (
+            self.type is None
+            and not self.referrers
+            and not self.tags
+            and self.locations == 0
+        )
+
 
 class Reducer:
     def __init__(self, log):
         self.log = log
 
-    def dispatch_entries(self, entries):
+    def dispatch_entries(self, entries, index=None):
         for term, entry in entries:
             if "type" in entry:
                 self.dispatch(entry)
 
+        if index is not None:
+            self.applied_index = index
+
 
 class RegistryState(Reducer):
     def __init__(self):
-        self.graph = DiGraph()
+        # The raft index of the last entry that was applied
+        self.applied_index = 0
 
-    def __getitem__(self, key):
-        return self.graph.nodes[key]
+        # Record id -> Record. Slots of deleted records are reused.
+        self._records = []
+        self._free = []
+
+        # Digest -> record id
+        self._ids = {}
+
+        self.repositories = Interner()
+        self.locations = Interner()
+
+        # Repository id -> {tag: record id}
+        self._tags = {}
+
+        # Repository id -> sorted list of tags
+        self._sorted_tags = {}
+
+        # Ids of records that are candidates for garbage collection
+        self._orphans = PagedSet()
+
+        # Repository id -> number of objects and tags in it
+        self._repository_refs = {}
+
+        # Sorted names of repositories that have anything in them
+        self._catalog = []
+
+        # Bytes of every object in each repository, counting shared objects once per
+        # repository, and bytes of every object in the cluster, counting them once
+        self._repository_bytes = {}
+        self._physical_bytes = 0
+
+        # Location id -> bytes of objects stored there
+        self._location_bytes = {}
+
+        # Ids of objects that are in a repository and stored somewhere, so should be
+        # replicated everywhere
+        self._live = PagedSet()
+
+        # Location id -> ids of live objects that aren't stored there yet
+        self._missing = {}
+
+        # Bumped every time a view is taken
+        self._epoch = 0
+
+        # Names of containers that the current view shares with us
+        self._shared = set()
+
+        # (container, key) of nested containers copied since the last view
+        self._owned = set()
+
+        # Weak reference to the UndoLog of the newest view, if one could be alive
+        self._undo = None
+
+        self._view = None
+
+    def view(self):
+        """
+        Returns a read-only view of the state as it is now.
+
+        Taking a view is O(1). Nothing is copied until the state next changes, and
+        then only the records, pages and small containers that are written to. The
+        values that records and digests had are saved for the view as they change.
+        This means a view can be read from another thread while more entries are
+        applied.
+        """
+        # Entries that don't change anything still move the index on
+        if self._view is None or self._view.applied_index != self.applied_index:
+            log = UndoLog()
+            previous = self._undo() if self._undo else None
+            if previous is not None:
+                previous.next = log
+            self._undo = weakref.ref(log)
+
+            self._view = RegistryView(self, log)
+            self._epoch += 1
+            self._shared = set(SHARED_CONTAINERS)
+            self._owned = set()
+        return self._view
+
+    def _save(self, name, key):
+        """Saves `name[key]` for any views that are still alive, before it changes."""
+        log = self._undo() if self._undo else None
+        if log is None:
+            # Every view has gone, along with their logs
+            self._undo = None
+            return
+
+        changes = getattr(log, name)
+        if key not in changes:
+            try:
+                changes[key] = getattr(self, name)[key]
+            except (IndexError, KeyError):
+                changes[key] = MISSING
+
+    def _own(self, name):
+        """Returns container `name`, copying it first if a view shares it."""
+        container = getattr(self, name)
+        if name in self._shared:
+            container = copy.copy(container)
+            setattr(self, name, container)
+            self._shared.discard(name)
+        return container
+
+    def _own_item(self, name, key, factory):
+        """Returns container `name[key]`, copying it first if a view shares it."""
+        container = self._own(name)
+        if (name, key) not in self._owned:
+            container[key] = factory(container.get(key, ()))
+            self._owned.add((name, key))
+        return container[key]
+
+    def _own_missing(self, location_id):
+        return self._own_item("_missing", location_id, copy.copy)
+
+    def _own_tags(self, repository_id):
+        return (
+            self._own_item("_tags", repository_id, dict),
+            self._own_item("_sorted_tags", repository_id, list),
+        )
+
+    def _writable(self, id):
+        record = self._records[id]
+        if record.epoch != self._epoch:
+            record = record.copy(self._epoch)
+            self._save("_records", id)
+            self._records[id] = record
+        return record
+
+    def _get(self, digest):
+        id = self._ids.get(digest)
+        if id is None:
+            return None
+        return self._records[id]
+
+    def _lookup(self, digest):
+        record = self._get(digest)
+        if record is None or record.type is None:
+            return None
+        return record
+
+    def _ensure(self, digest):
+        """Returns the id of a writable record for `digest`, creating a placeholder if needed."""
+        id = self._ids.get(digest)
+        if id is not None:
+            return id, self._writable(id)
+
+        record = Record(digest, self._epoch)
+        id = self._free.pop() if self._free else len(self._records)
+        self._save("_records", id)
+        if id < len(self._records):
+            self._records[id] = record
+        else:
+            self._records.append(record)
+
+        self._save("_ids", digest)
+        self._ids[digest] = id
+
+        return id, record
+
+    def _update_orphan(self, id, record):
+        orphan = record.orphaned
+        if orphan != record.orphan:
+            record.orphan = orphan
+            if orphan:
+                self._own("_orphans").add(id)
+            else:
+                self._own("_orphans").discard(id)
+
+    def _drop_if_unused(self, id):
+        if self._records[id] is None:
+            return
+
+        record = self._writable(id)
+        self._update_orphan(id, record)
+        if not record.unused:
+            return
+
+        self._clear_dependencies(id, record)
+
+        # A cycle in the dependencies could have dropped us already
+        if self._records[id] is None:
+            return
+
+        self._save("_ids", record.digest)
+        del self._ids[record.digest]
+        self._save("_records", id)
+        self._records[id] = None
+        self._free.append(id)
+
+    def _add_dependency(self, id, record, digest):
+        dependency_id, dependency = self._ensure(digest)
+
+        # The dependency might be the record itself
+        record = self._records[id]
+
+        if record.dependencies is None:
+            record.dependencies = array("q")
+        elif dependency_id in record.dependencies:
+            return
+        record.dependencies.append(dependency_id)
+
+        if dependency.referrers is None:
+            dependency.referrers = array("q")
+        dependency.referrers.append(id)
+        self._update_orphan(dependency_id, dependency)
+
+    def _clear_dependencies(self, id, record):
+        dependencies, record.dependencies = record.dependencies, None
+        if not dependencies:
+            return
+
+        for dependency_id in dependencies:
+            dependency = self._writable(dependency_id)
+            dependency.referrers.remove(id)
+            if not dependency.referrers:
+                dependency.referrers = None
+            self._drop_if_unused(dependency_id)
+
+    def _remove(self, id, record, locations):
+        """
+        Forget an object that was stored in `locations`.
+
+        Its outgoing edges go with it, but if anything still refers to it then it is
+        kept as a placeholder so that those edges survive it being pushed again.
+        """
+        self._account(record, -(record.size or 0))
+
+        record.type = None
+        for repository_id in record.repositories:
+            self._unref_repository(repository_id)
+        record.repositories = ()
+        record.locations = 0
+        record.content_type = None
+        record.size = None
+        self._update_live(id, record, locations)
+        self._clear_dependencies(id, record)
+        self._drop_if_unused(id)
+
+    def _location_names(self, locations):
+        return self.locations.names(location_ids(locations))
+
+    def _add_count(self, container, key, delta):
+        if not delta:
+            return
+        counts = self._own(container)
+        total = counts.get(key, 0) + delta
+        if total:
+            counts[key] = total
+        else:
+            del counts[key]
+
+    def _account(self, record, delta):
+        """Add `delta` bytes everywhere `record` is counted."""
+        if not delta:
+            return
+
+        if record.type is not None:
+            self._physical_bytes += delta
+
+        for repository_id in record.repositories:
+            self._add_count("_repository_bytes", repository_id, delta)
+
+        for location_id in location_ids(record.locations):
+            self._add_count("_location_bytes", location_id, delta)
+
+    def _update_live(self, id, record, locations):
+        """
+        Keep the live set and the missing objects of every location up to date after
+        a change to `record`, which was stored in `locations` before it.
+        """
+        was_live = record.live
+        live = (
+            record.type is not None
+            and bool(record.repositories)
+            and record.locations != 0
+        )
+        record.live = live
+
+        if was_live and live:
+            if locations == record.locations:
+                return
+            # Only the locations that changed need updating
+            for location_id in location_ids(record.locations & ~locations):
+                self._own_missing(location_id).discard(id)
+            for location_id in location_ids(locations & ~record.locations):
+                self._own_missing(location_id).add(id)
+            return
+
+        if was_live:
+            self._own("_live").discard(id)
+        elif live:
+            self._own("_live").add(id)
+        else:
+            return
+
+        for location_id in range(len(self.locations)):
+            if was_live and not locations & (1 << location_id):
+                self._own_missing(location_id).discard(id)
+            elif live and not record.locations & (1 << location_id):
+                self._own_missing(location_id).add(id)
+
+    def get_missing_objects(self, location):
+        """
+        Returns every object that should be replicated to `location` but isn't yet.
+
+        This is maintained as entries are applied, so it's cheap enough to compute a
+        node's whole replication backlog on demand.
+        """
+        location_id = self.locations.lookup(location)
+        missing = self._missing.get(location_id, self._live)
+        return {self._records[id].digest for id in missing}
+
+    def get_replication_backlog(self):
+        """Returns the number of objects each known location is missing."""
+        return {
+            self.locations[location_id]: len(missing)
+            for location_id, missing in self._missing.items()
+        }
+
+    def get_repository_size(self, repository):
+        """Returns the bytes of every object in `repository`."""
+        repository_id = self.repositories.lookup(repository)
+        return self._repository_bytes.get(repository_id, 0)
+
+    def get_storage_usage(self):
+        """
+        Returns how much is stored, maintained as entries are applied.
+
+        `logical` counts an object once for every repository it is in, `physical`
+        counts it once. `locations` is the bytes stored on each node.
+        """
+        return {
+            "logical": sum(self._repository_bytes.values()),
+            "physical": self._physical_bytes,
+            "repositories": {
+                name: self.get_repository_size(name) for name in self._catalog
+            },
+            "locations": {
+                self.locations[id]: size for id, size in self._location_bytes.items()
+            },
+        }
+
+    def __contains__(self, digest):
+        return self._lookup(digest) is not None
+
+    def __getitem__(self, digest):
+        record = self._lookup(digest)
+        if record is None:
+            raise KeyError(digest)
+
+        node = {
+            ATTR_TYPE: record.type,
+            ATTR_REPOSITORIES: self.repositories.names(record.repositories),
+            ATTR_LOCATIONS: self._location_names(record.locations),
+            ATTR_DEPENDENCIES: [
+                self._records[id].digest for id in record.dependencies or ()
+            ],
+        }
+        if record.content_type is not None:
+            node[ATTR_CONTENT_TYPE] = record.content_type
+        if record.size is not None:
+            node[ATTR_SIZE] = record.size
+
+        return node
+
+    def _in_repository(self, record, repository):
+        repository_id = self.repositories.lookup(repository)
+        return repository_id is not None and repository_id in record.repositories
 
     def is_blob_available(self, repository, hash):
-        if hash not in self.graph.nodes:
+        blob = self._lookup(hash)
+        if blob is None:
             return False
 
-        blob = self.graph.nodes[hash]
-
-        if blob[ATTR_TYPE] != TYPE_BLOB:
+        if blob.type != TYPE_BLOB:
             return False
 
-        if repository not in self.graph.nodes[hash][ATTR_REPOSITORIES]:
+        if not self._in_repository(blob, repository):
             return False
 
         return True
 
     def is_manifest_available(self, repository, hash):
-        if hash not in self.graph.nodes:
+        manifest = self._lookup(hash)
+        if manifest is None:
             return False
 
-        manifest = self.graph.nodes[hash]
-
-        if manifest[ATTR_TYPE] != TYPE_MANIFEST:
+        if manifest.type != TYPE_MANIFEST:
             return False
 
-        if ATTR_CONTENT_TYPE not in manifest:
+        if manifest.content_type is None:
             return False
 
-        if repository not in self.graph.nodes[hash][ATTR_REPOSITORIES]:
+        if not self._in_repository(manifest, repository):
             return False
 
         return True
 
+    def is_stored(self, hash, location):
+        """Returns True if `location` has recorded that it holds a copy of an object."""
+        record = self._lookup(hash)
+        if record is None:
+            return False
+
+        location_id = self.locations.lookup(location)
+        if location_id is None:
+            return False
+
+        return bool(record.locations & (1 << location_id))
+
+    def get_size(self, hash):
+        """Returns the size of an object, or None if it hasn't been recorded."""
+        record = self._lookup(hash)
+        if record is None:
+            return None
+        return record.size
+
+    def get_dependencies(self, hash):
+        """Returns the digests that an object depends on."""
+        record = self._get(hash)
+        if record is None:
+            raise KeyError(hash)
+        return {self._records[id].digest for id in record.dependencies or ()}
+
+    def get_referrers(self, hash):
+        """Returns the digests of the objects that directly depend on an object."""
+        record = self._get(hash)
+        if record is None:
+            raise KeyError(hash)
+        return {self._records[id].digest for id in record.referrers or ()}
+
+    def get_users(self, hash):
+        """
+        Returns every object that uses an object, directly or through others.
+
+        Each one is listed with the repositories it is in and the tags that point at
+        it. The referrers index is walked upwards, so the cost is proportional to the
+        number of objects returned rather than the size of the registry.
+        """
+        record = self._get(hash)
+        if record is None:
+            raise KeyError(hash)
+
+        users = []
+        seen = set()
+        pending = list(record.referrers or ())
+
+        while pending:
+            id = pending.pop()
+            if id in seen:
+                continue
+            seen.add(id)
+
+            user = self._records[id]
+            pending.extend(user.referrers or ())
+
+            if user.type is None:
+                continue
+
+            users.append(
+                {
+                    "digest": user.digest,
+                    "repositories": sorted(self.repositories.names(user.repositories)),
+                    "tags": [
+                        {"repository": self.repositories[repository_id], "tag": tag}
+                        for repository_id, tag in sorted(user.tags)
+                    ],
+                }
+            )
+
+        users.sort(key=lambda user: user["digest"])
+
+        return users
+
     def get_orphaned_objects(self):
         """
-        Returns all nodes that have no incoming edges and are not a tag.
+        Returns all objects that aren't tagged and that nothing depends on.
 
         These nodes should be deleted by a mirror, and when this has
         happened they should report that with a BLOB_UNMOUNTED or MANIFEST_UNMOUNTED.
+
+        The set is maintained as entries are applied, so this doesn't scan the index.
         """
-        orphaned = set()
-        for v in self.graph:
-            if self.graph.nodes[v][ATTR_TYPE] == TYPE_TAG:
-                continue
-            if len(self.graph.in_edges(v)) == 0:
-                orphaned.add(v)
-        return orphaned
+        return {self._records[id].digest for id in self._orphans}
 
     def get_tags(self, repository):
-        def _filter(node):
-            n = self.graph.nodes[node]
-            if n[ATTR_TYPE] != TYPE_TAG:
-                return False
-            if n[ATTR_REPOSITORY] != repository:
-                return False
-            return True
-
-        tags = subgraph_view(self.graph, _filter)
-        resolved_tags = [tags.nodes[tag][ATTR_TAG] for tag in tags.nodes]
-        if len(resolved_tags) == 0:
+        return list(self._get_sorted_tags(repository))
+
+    def _get_sorted_tags(self, repository):
+        repository_id = self.repositories.lookup(repository)
+        tags = self._sorted_tags.get(repository_id)
+        if not tags:
             raise KeyError()
-        return resolved_tags
+        return tags
+
+    def _page(self, items, last, n):
+        start = bisect_right(items, last) if last else 0
+        if n is None:
+            return items[start:], False
+
+        end = start + n
+        return items[start:end], end < len(items)
+
+    def get_tags_page(self, repository, last=None, n=None):
+        """
+        Returns up to `n` tags that sort after `last`, and whether there are more.
+
+        Raises KeyError if the repository has no tags.
+        """
+        return self._page(self._get_sorted_tags(repository), last, n)
+
+    def get_catalog_page(self, last=None, n=None):
+        """Returns up to `n` repositories that sort after `last`, and whether there are more."""
+        return self._page(self._catalog, last, n)
+
+    def _ref_repository(self, repository_id):
+        repository_refs = self._own("_repository_refs")
+        refs = repository_refs.get(repository_id, 0)
+        if refs == 0:
+            insort(self._own("_catalog"), self.repositories[repository_id])
+        repository_refs[repository_id] = refs + 1
+
+    def _unref_repository(self, repository_id):
+        repository_refs = self._own("_repository_refs")
+        refs = repository_refs[repository_id] - 1
+        if refs == 0:
+            name = self.repositories[repository_id]
+            catalog = self._own("_catalog")
+            del catalog[bisect_left(catalog, name)]
+            del repository_refs[repository_id]
+        else:
+            repository_refs[repository_id] = refs
 
     def get_tag(self, repository, tag):
-        key = f"tag:{repository}:{tag}"
-        if key not in self.graph:
+        repository_id = self.repositories.lookup(repository)
+        tags = self._tags.get(repository_id, {})
+        if tag not in tags:
             raise KeyError()
-        return next(self.graph.neighbors(key))
+        return self._records[tags[tag]].digest
 
-    def dispatch(self, entry):
-        logger.critical("Applying %s", entry)
+    def _untag(self, repository_id, tag):
+        tags, sorted_tags = self._own_tags(repository_id)
 
-        if entry["type"] == RegistryActions.HASH_TAGGED:
-            tag = entry[ATTR_TAG]
-            repository = entry[ATTR_REPOSITORY]
-            key = f"tag:{repository}:{tag}"
+        id = tags.pop(tag)
+        record = self._writable(id)
+        record.tags = tuple(t for t in record.tags if t != (repository_id, tag))
+        self._drop_if_unused(id)
 
-            if key in self.graph.nodes:
-                self.graph.remove_node(key)
+        del sorted_tags[bisect_left(sorted_tags, tag)]
 
-            self.graph.add_node(
-                key,
-                **{ATTR_TAG: tag, ATTR_REPOSITORY: repository, ATTR_TYPE: TYPE_TAG},
-            )
-            self.graph.add_edge(key, entry[ATTR_HASH])
-
-        elif entry["type"] == RegistryActions.BLOB_MOUNTED:
-            if entry[ATTR_HASH] not in self.graph.nodes:
-                self.graph.add_node(
-                    entry[ATTR_HASH],
-                    **{
-                        ATTR_TYPE: TYPE_BLOB,
-                        ATTR_REPOSITORIES: set(),
-                        ATTR_LOCATIONS: set(),
-                    },
-                )
-
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_REPOSITORIES].add(
-                entry[ATTR_REPOSITORY]
-            )
+        self._unref_repository(repository_id)
 
-        elif entry["type"] == RegistryActions.BLOB_UNMOUNTED:
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_REPOSITORIES].discard(
-                entry[ATTR_REPOSITORY]
-            )
+    def _mount(self, entry, type):
+        id, record = self._ensure(entry[ATTR_HASH])
+        if record.type is None:
+            record.type = type
+            self._physical_bytes += record.size or 0
+            self._update_orphan(id, record)
 
-        elif entry["type"] == RegistryActions.BLOB_INFO:
-            for dependency in entry[ATTR_DEPENDENCIES]:
-                self.graph.add_edge(entry[ATTR_HASH], dependency)
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_CONTENT_TYPE] = entry[
-                ATTR_CONTENT_TYPE
-            ]
+        repository_id = self.repositories.intern(entry[ATTR_REPOSITORY])
+        if repository_id not in record.repositories:
+            record.repositories = tuple(sorted(record.repositories + (repository_id,)))
+            self._ref_repository(repository_id)
+            self._add_count("_repository_bytes", repository_id, record.size or 0)
 
-        elif entry["type"] == RegistryActions.BLOB_STAT:
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_SIZE] = entry[ATTR_SIZE]
+        self._update_live(id, record, record.locations)
 
-        elif entry["type"] == RegistryActions.BLOB_STORED:
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_LOCATIONS].add(entry[ATTR_LOCATION])
+    def _unmount(self, entry):
+        if self._lookup(entry[ATTR_HASH]) is None:
+            return None, None
 
-        elif entry["type"] == RegistryActions.BLOB_UNSTORED:
-            if entry[ATTR_HASH] not in self.graph.nodes:
-                return
-            node = self.graph.nodes[entry[ATTR_HASH]]
-            node[ATTR_LOCATIONS].discard(entry[ATTR_LOCATION])
-            if len(node[ATTR_LOCATIONS]) == 0:
-                self.graph.remove_node(entry[ATTR_HASH])
-
-        elif entry["type"] == RegistryActions.MANIFEST_MOUNTED:
-            if entry[ATTR_HASH] not in self.graph.nodes:
-                self.graph.add_node(
-                    entry[ATTR_HASH],
-                    **{
-                        ATTR_TYPE: TYPE_MANIFEST,
-                        ATTR_REPOSITORIES: set(),
-                        ATTR_LOCATIONS: set(),
-                    },
-                )
-
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_REPOSITORIES].add(
-                entry[ATTR_REPOSITORY]
+        id = self._ids[entry[ATTR_HASH]]
+        record = self._writable(id)
+
+        repository_id = self.repositories.lookup(entry[ATTR_REPOSITORY])
+        if repository_id in record.repositories:
+            record.repositories = tuple(
+                r for r in record.repositories if r != repository_id
             )
+            self._unref_repository(repository_id)
+            self._add_count("_repository_bytes", repository_id, -(record.size or 0))
+            self._update_live(id, record, record.locations)
+
+        return repository_id, record
+
+    def _info(self, entry):
+        id, record = self._ensure(entry[ATTR_HASH])
+        for dependency in entry[ATTR_DEPENDENCIES]:
+            self._add_dependency(id, record, dependency)
+        self._records[id].content_type = entry[ATTR_CONTENT_TYPE]
+
+    def _stat(self, entry):
+        id = self._ids.get(entry[ATTR_HASH])
+        if id is None:
+            logger.warning("Ignoring size of unknown object %s", entry[ATTR_HASH])
+            return
+        record = self._writable(id)
+        self._account(record, entry[ATTR_SIZE] - (record.size or 0))
+        record.size = entry[ATTR_SIZE]
+
+    def _store(self, entry):
+        id = self._ids.get(entry[ATTR_HASH])
+        if id is None:
+            logger.warning("Ignoring location of unknown object %s", entry[ATTR_HASH])
+            return
+        location_id = self.locations.intern(entry[ATTR_LOCATION])
+        if location_id not in self._missing:
+            # A location seen for the first time is missing every live object. The
+            # copy shares its pages with the live set until either changes.
+            self._own("_missing")[location_id] = copy.copy(self._live)
+            self._owned.add(("_missing", location_id))
+
+        locations = self._records[id].locations
+        if locations & (1 << location_id):
+            return
+
+        record = self._writable(id)
+        record.locations |= 1 << location_id
+        self._add_count("_location_bytes", location_id, record.size or 0)
+        self._update_live(id, record, locations)
+
+    def _unstore(self, entry):
+        id = self._ids.get(entry[ATTR_HASH])
+        if id is None:
+            return
+
+        record = self._writable(id)
+        locations = record.locations
+        location_id = self.locations.lookup(entry[ATTR_LOCATION])
+        if location_id is not None and locations & (1 << location_id):
+            record.locations &= ~(1 << location_id)
+            self._add_count("_location_bytes", location_id, -(record.size or 0))
+
+        if record.locations == 0:
+            self._remove(id, record, locations)
+        else:
+            self._update_live(id, record, locations)
+
+    def _tag(self, entry):
+        repository_id = self.repositories.intern(entry[ATTR_REPOSITORY])
+        tags, sorted_tags = self._own_tags(repository_id)
+        tag = entry[ATTR_TAG]
+
+        if tag in tags:
+            self._untag(repository_id, tag)
+
+        id, record = self._ensure(entry[ATTR_HASH])
+        record.tags += ((repository_id, tag),)
+        self._update_orphan(id, record)
+
+        tags[tag] = id
+        insort(sorted_tags, tag)
+        self._ref_repository(repository_id)
+
+    def _mount_blob(self, entry):
+        self._mount(entry, TYPE_BLOB)
+
+    def _mount_manifest(self, entry):
+        self._mount(entry, TYPE_MANIFEST)
+
+    def _unmount_manifest(self, entry):
+        repository_id, record = self._unmount(entry)
+        if record is None:
+            return
+
+        # Any tags in this repository that point at the manifest go with it
+        for tag_repository_id, tag in record.tags:
+            if tag_repository_id == repository_id:
+                self._untag(repository_id, tag)
+
+    _handlers = {
+        RegistryActions.HASH_TAGGED: _tag,
+        RegistryActions.BLOB_MOUNTED: _mount_blob,
+        RegistryActions.BLOB_UNMOUNTED: _unmount,
+        RegistryActions.BLOB_INFO: _info,
+        RegistryActions.BLOB_STAT: _stat,
+        RegistryActions.BLOB_STORED: _store,
+        RegistryActions.BLOB_UNSTORED: _unstore,
+        RegistryActions.MANIFEST_MOUNTED: _mount_manifest,
+        RegistryActions.MANIFEST_UNMOUNTED: _unmount_manifest,
+        RegistryActions.MANIFEST_INFO: _info,
+        RegistryActions.MANIFEST_STAT: _stat,
+        RegistryActions.MANIFEST_STORED: _store,
+        RegistryActions.MANIFEST_UNSTORED: _unstore,
+    }
+
+    def dispatch(self, entry):
+        logger.critical("Applying %s", entry)
 
-        elif entry["type"] == RegistryActions.MANIFEST_UNMOUNTED:
-            manifest = self.graph.nodes[entry[ATTR_HASH]]
-            manifest[ATTR_REPOSITORIES].discard(entry[ATTR_REPOSITORY])
+        self._view = None
 
-            for tag in list(self.graph.predecessors(entry[ATTR_HASH])):
-                if self.graph.nodes[tag][ATTR_REPOSITORY] == entry[ATTR_REPOSITORY]:
-                    self.graph.remove_node(tag)
+        handler = self._handlers.get(entry["type"])
+        if handler:
+            handler(self, entry)
 
-        elif entry["type"] == RegistryActions.MANIFEST_INFO:
-            for dependency in entry[ATTR_DEPENDENCIES]:
-                self.graph.add_edge(entry[ATTR_HASH], dependency)
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_CONTENT_TYPE] = entry[
-                ATTR_CONTENT_TYPE
-            ]
 
-        elif entry["type"] == RegistryActions.MANIFEST_INFO:
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_SIZE] = entry[ATTR_SIZE]
+class RegistryView(RegistryState):
 
-        elif entry["type"] == RegistryActions.MANIFEST_STORED:
-            self.graph.nodes[entry[ATTR_HASH]][ATTR_LOCATIONS].add(entry[ATTR_LOCATION])
+    """A read-only view of a RegistryState as of `applied_index`."""
 
-        elif entry["type"] == RegistryActions.MANIFEST_UNSTORED:
-            if entry[ATTR_HASH] not in self.graph.nodes:
-                return
-            node = self.graph.nodes[entry[ATTR_HASH]]
-            node[ATTR_LOCATIONS].discard(entry[ATTR_LOCATION])
-            if len(node[ATTR_LOCATIONS]) == 0:
-                self.graph.remove_node(entry[ATTR_HASH])
+    def __init__(self, state, log):
+        for name in SHARED_CONTAINERS:
+            setattr(self, name, getattr(state, name))
+
+        for name in SNAPSHOT_CONTAINERS:
+            setattr(self, name, Snapshot(getattr(state, name), log, name))
+
+        # Interned names are only ever appended to, so are safe to share. There are
+        # only a few locations, and the backlog lists all of them, so those are
+        # copied to leave out any that are seen after the view was taken.
+        self.repositories = state.repositories
+        self.locations = state.locations.copy()
+
+        self._physical_bytes = state._physical_bytes
+
+        self.applied_index = state.applied_index
+
+    def view(self):
+        return self
+
+    def dispatch(self, entry):
+        raise RuntimeError("Views of the registry state are read-only")
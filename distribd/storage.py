@@ -149,6 +149,11 @@ class Storage:
         await self._fp.file.open()
 
     async def close(self):
+        # Wait for a commit that is still being written
+        async with self._commit_lock:
+            await self._close()
+
+    async def _close(self):
         if self._fp:
             await self._fp.close()
             self._fp = None
@@ -162,7 +167,7 @@ class Storage:
             return False
 
         async with self._commit_lock:
-            await self.close()
+            await self._close()
 
             while self.last_index > last_index:
                 del self.log[-1]
@@ -182,14 +187,20 @@ class Storage:
     async def commit(self, term, entry):
         record = [term, entry]
 
+        # A commit that has started always finishes, even if the caller is
+        # cancelled. Otherwise the journal on disk and in memory could disagree,
+        # and caio stops delivering results after an operation is cancelled.
+        await asyncio.shield(self._commit(record))
+
+        logger.debug("Committed term %d index %d", self.last_term, self.last_index)
+
+    async def _commit(self, record):
         async with self._commit_lock:
             await self._fp.write(json.dumps(record) + "\n")
             await self._fp.file.fsync()
 
             self.log.append(record)
 
-        logger.debug("Committed term %d index %d", self.last_term, self.last_index)
-
     def __getitem__(self, key):
         if isinstance(key, slice):
             new_slice = slice(
@@ -0,0 +1,475 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+import uuid
+import weakref
+
+from aiofile import Writer
+
+from .utils.aio import open_for_writing
+
+logger = logging.getLogger(__name__)
+
+# Uploads that haven't been touched for this long (in seconds) are thrown away
+UPLOAD_SESSION_EXPIRY = 60 * 60 * 24
+
+# How often (in seconds) to look for abandoned uploads
+EXPIRY_INTERVAL = 60 * 10
+
+# Request bodies are read from the socket in chunks of this size
+INGEST_CHUNK_SIZE = 1024 * 1024
+
+# Chunks that can be waiting to be hashed or written before reading pauses
+INGEST_BUFFERS = 8
+
+
+class UploadSession:
+    """
+    A chunked blob upload that is in progress.
+
+    The data goes to `uploads/<session_id>` and a small checkpoint of the session
+    metadata goes next to it. sha256 state can't be serialized, so a session that
+    is recovered after a restart re-hashes the bytes it had already accepted.
+
+    Chunks that carry on from the end of the hashed data are hashed as they
+    arrive. Chunks can also be written at any later offset, in any order and
+    concurrently. Those are recorded as `extents` and hashed when the upload is
+    finished.
+    """
+
+    def __init__(self, sessions, session_id, repository, size=0, extents=None):
+        self.sessions = sessions
+        self.session_id = session_id
+        self.repository = repository
+
+        # Bytes at the start of the upload that have been fed to `hasher`
+        self.size = size
+        self.hasher = hashlib.sha256()
+
+        # Sorted, non-overlapping (start, end) ranges received past `size`
+        self.extents = [tuple(extent) for extent in extents or ()]
+
+        # (start, end) ranges that requests are writing right now
+        self._writing = []
+
+    @property
+    def path(self):
+        return self.sessions.directory / self.session_id
+
+    @property
+    def checkpoint_path(self):
+        return self.sessions.directory / f"{self.session_id}.json"
+
+    @property
+    def end(self):
+        """The offset just past the last byte that has been received."""
+        return self.extents[-1][1] if self.extents else self.size
+
+    @property
+    def contiguous(self):
+        """The number of bytes at the start of the upload that have all been received."""
+        end = self.size
+        for start, stop in self.extents:
+            if start > end:
+                break
+            end = max(end, stop)
+        return end
+
+    def missing(self):
+        """The (start, end) ranges before `end` that haven't been received."""
+        missing = []
+        end = self.size
+        for start, stop in self.extents:
+            if start > end:
+                missing.append((end, start))
+            end = max(end, stop)
+        return missing
+
+    @property
+    def writing(self):
+        """Whether any requests are writing to the upload right now."""
+        return bool(self._writing)
+
+    def writable(self, start, end=math.inf):
+        """
+        Whether a chunk can be written to the range from `start` up to `end`.
+
+        Hashed data can't be changed, and two requests can't write to the same
+        place at once.
+        """
+        if start < self.size:
+            return False
+
+        for writing_start, writing_end in self._writing:
+            if start < writing_end and writing_start < end:
+                return False
+
+        return True
+
+    def _record(self, start, end):
+        extents = []
+        for extent_start, extent_end in self.extents:
+            if extent_end < start or extent_start > end:
+                extents.append((extent_start, extent_end))
+            else:
+                start = min(start, extent_start)
+                end = max(end, extent_end)
+        extents.append((start, end))
+        self.extents = sorted(extents)
+
+    def _trim(self):
+        """Forget about extents that are now covered by hashed data."""
+        extents = []
+        for start, end in self.extents:
+            if end > self.size:
+                extents.append((max(start, self.size), end))
+        self.extents = extents
+
+    def update(self, chunk):
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+
+    async def ingest(self, content, offset=None, length=None):
+        """
+        Write a request body to the upload at `offset`, returning its size.
+
+        By default the body carries on from the end of the contiguous data. If
+        it starts where the hashed data stops then reading from the socket,
+        hashing and writing to disk overlap, and hashing happens on a worker
+        thread so a large layer doesn't stall the event loop. Otherwise it is
+        just written and hashed by `assemble`. Check `writable` first. If the
+        body can't be ingested the session is reset so that the next request
+        picks up from the last checkpoint.
+        """
+        sessions = self.sessions
+        loop = asyncio.get_event_loop()
+
+        if offset is None:
+            offset = self.contiguous
+
+        hashing = offset == self.size
+
+        writing = (offset, math.inf if length is None else offset + length)
+        self._writing.append(writing)
+
+        hash_queue = asyncio.Queue(sessions.ingest_buffers)
+        write_queue = asyncio.Queue(sessions.ingest_buffers)
+
+        async def read():
+            while True:
+                chunk = await content.read(sessions.ingest_chunk_size)
+                if hashing:
+                    await hash_queue.put(chunk)
+                await write_queue.put(chunk)
+                if not chunk:
+                    return
+
+        async def digest():
+            chunk = await hash_queue.get()
+            while chunk:
+                # hashlib releases the GIL for large updates
+                await loop.run_in_executor(None, self.hasher.update, chunk)
+                chunk = await hash_queue.get()
+
+        async def write(fp):
+            writer = Writer(fp, offset=offset)
+            size = 0
+            chunk = await write_queue.get()
+            while chunk:
+                # Clients disconnect part way through uploads, which cancels
+                # this. Let the write in flight finish so caio doesn't wedge.
+                await asyncio.shield(writer(chunk))
+                size += len(chunk)
+                chunk = await write_queue.get()
+            await asyncio.shield(fp.fsync())
+            return size
+
+        started = time.monotonic()
+
+        try:
+            async with open_for_writing(self.path, "r+b") as fp:
+                stages = [read(), write(fp)]
+                if hashing:
+                    stages.append(digest())
+
+                tasks = [asyncio.ensure_future(stage) for stage in stages]
+                try:
+                    _, size, *_ = await asyncio.gather(*tasks)
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    sessions.reset(self.session_id)
+                    raise
+
+        finally:
+            self._writing.remove(writing)
+
+        if hashing:
+            self.size += size
+            self._trim()
+        elif size:
+            self._record(offset, offset + size)
+
+        sessions.record_ingest(size, time.monotonic() - started)
+
+        return size
+
+    def _hash_to(self, end):
+        with open(self.path, "rb") as fp:
+            fp.seek(self.size)
+            while self.size < end:
+                chunk = fp.read(min(1024 * 1024, end - self.size))
+                if not chunk:
+                    raise RuntimeError(f"Upload {self.session_id} is short")
+                self.hasher.update(chunk)
+                self.size += len(chunk)
+
+        # Drop anything written past the end by a request that failed
+        os.truncate(self.path, end)
+
+    async def assemble(self):
+        """
+        Hash the chunks that arrived out of order, once there are no gaps.
+
+        Don't call this while anything is `writing`. Returns the ranges that are still missing, which is empty on success.
+        """
+        missing = self.missing()
+        if missing:
+            return missing
+
+        end = self.end
+        if end > self.size or os.path.getsize(self.path) > end:
+            # Nothing can be written while the file is hashed and truncated
+            assembling = (self.size, math.inf)
+            self._writing.append(assembling)
+
+            try:
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self._hash_to, end)
+            finally:
+                self._writing.remove(assembling)
+
+            self.extents = []
+
+        return []
+
+    def checkpoint(self):
+        """Atomically persist how much of the upload has been accepted."""
+        if not self.sessions.directory.exists():
+            os.makedirs(self.sessions.directory)
+
+        temporary_path = self.checkpoint_path.with_suffix(".tmp")
+        temporary_path.write_text(
+            json.dumps(
+                {
+                    "repository": self.repository,
+                    "size": self.size,
+                    "extents": self.extents,
+                }
+            )
+        )
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def recover(self):
+        """
+        Bring the hash back up to date with the data on disk.
+
+        Anything past the last checkpoint was never acknowledged to the client so
+        it is truncated away. Blocks, so run it in an executor.
+        """
+        if not self.path.exists():
+            self.path.touch()
+
+        end = self.end
+        if os.path.getsize(self.path) > end:
+            os.truncate(self.path, end)
+
+        size = 0
+        with open(self.path, "rb") as fp:
+            while size < self.size:
+                chunk = fp.read(min(1024 * 1024, self.size - size))
+                if not chunk:
+                    break
+                self.hasher.update(chunk)
+                size += len(chunk)
+
+        if size < self.size:
+            # The hashed data was cut short, so nothing after it can be trusted
+            self.extents = []
+
+        self.size = size
+
+
+class UploadSessions:
+    """
+    The blob uploads that are in progress on this node.
+
+    Sessions are checkpointed to disk so that a client can carry on with a
+    chunked upload after the node restarts. Sessions that have been abandoned
+    expire along with their data.
+
+    Session ids are `<identifier>.<uuid>`, so any node can tell which node holds
+    the data for an upload.
+    """
+
+    def __init__(
+        self,
+        images_directory,
+        identifier,
+        expiry=UPLOAD_SESSION_EXPIRY,
+        ingest_chunk_size=INGEST_CHUNK_SIZE,
+        ingest_buffers=INGEST_BUFFERS,
+    ):
+        self.directory = images_directory / "uploads"
+        self.identifier = identifier
+        self.expiry = expiry
+
+        self.ingest_chunk_size = ingest_chunk_size
+        self.ingest_buffers = ingest_buffers
+
+        # Totals for the request bodies that have been ingested, for metrics
+        self.ingest_count = 0
+        self.ingest_bytes = 0
+        self.ingest_seconds = 0
+        self.ingest_throughput = 0
+
+        # Uploads that finished as a copy of a blob that was already stored
+        self.coalesced = 0
+
+        self._sessions = {}
+        self._recovering = {}
+
+        # Digest -> lock held while an upload of that digest is being stored
+        self._storing = weakref.WeakValueDictionary()
+
+    def owner(self, session_id):
+        """The identifier of the node that a session belongs to."""
+        if "." not in session_id:
+            # Sessions started before ids carried their owner are always local
+            return self.identifier
+        return session_id.rsplit(".", 1)[0]
+
+    def create(self, repository):
+        session_id = f"{self.identifier}.{uuid.uuid4()}"
+        session = self._sessions[session_id] = UploadSession(
+            self, session_id, repository
+        )
+        session.checkpoint()
+        session.path.touch()
+        return session
+
+    async def get(self, session_id):
+        """Return the session called `session_id`, recovering it from disk if needed."""
+        if session_id in self._sessions:
+            return self._sessions[session_id]
+
+        if session_id in self._recovering:
+            return await asyncio.shield(self._recovering[session_id])
+
+        checkpoint_path = self.directory / f"{session_id}.json"
+        if "/" in session_id or not checkpoint_path.exists():
+            return None
+
+        loop = asyncio.get_event_loop()
+        future = self._recovering[session_id] = loop.create_future()
+
+        try:
+            metadata = json.loads(checkpoint_path.read_text())
+            session = UploadSession(
+                self,
+                session_id,
+                metadata["repository"],
+                metadata["size"],
+                metadata.get("extents"),
+            )
+            await loop.run_in_executor(None, session.recover)
+
+        except Exception:
+            logger.exception("Unable to recover upload session %s", session_id)
+            future.set_result(None)
+            return None
+
+        else:
+            logger.info("Recovered upload session %s", session_id)
+            self._sessions[session_id] = session
+            future.set_result(session)
+            return session
+
+        finally:
+            del self._recovering[session_id]
+
+    def storing(self, digest):
+        """
+        A lock to hold while storing an upload of `digest`.
+
+        When lots of clients push the same layer at once, only the first one does
+        the work. The others wait for it and then find the blob already stored.
+        The lock goes away when nothing is waiting on it.
+        """
+        lock = self._storing.get(digest)
+        if lock is None:
+            lock = self._storing[digest] = asyncio.Lock()
+        return lock
+
+    def reset(self, session_id):
+        """Forget the in-memory state of a session so it is recovered from its checkpoint."""
+        self._sessions.pop(session_id, None)
+
+    def record_ingest(self, size, seconds):
+        throughput = size / seconds if seconds > 0 else 0
+
+        self.ingest_count += 1
+        self.ingest_bytes += size
+        self.ingest_seconds += seconds
+        self.ingest_throughput += throughput
+
+        logger.debug("Ingested %d bytes at %.0f bytes/s", size, throughput)
+
+    def discard(self, session_id):
+        """Forget about a session and its checkpoint. The data file is left alone."""
+        self._sessions.pop(session_id, None)
+
+        try:
+            (self.directory / f"{session_id}.json").unlink()
+        except FileNotFoundError:
+            pass
+
+    def expire(self, now=None):
+        """Remove uploads (and anything else left in the uploads area) that have gone stale."""
+        if not self.directory.exists():
+            return
+
+        now = now or time.time()
+
+        for path in list(self.directory.iterdir()):
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            if now - mtime < self.expiry:
+                continue
+
+            if (self.directory / f"{path.name}.json").exists():
+                # Data belonging to a session expires along with its checkpoint
+                continue
+
+            if path.suffix == ".json":
+                session_id = path.stem
+                logger.info("Expiring abandoned upload session %s", session_id)
+                self.discard(session_id)
+                path = self.directory / session_id
+
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    async def run_forever(self):
+        while True:
+            self.expire()
+            await asyncio.sleep(EXPIRY_INTERVAL)
@@ -0,0 +1,22 @@
+import asyncio
+import contextlib
+
+from aiofile import AIOFile
+
+
+@contextlib.asynccontextmanager
+async def open_for_writing(path, mode):
+    """
+    Open `path` with AIOFile, making sure the final fsync and close finish.
+
+    AIOFile closes a writable file in a task that its caller awaits, so
+    cancelling the caller cancels the fsync too. caio can't cope with a cancelled
+    operation still completing in the kernel and stops delivering other results,
+    including for the journal.
+    """
+    fp = AIOFile(path, mode)
+    await fp.open()
+    try:
+        yield fp
+    finally:
+        await asyncio.shield(fp.close())
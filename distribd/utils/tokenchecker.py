@@ -23,7 +23,15 @@ class TokenChecker:
             with open(self._public_key_path, "r") as fp:
                 self._public_key = fp.read()
 
-    def authenticate(self, request, repository=None, actions=None):
+    def authenticate(
+        self, request, repository=None, actions=None, resource_type="repository"
+    ):
+        """
+        Check the request has a token granting `actions` on a resource.
+
+        Most resources are repositories, but the catalog is the `registry` resource
+        named `catalog`.
+        """
         request["user"] = "anonymous"
 
         if not self._enabled:
@@ -31,13 +39,13 @@ class TokenChecker:
 
         if "Authorization" not in request.headers:
             raise exceptions.Unauthorized(
-                self._realm, self._service, repository, actions
+                self._realm, self._service, repository, actions, resource_type
             )
 
         auth_header = request.headers["Authorization"]
         if not auth_header.startswith("Bearer "):
             raise exceptions.Unauthorized(
-                self._realm, self._service, repository, actions
+                self._realm, self._service, repository, actions, resource_type
             )
 
         bearer_token = auth_header.split(" ", 1)[1]
@@ -62,7 +70,7 @@ class TokenChecker:
             return
 
         for access in decoded["access"]:
-            if access.get("type") != "repository":
+            if access.get("type") != resource_type:
                 continue
             if access.get("name") != repository:
                 continue
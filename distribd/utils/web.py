@@ -1,13 +1,44 @@
 import asyncio
+import logging
 
 import aiohttp.web
 
 from .tls import create_server_context
 
+logger = logging.getLogger(__name__)
 
-async def run_server(
-    raft, server_name, bind_config, routes, access_log_class=None, **context
+# Headers that only apply to a single connection so mustn't be proxied
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "content-length",
+    "host",
+    "keep-alive",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Proxied response bodies are relayed in chunks of this size
+PROXY_CHUNK_SIZE = 1024 * 1024
+
+
+async def start_server(
+    raft,
+    server_name,
+    bind_config,
+    routes,
+    access_log_class=None,
+    reuse_port=False,
+    **context,
 ):
+    """
+    Start serving `routes` on the address in `bind_config` and return the runner.
+
+    The address that was actually bound is written back to `bind_config` and, if
+    there is a `raft`, announced to the rest of the cluster as `server_name`.
+    """
     app = aiohttp.web.Application(client_max_size=1024 ** 3)
 
     for key, value in context.items():
@@ -25,12 +56,15 @@ async def run_server(
     host = bind_config["address"].get(str)
     port = bind_config["port"].get(int)
 
+    ssl_context = create_server_context(bind_config["tls"])
+
     site = aiohttp.web.TCPSite(
         runner,
         host,
         port,
         shutdown_timeout=1.0,
-        ssl_context=create_server_context(bind_config["tls"]),
+        ssl_context=ssl_context,
+        reuse_port=reuse_port or None,
     )
     await site.start()
 
@@ -38,12 +72,96 @@ async def run_server(
     bind_config["address"].set(sockname[0])
     bind_config["port"].set(sockname[1])
 
-    raft.state_changed(**{server_name: {"address": sockname[0], "port": sockname[1]}})
+    if raft:
+        raft.state_changed(
+            **{
+                server_name: {
+                    "address": sockname[0],
+                    "port": sockname[1],
+                    "protocol": "https" if ssl_context else "http",
+                }
+            }
+        )
+
+    return runner
+
 
+def peer_url(server):
+    """The base url of a listener from the discovery info a node announced."""
+    protocol = server.get("protocol", "http")
+    return f"{protocol}://{server['address']}:{server['port']}"
+
+
+async def serve_forever(*runners):
     try:
         # Sleep forever. No activity is needed.
         await asyncio.Event().wait()
     finally:
         # On any reason of exit, stop reporting the health.
-        await asyncio.shield(runner.shutdown())
-        await asyncio.shield(runner.cleanup())
+        for runner in runners:
+            await asyncio.shield(runner.shutdown())
+            await asyncio.shield(runner.cleanup())
+
+
+async def run_server(
+    raft, server_name, bind_config, routes, access_log_class=None, **context
+):
+    runner = await start_server(
+        raft,
+        server_name,
+        bind_config,
+        routes,
+        access_log_class=access_log_class,
+        **context,
+    )
+    await serve_forever(runner)
+
+
+async def proxy_request(session, request, url, headers=None):
+    """
+    Stream `request` to `url` and relay the reply back to the client.
+
+    Neither the request body nor the response is buffered. `headers` are added to
+    the ones sent by the client. Raises aiohttp.ClientError if `url` can't be
+    reached. If the reply fails after it has started being relayed then the
+    client's connection is dropped, as it is too late to send an error.
+    """
+    forwarded_headers = {
+        key: value
+        for key, value in request.headers.items()
+        if key.lower() not in HOP_BY_HOP_HEADERS
+    }
+    forwarded_headers.update(headers or {})
+
+    if request.content_length is not None:
+        forwarded_headers["Content-Length"] = str(request.content_length)
+
+    async with session.request(
+        request.method,
+        url,
+        headers=forwarded_headers,
+        data=request.content if request.body_exists else None,
+        allow_redirects=False,
+    ) as resp:
+        response = aiohttp.web.StreamResponse(
+            status=resp.status,
+            headers={
+                key: value
+                for key, value in resp.headers.items()
+                if key.lower() not in HOP_BY_HOP_HEADERS
+            },
+        )
+        if resp.content_length is not None:
+            response.content_length = resp.content_length
+        await response.prepare(request)
+
+        try:
+            async for chunk in resp.content.iter_chunked(PROXY_CHUNK_SIZE):
+                await response.write(chunk)
+        except aiohttp.ClientError:
+            logger.exception("Proxied reply from %s failed part way through", url)
+            request.transport.close()
+            return response
+
+    await response.write_eof()
+    return response
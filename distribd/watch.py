@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+from .actions import RegistryActions
+
+logger = logging.getLogger(__name__)
+
+# How long (in seconds) a watch waits for a change if the client doesn't say
+WATCH_TIMEOUT = 30
+
+# The longest (in seconds) a client can ask a watch to wait for
+MAX_WATCH_TIMEOUT = 300
+
+
+class TagWatchers:
+    """
+    Clients that are waiting for tags to change.
+
+    This is fed `HASH_TAGGED` entries as they are applied and remembers the raft
+    index that last touched each tag. Tags are forgotten again when the manifest
+    they point at is unmounted, so this only grows with the tags that exist. A
+    waiting client is just a future filed under its repository, so it costs
+    nothing until that repository is tagged.
+    """
+
+    def __init__(self):
+        # Repository -> {tag: (index of the entry that last tagged it, hash)}
+        self._tagged = {}
+
+        # Repository -> {manifest hash: set of tags pointing at it}
+        self._manifests = {}
+
+        # Repository -> {future: tag, or None for any tag}
+        self._waiters = {}
+
+    @property
+    def waiting(self):
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def changes(self, repository, since, tag=None):
+        """Returns {tag: index} for tags in `repository` that were tagged after `since`."""
+        tagged = self._tagged.get(repository, {})
+
+        if tag is not None:
+            index, hash = tagged.get(tag, (0, None))
+            return {tag: index} if index > since else {}
+
+        return {tag: index for tag, (index, hash) in tagged.items() if index > since}
+
+    async def wait(self, repository, since, tag=None, timeout=None):
+        """
+        Wait until a tag in `repository` is tagged after index `since`.
+
+        If `tag` is set then only that tag is watched. Returns the same as
+        `changes`, which is empty if nothing changed within `timeout` seconds.
+        """
+        changes = self.changes(repository, since, tag)
+        if changes:
+            return changes
+
+        future = asyncio.get_event_loop().create_future()
+        waiters = self._waiters.setdefault(repository, {})
+        waiters[future] = tag
+
+        try:
+            await asyncio.wait([future], timeout=timeout)
+        finally:
+            del waiters[future]
+            if not waiters:
+                del self._waiters[repository]
+
+        return self.changes(repository, since, tag)
+
+    def dispatch_entries(self, entries, index):
+        """Record the tags changed by `entries`, the last of which is at `index`."""
+        changed = {}
+
+        for entry_index, (term, entry) in enumerate(entries, index - len(entries) + 1):
+            type = entry.get("type")
+
+            if type == RegistryActions.MANIFEST_UNMOUNTED:
+                self._forget(entry["repository"], entry["hash"])
+                continue
+
+            if type != RegistryActions.HASH_TAGGED:
+                continue
+
+            repository = entry["repository"]
+            tag = entry["tag"]
+
+            hash = entry["hash"]
+
+            tagged = self._tagged.setdefault(repository, {})
+            manifests = self._manifests.setdefault(repository, {})
+            if tag in tagged:
+                self._untag(repository, tag, tagged[tag][1])
+            tagged[tag] = (entry_index, hash)
+            manifests.setdefault(hash, set()).add(tag)
+
+            changed.setdefault(repository, set()).add(tag)
+
+        for repository, tags in changed.items():
+            for future, tag in self._waiters.get(repository, {}).items():
+                if (tag is None or tag in tags) and not future.done():
+                    future.set_result(None)
+
+    def _untag(self, repository, tag, hash):
+        """Drop `tag` from the tags of `hash` in `repository`."""
+        manifests = self._manifests[repository]
+        tags = manifests[hash]
+        tags.discard(tag)
+        if not tags:
+            del manifests[hash]
+
+    def _forget(self, repository, hash):
+        """Forget the tags that went with `hash` when it left `repository`."""
+        manifests = self._manifests.get(repository, {})
+        tagged = self._tagged.get(repository, {})
+
+        for tag in manifests.pop(hash, ()):
+            del tagged[tag]
+
+        if not manifests:
+            self._manifests.pop(repository, None)
+            self._tagged.pop(repository, None)
@@ -0,0 +1,338 @@
+import asyncio
+import logging
+import multiprocessing
+import pathlib
+
+import aiohttp
+from aiohttp import web
+import coloredlogs
+import confuse
+import ujson
+import uvloop
+import verboselogs
+from yarl import URL
+
+from . import exceptions, registry
+from .actions import RegistryActions
+from .cache import ManifestCache
+from .state import RegistryState
+from .utils.tokenchecker import TokenChecker
+from .utils.web import proxy_request, serve_forever, start_server
+from .watch import TagWatchers
+
+logger = logging.getLogger(__name__)
+
+# How long a worker's request for committed entries waits for new ones
+COMMITTED_POLL_TIMEOUT = 30
+
+# The most committed entries handed to a worker at once
+COMMITTED_BATCH_SIZE = 1000
+
+# How long a worker waits before following the raft process again after a failure
+RETRY_INTERVAL = 1.0
+
+# How often (in seconds) to check for workers that have died
+WORKER_CHECK_INTERVAL = 1.0
+
+# Handlers that a worker can answer from its replica. Everything else is passed
+# to the raft process: writes, and reads by tag, as a replica that is a little
+# behind would hand out the previous digest straight after a push.
+READ_HANDLERS = {
+    registry.handle_bare_v2,
+    registry.handle_v2_root,
+    registry.list_repositories,
+    registry.watch_tags,
+    registry.list_referrers,
+    registry.head_manifest_by_hash,
+    registry.get_manifest_by_hash,
+    registry.head_blob,
+    registry.get_blob_by_hash,
+}
+
+# A worker's replica can be a little behind, so these are retried upstream
+FORWARDED_ERRORS = (
+    exceptions.BlobUnknown,
+    exceptions.ManifestUnknown,
+    exceptions.NameUnknown,
+)
+
+internal_routes = web.RouteTableDef()
+
+
+@internal_routes.get("/_distribd/committed")
+async def committed_entries(request):
+    """
+    Stream applied entries to the workers on this node.
+
+    Long polls until something after index `since` has been applied, then
+    returns a batch of entries starting from `since + 1`.
+    """
+    reducers = request.app["raft"].reducers
+
+    try:
+        since = int(request.query.get("since", 0))
+        timeout = float(request.query.get("timeout", COMMITTED_POLL_TIMEOUT))
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    try:
+        await reducers.wait_for_applied(since + 1, timeout)
+    except asyncio.TimeoutError:
+        pass
+
+    end = min(reducers.applied_index, since + COMMITTED_BATCH_SIZE)
+    entries = reducers.machine.log[since + 1 : end + 1] if end > since else []
+
+    return web.json_response(
+        {"index": max(since, end), "entries": entries}, dumps=ujson.dumps
+    )
+
+
+class Upstream:
+    """
+    Stands in for the Mirrorer in a worker.
+
+    Workers don't mirror anything themselves. A request for an object that isn't
+    stored here yet fails in the worker and is passed to the raft process, which
+    reads it through from a peer.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def read_through(self, hash):
+        return None
+
+
+class RegistryReplica:
+    """A read-only copy of the registry state that follows the raft process."""
+
+    def __init__(self, session, upstream, manifest_cache, tag_watchers):
+        self.session = session
+        self.upstream = upstream
+        self.manifest_cache = manifest_cache
+        self.tag_watchers = tag_watchers
+
+        self.state = RegistryState()
+
+    def apply(self, entries, index):
+        if not entries:
+            return
+
+        self.state.dispatch_entries(entries, index)
+        self.tag_watchers.dispatch_entries(entries, index)
+
+        for term, entry in entries:
+            if entry.get("type") == RegistryActions.MANIFEST_UNSTORED:
+                self.manifest_cache.discard(entry["hash"])
+
+    async def run_forever(self):
+        url = self.upstream / "_distribd" / "committed"
+
+        while True:
+            params = {
+                "since": str(self.state.applied_index),
+                "timeout": str(COMMITTED_POLL_TIMEOUT),
+            }
+
+            try:
+                async with self.session.get(url, params=params) as resp:
+                    payload = await resp.json(loads=ujson.loads)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logger.warning("Unable to follow committed entries from %s", url)
+                await asyncio.sleep(RETRY_INTERVAL)
+                continue
+
+            self.apply(payload["entries"], payload["index"])
+
+
+async def forward(request):
+    """Hand a request to the raft process on this node and relay its reply."""
+    url = f"{request.app['upstream']}{request.rel_url}"
+
+    try:
+        return await proxy_request(request.app["mirrorer"].session, request, url)
+    except aiohttp.ClientError:
+        logger.exception("Unable to forward %s %s", request.method, request.path)
+        raise web.HTTPServiceUnavailable()
+
+
+def _serve_or_forward(handler):
+    async def serve(request):
+        try:
+            return await handler(request)
+        except FORWARDED_ERRORS:
+            return await forward(request)
+
+    return serve
+
+
+def worker_routes():
+    routes = web.RouteTableDef()
+    for route in registry.routes:
+        if route.handler in READ_HANDLERS:
+            handler = _serve_or_forward(route.handler)
+        else:
+            handler = forward
+        routes.route(route.method, route.path, **route.kwargs)(handler)
+    return routes
+
+
+async def run_worker(settings):
+    config = confuse.Configuration("distribd", read=False)
+    config.set(settings["config"])
+
+    verify_local_objects = False
+    if config["verify_local_objects"].exists():
+        verify_local_objects = config["verify_local_objects"].get(bool)
+
+    upstream = URL(settings["upstream"])
+    session = aiohttp.ClientSession(json_serialize=ujson.dumps)
+    manifest_cache = ManifestCache(settings["manifest_cache_size"])
+    tag_watchers = TagWatchers()
+    replica = RegistryReplica(session, upstream, manifest_cache, tag_watchers)
+
+    try:
+        runner = await start_server(
+            None,
+            f"registry.{settings['name']}",
+            config,
+            worker_routes(),
+            reuse_port=True,
+            identifier=settings["identifier"],
+            registry_state=replica.state,
+            images_directory=pathlib.Path(settings["images_directory"]),
+            manifest_cache=manifest_cache,
+            tag_watchers=tag_watchers,
+            verify_local_objects=verify_local_objects,
+            token_checker=TokenChecker(config),
+            mirrorer=Upstream(session),
+            upstream=upstream,
+        )
+
+        await asyncio.gather(replica.run_forever(), serve_forever(runner))
+
+    finally:
+        await session.close()
+
+
+def worker_main(settings):
+    verboselogs.install()
+    coloredlogs.install(
+        level="DEBUG", fmt="%(asctime)s %(name)s %(levelname)s %(message)s"
+    )
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        asyncio.run(run_worker(settings))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_workers(count, settings):
+    """Keep `count` worker processes running until cancelled."""
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+
+    try:
+        while True:
+            for i in range(count):
+                process = processes.get(i)
+                if process and process.is_alive():
+                    continue
+
+                if process:
+                    logger.warning(
+                        "Registry worker %d exited with %s, restarting",
+                        i,
+                        process.exitcode,
+                    )
+
+                process = context.Process(
+                    target=worker_main,
+                    args=(settings,),
+                    name=f"distribd-{settings['name']}-{i}",
+                    daemon=True,
+                )
+                process.start()
+                processes[i] = process
+
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join(1)
+
+
+async def run_registry_workers(
+    raft,
+    name,
+    config,
+    identifier,
+    registry_state,
+    images_directory,
+    mirrorer,
+    wh_manager,
+    upload_sessions,
+    manifest_cache,
+    tag_watchers,
+):
+    """
+    Like `run_registry`, but share the listener with `workers` worker processes.
+
+    This process and the workers all bind the public port with SO_REUSEPORT so
+    the kernel spreads connections across them. Each worker keeps a read-only
+    replica of the registry state, fed with the entries this process has
+    applied, and serves reads from it and the storage directory. Writes, and
+    reads its replica can't answer yet, are passed to this process over a
+    private listener on the loopback interface.
+    """
+    context = registry.registry_context(
+        raft,
+        config,
+        identifier,
+        registry_state,
+        images_directory,
+        mirrorer,
+        wh_manager,
+        upload_sessions,
+        manifest_cache,
+        tag_watchers,
+    )
+
+    runner = await start_server(
+        raft, f"registry.{name}", config, registry.routes, reuse_port=True, **context
+    )
+
+    internal_config = config["internal"]
+    if not internal_config["address"].exists():
+        internal_config["address"].set("127.0.0.1")
+    if not internal_config["port"].exists():
+        internal_config["port"].set(0)
+
+    internal_runner = await start_server(
+        raft,
+        f"registry.{name}.internal",
+        internal_config,
+        [*registry.routes, *internal_routes],
+        **context,
+    )
+
+    address = internal_config["address"].get(str)
+    port = internal_config["port"].get(int)
+
+    settings = {
+        "name": name,
+        "config": config.flatten(),
+        "identifier": identifier,
+        "images_directory": str(images_directory),
+        "manifest_cache_size": manifest_cache.max_bytes,
+        "upstream": f"http://{address}:{port}",
+    }
+
+    await asyncio.gather(
+        run_workers(config["workers"].get(int), settings),
+        serve_forever(runner, internal_runner),
+    )
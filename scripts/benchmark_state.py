@@ -0,0 +1,356 @@
+"""
+Compare the memory use and lookup speed of the registry index against the
+networkx graph it replaced.
+
+    python scripts/benchmark_state.py --manifests 20000 --layers 8
+
+The legacy implementation is kept here (rather than in the package) so that this
+is the only thing that still needs networkx.
+"""
+
+import argparse
+import gc
+import hashlib
+import logging
+import random
+import time
+import tracemalloc
+
+from distribd.actions import RegistryActions
+from distribd.state import (
+    ATTR_CONTENT_TYPE,
+    ATTR_DEPENDENCIES,
+    ATTR_HASH,
+    ATTR_LOCATION,
+    ATTR_LOCATIONS,
+    ATTR_REPOSITORIES,
+    ATTR_REPOSITORY,
+    ATTR_SIZE,
+    ATTR_TAG,
+    ATTR_TYPE,
+    TYPE_BLOB,
+    TYPE_MANIFEST,
+    TYPE_TAG,
+    Reducer,
+    RegistryState,
+)
+from networkx import DiGraph, subgraph_view
+
+
+class LegacyRegistryState(Reducer):
+    def __init__(self):
+        self.graph = DiGraph()
+
+    def __getitem__(self, key):
+        return self.graph.nodes[key]
+
+    def is_blob_available(self, repository, hash):
+        if hash not in self.graph.nodes:
+            return False
+
+        blob = self.graph.nodes[hash]
+
+        if blob[ATTR_TYPE] != TYPE_BLOB:
+            return False
+
+        if repository not in self.graph.nodes[hash][ATTR_REPOSITORIES]:
+            return False
+
+        return True
+
+    def is_manifest_available(self, repository, hash):
+        if hash not in self.graph.nodes:
+            return False
+
+        manifest = self.graph.nodes[hash]
+
+        if manifest[ATTR_TYPE] != TYPE_MANIFEST:
+            return False
+
+        if ATTR_CONTENT_TYPE not in manifest:
+            return False
+
+        if repository not in self.graph.nodes[hash][ATTR_REPOSITORIES]:
+            return False
+
+        return True
+
+    def get_orphaned_objects(self):
+        """
+        Returns all nodes that have no incoming edges and are not a tag.
+
+        These nodes should be deleted by a mirror, and when this has
+        happened they should report that with a BLOB_UNMOUNTED or MANIFEST_UNMOUNTED.
+        """
+        orphaned = set()
+        for v in self.graph:
+            if self.graph.nodes[v][ATTR_TYPE] == TYPE_TAG:
+                continue
+            if len(self.graph.in_edges(v)) == 0:
+                orphaned.add(v)
+        return orphaned
+
+    def get_tags(self, repository):
+        def _filter(node):
+            n = self.graph.nodes[node]
+            if n[ATTR_TYPE] != TYPE_TAG:
+                return False
+            if n[ATTR_REPOSITORY] != repository:
+                return False
+            return True
+
+        tags = subgraph_view(self.graph, _filter)
+        resolved_tags = [tags.nodes[tag][ATTR_TAG] for tag in tags.nodes]
+        if len(resolved_tags) == 0:
+            raise KeyError()
+        return resolved_tags
+
+    def get_tag(self, repository, tag):
+        key = f"tag:{repository}:{tag}"
+        if key not in self.graph:
+            raise KeyError()
+        return next(self.graph.neighbors(key))
+
+    def dispatch(self, entry):
+
+        if entry["type"] == RegistryActions.HASH_TAGGED:
+            tag = entry[ATTR_TAG]
+            repository = entry[ATTR_REPOSITORY]
+            key = f"tag:{repository}:{tag}"
+
+            if key in self.graph.nodes:
+                self.graph.remove_node(key)
+
+            self.graph.add_node(
+                key,
+                **{ATTR_TAG: tag, ATTR_REPOSITORY: repository, ATTR_TYPE: TYPE_TAG},
+            )
+            self.graph.add_edge(key, entry[ATTR_HASH])
+
+        elif entry["type"] == RegistryActions.BLOB_MOUNTED:
+            if entry[ATTR_HASH] not in self.graph.nodes:
+                self.graph.add_node(
+                    entry[ATTR_HASH],
+                    **{
+                        ATTR_TYPE: TYPE_BLOB,
+                        ATTR_REPOSITORIES: set(),
+                        ATTR_LOCATIONS: set(),
+                    },
+                )
+
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_REPOSITORIES].add(
+                entry[ATTR_REPOSITORY]
+            )
+
+        elif entry["type"] == RegistryActions.BLOB_UNMOUNTED:
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_REPOSITORIES].discard(
+                entry[ATTR_REPOSITORY]
+            )
+
+        elif entry["type"] == RegistryActions.BLOB_INFO:
+            for dependency in entry[ATTR_DEPENDENCIES]:
+                self.graph.add_edge(entry[ATTR_HASH], dependency)
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_CONTENT_TYPE] = entry[
+                ATTR_CONTENT_TYPE
+            ]
+
+        elif entry["type"] == RegistryActions.BLOB_STAT:
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_SIZE] = entry[ATTR_SIZE]
+
+        elif entry["type"] == RegistryActions.BLOB_STORED:
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_LOCATIONS].add(entry[ATTR_LOCATION])
+
+        elif entry["type"] == RegistryActions.BLOB_UNSTORED:
+            if entry[ATTR_HASH] not in self.graph.nodes:
+                return
+            node = self.graph.nodes[entry[ATTR_HASH]]
+            node[ATTR_LOCATIONS].discard(entry[ATTR_LOCATION])
+            if len(node[ATTR_LOCATIONS]) == 0:
+                self.graph.remove_node(entry[ATTR_HASH])
+
+        elif entry["type"] == RegistryActions.MANIFEST_MOUNTED:
+            if entry[ATTR_HASH] not in self.graph.nodes:
+                self.graph.add_node(
+                    entry[ATTR_HASH],
+                    **{
+                        ATTR_TYPE: TYPE_MANIFEST,
+                        ATTR_REPOSITORIES: set(),
+                        ATTR_LOCATIONS: set(),
+                    },
+                )
+
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_REPOSITORIES].add(
+                entry[ATTR_REPOSITORY]
+            )
+
+        elif entry["type"] == RegistryActions.MANIFEST_UNMOUNTED:
+            manifest = self.graph.nodes[entry[ATTR_HASH]]
+            manifest[ATTR_REPOSITORIES].discard(entry[ATTR_REPOSITORY])
+
+            for tag in list(self.graph.predecessors(entry[ATTR_HASH])):
+                if self.graph.nodes[tag][ATTR_REPOSITORY] == entry[ATTR_REPOSITORY]:
+                    self.graph.remove_node(tag)
+
+        elif entry["type"] == RegistryActions.MANIFEST_INFO:
+            for dependency in entry[ATTR_DEPENDENCIES]:
+                self.graph.add_edge(entry[ATTR_HASH], dependency)
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_CONTENT_TYPE] = entry[
+                ATTR_CONTENT_TYPE
+            ]
+
+        elif entry["type"] == RegistryActions.MANIFEST_INFO:
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_SIZE] = entry[ATTR_SIZE]
+
+        elif entry["type"] == RegistryActions.MANIFEST_STORED:
+            self.graph.nodes[entry[ATTR_HASH]][ATTR_LOCATIONS].add(entry[ATTR_LOCATION])
+
+        elif entry["type"] == RegistryActions.MANIFEST_UNSTORED:
+            if entry[ATTR_HASH] not in self.graph.nodes:
+                return
+            node = self.graph.nodes[entry[ATTR_HASH]]
+            node[ATTR_LOCATIONS].discard(entry[ATTR_LOCATION])
+            if len(node[ATTR_LOCATIONS]) == 0:
+                self.graph.remove_node(entry[ATTR_HASH])
+
+
+def digest(*parts):
+    return "sha256:" + hashlib.sha256(":".join(map(str, parts)).encode()).hexdigest()
+
+
+def generate_entries(manifests, layers, repositories, locations):
+    """A workload where manifests share a pool of base layers, and every one is tagged."""
+    rng = random.Random(0)
+    base_layers = [digest("base", i) for i in range(max(1, manifests // 10))]
+    nodes = [f"node{i}" for i in range(locations)]
+
+    entries = []
+    for i in range(manifests):
+        repository = f"repo{i % repositories}"
+
+        dependencies = rng.sample(base_layers, min(2, len(base_layers)))
+        dependencies.extend(digest("layer", i, j) for j in range(layers))
+
+        for layer in dependencies:
+            entries.append(
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": repository,
+                    "hash": layer,
+                }
+            )
+            entries.append(
+                {"type": RegistryActions.BLOB_STAT, "hash": layer, "size": 1024}
+            )
+            for node in nodes:
+                entries.append(
+                    {
+                        "type": RegistryActions.BLOB_STORED,
+                        "hash": layer,
+                        "location": node,
+                    }
+                )
+
+        manifest = digest("manifest", i)
+        entries.append(
+            {
+                "type": RegistryActions.MANIFEST_MOUNTED,
+                "repository": repository,
+                "hash": manifest,
+            }
+        )
+        for node in nodes:
+            entries.append(
+                {
+                    "type": RegistryActions.MANIFEST_STORED,
+                    "hash": manifest,
+                    "location": node,
+                }
+            )
+        entries.append(
+            {
+                "type": RegistryActions.MANIFEST_INFO,
+                "hash": manifest,
+                "content_type": "application/vnd.docker.distribution.manifest.v2+json",
+                "dependencies": dependencies,
+            }
+        )
+        entries.append(
+            {
+                "type": RegistryActions.HASH_TAGGED,
+                "repository": repository,
+                "tag": f"v{i}",
+                "hash": manifest,
+            }
+        )
+
+    return entries
+
+
+def measure(factory, entries, manifests, layers, repositories, lookups):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    state = factory()
+    for entry in entries:
+        state.dispatch(entry)
+
+    load_time = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rng = random.Random(1)
+    queries = []
+    for _ in range(lookups):
+        i = rng.randrange(manifests)
+        repository = f"repo{i % repositories}"
+        queries.append((repository, i, digest("layer", i, rng.randrange(layers))))
+
+    start = time.perf_counter()
+    for repository, i, layer in queries:
+        state.is_blob_available(repository, layer)
+        state[layer]
+        state.get_tag(repository, f"v{i}")
+    lookup_time = time.perf_counter() - start
+
+    return memory, load_time, lookup_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifests", type=int, default=10000)
+    parser.add_argument("--layers", type=int, default=5)
+    parser.add_argument("--repositories", type=int, default=100)
+    parser.add_argument("--locations", type=int, default=3)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    # Both implementations log every entry they apply
+    logging.disable(logging.CRITICAL)
+
+    entries = generate_entries(
+        args.manifests, args.layers, args.repositories, args.locations
+    )
+    print(f"{len(entries)} entries")
+
+    for name, factory in (
+        ("networkx", LegacyRegistryState),
+        ("compact", RegistryState),
+    ):
+        memory, load_time, lookup_time = measure(
+            factory,
+            entries,
+            args.manifests,
+            args.layers,
+            args.repositories,
+            args.lookups,
+        )
+        print(
+            f"{name:>10}: {memory / 1024 / 1024:8.1f} MiB"
+            f"  load {load_time:6.2f}s"
+            f"  {args.lookups / lookup_time:10.0f} lookups/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+from distribd.cache import ManifestCache
+
+
+def test_evicts_least_recently_used():
+    cache = ManifestCache(max_bytes=8)
+
+    cache.put("sha256:a", b"9080")
+    cache.put("sha256:b", b"7060")
+    assert cache.get("sha256:a") == b"9080"
+
+    cache.put("sha256:c", b"5040")
+
+    assert "sha256:a" in cache
+    assert "sha256:b" not in cache
+    assert cache.get("sha256:c") == b"5040"
+    assert cache.size == 8
+
+
+def test_discard():
+    cache = ManifestCache(max_bytes=8)
+
+    cache.put("sha256:a", b"9080")
+    cache.discard("sha256:a")
+    cache.discard("sha256:missing")
+
+    assert cache.get("sha256:a") is None
+    assert cache.size == 0
+
+
+def test_too_big():
+    cache = ManifestCache(max_bytes=2)
+
+    cache.put("sha256:a", b"9080")
+
+    assert len(cache) == 0
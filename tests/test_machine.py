@@ -354,3 +354,95 @@ def test_find_inconsistencies(loop):
         )
         == 3
     )
+
+
+def test_timeouts_follow_rtt(loop):
+    m = Machine("node1")
+    m.add_peer("node2")
+    m.add_peer("node3")
+
+    m.election_timeout_min = 0.15
+    m.election_timeout_max = 5.0
+    m.heartbeat_interval_min = 0.01
+    m.heartbeat_interval_max = 1.0
+
+    # No measurements yet, so use the lower bounds
+    assert m.heartbeat_interval == 0.01
+    assert m.election_timeout == 0.15
+
+    m.tick = 0
+    m.step(Msg("node1", "node1", Message.Tick, 0))
+    m.step(Msg("node2", "node1", Message.PreVoteReply, 1, reject=False))
+    m.step(Msg("node2", "node1", Message.VoteReply, 1, reject=False))
+    assert m.state == NodeState.LEADER
+
+    heartbeat = m.outbox[0]
+    assert heartbeat.type == Message.AppendEntries
+
+    # Pretend the reply took 100ms to come back
+    m.step(
+        heartbeat.reply(1, reject=False, log_index=1, sent_at=heartbeat.sent_at - 0.1)
+    )
+
+    assert abs(m.peers["node2"].srtt - 0.1) < 0.01
+    assert 0.2 < m.heartbeat_interval < 1.0
+    assert 2.5 < m.election_timeout < 3.5
+
+    # The next heartbeat advertises our rtt to followers
+    m.step(Msg("node1", "node1", Message.Tick, 0))
+    assert m.outbox[0].rtt == m.rtt
+
+    # Bounds still apply however slow the network is
+    m.step(
+        heartbeat.reply(1, reject=False, log_index=1, sent_at=heartbeat.sent_at - 10)
+    )
+    assert m.heartbeat_interval == 1.0
+    assert m.election_timeout == 5.0
+
+
+def test_election_timeout_within_bounds(loop):
+    m = Machine("node1")
+    m.add_peer("node2")
+    m.add_peer("node3")
+
+    m.election_timeout_min = 0.15
+    m.election_timeout_max = 3.0
+
+    # A very slow network puts the shortest timeout at the upper bound
+    m.leader_rtt = 10
+    assert m.election_timeout == 3.0
+
+    ticks = set()
+    for i in range(100):
+        m._reset_election_tick()
+        ticks.add(m.tick - m.current_tick())
+
+    assert all(1.49 < tick <= 3.0 for tick in ticks)
+    assert len(ticks) > 1
+
+
+def test_follower_uses_leader_rtt(loop):
+    m = Machine("node1")
+    m.add_peer("node2")
+    m.add_peer("node3")
+
+    m.election_timeout_min = 0.15
+    m.election_timeout_max = 3.0
+
+    m.step(
+        Msg(
+            "node2",
+            "node1",
+            Message.AppendEntries,
+            2,
+            prev_index=0,
+            prev_term=0,
+            entries=[],
+            leader_commit=0,
+            sent_at=5,
+            rtt=0.1,
+        )
+    )
+
+    assert m.election_timeout == 1.0
+    assert m.outbox[0].sent_at == 5
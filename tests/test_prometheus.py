@@ -41,6 +41,12 @@ async def test_prometheus(loop, cluster_config, client_session):
         async with client_session.get(f"http://{address}:{port}/metrics") as resp:
             assert resp.status == 200
 
+        async with client_session.get(f"http://{address}:{port}/storage") as resp:
+            assert resp.status == 200
+            payload = await resp.json()
+            assert payload["physical"] == 0
+            assert payload["repositories"] == {}
+
     # Cancel servers. Ignore CancelledError.
     servers.cancel()
     try:
@@ -3,7 +3,13 @@ import json
 import logging
 
 from aiofile import AIOFile, LineReader
+import confuse
+from distribd import exceptions
+from distribd.machine import Machine, Message
+from distribd.raft import MessageQueue, Priority, Raft
+from distribd.reducers import Reducers
 from distribd.service import main
+from distribd.state import RegistryState
 import pytest
 
 logger = logging.getLogger(__name__)
@@ -166,3 +172,79 @@ async def test_third_node_recovery(
     await asyncio.sleep(0)
 
     await wait_converged(tmp_path, agreements)
+
+
+async def test_message_queue_priority():
+    queue = MessageQueue()
+
+    for message_type in (
+        Message.AddEntries,
+        Message.AppendEntriesReply,
+        Message.AddEntries,
+        Message.Tick,
+        Message.Vote,
+    ):
+        await queue.put(({"type": str(message_type)}, None))
+
+    assert queue.depth[Priority.PROPOSAL] == 2
+    assert queue.depth[Priority.CONTROL] == 2
+
+    order = []
+    while queue.qsize():
+        msg, _ = await queue.get()
+        order.append(msg["type"])
+
+    assert order == [
+        str(Message.Tick),
+        str(Message.Vote),
+        str(Message.AppendEntriesReply),
+        str(Message.AddEntries),
+        str(Message.AddEntries),
+    ]
+
+    assert queue.depth[Priority.PROPOSAL] == 0
+    assert queue.wait_count[Priority.PROPOSAL] == 2
+
+
+async def test_message_queue_starvation():
+    queue = MessageQueue(starvation_limit=2)
+
+    await queue.put(({"type": str(Message.AddEntries)}, None))
+    for i in range(4):
+        await queue.put(({"type": str(Message.Tick)}, None))
+
+    order = []
+    while queue.qsize():
+        msg, _ = await queue.get()
+        order.append(msg["type"])
+
+    assert order == [
+        str(Message.Tick),
+        str(Message.Tick),
+        str(Message.AddEntries),
+        str(Message.Tick),
+        str(Message.Tick),
+    ]
+
+
+async def test_admission_control():
+    config = confuse.Configuration("distribd", read=False)
+    config["raft"]["max_pending_entries"].set(2)
+
+    machine = Machine("node1")
+    reducers = Reducers(machine, RegistryState())
+    raft = Raft(config, machine, None, reducers)
+
+    raft.check_admission(2, 100)
+    assert raft.pressure == 0.0
+
+    machine.log.append((1, {}))
+    machine.log.append((1, {}))
+    assert raft.pressure == 1.0
+
+    with pytest.raises(exceptions.TooManyRequests) as e:
+        raft.check_admission(1, 100)
+
+    # Nothing has been committed recently so clients are told to back off fully
+    assert e.value.headers["Retry-After"] == "30"
+    assert raft.rejected_proposals == 1
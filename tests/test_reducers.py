@@ -0,0 +1,221 @@
+import asyncio
+
+from distribd.machine import Machine
+from distribd.reducers import COMPACT_THRESHOLD, Reducers
+from distribd.state import RegistryState
+import pytest
+
+
+def make_reducers(entries=10):
+    machine = Machine("node1")
+    for i in range(entries):
+        machine.log.append((1, {}))
+    return machine, Reducers(machine, RegistryState())
+
+
+async def test_wait_for_commit_already_applied():
+    machine, reducers = make_reducers()
+    machine.commit_index = 5
+    await reducers.step(machine)
+
+    assert await reducers.wait_for_commit(1, 3) is True
+    assert await reducers.wait_for_commit(2, 3) is False
+
+
+async def test_step_only_wakes_satisfied_waiters():
+    machine, reducers = make_reducers()
+
+    waiters = [
+        asyncio.ensure_future(reducers.wait_for_commit(1, index))
+        for index in (8, 2, 5, 3)
+    ]
+    await asyncio.sleep(0)
+    assert reducers.waiting == 4
+
+    machine.commit_index = 4
+    await reducers.step(machine)
+    await asyncio.sleep(0)
+
+    assert [w.done() for w in waiters] == [False, True, False, True]
+    assert reducers.waiting == 2
+
+    machine.commit_index = 10
+    await reducers.step(machine)
+    assert await asyncio.gather(*waiters) == [True, True, True, True]
+    assert reducers.waiting == 0
+
+
+async def test_wait_for_commit_timeout():
+    machine, reducers = make_reducers()
+
+    with pytest.raises(asyncio.TimeoutError):
+        await reducers.wait_for_commit(1, 5, timeout=0.01)
+
+    await asyncio.sleep(0)
+    assert reducers.waiting == 0
+
+    # A later commit skips over the abandoned waiter
+    machine.commit_index = 5
+    await reducers.step(machine)
+    assert reducers._waiters == []
+
+
+async def test_cancelled_waiters_are_compacted():
+    machine, reducers = make_reducers()
+
+    waiters = [
+        asyncio.ensure_future(reducers.wait_for_commit(1, 5))
+        for i in range(COMPACT_THRESHOLD)
+    ]
+    await asyncio.sleep(0)
+
+    for waiter in waiters:
+        waiter.cancel()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    assert reducers.waiting == 0
+    assert reducers._waiters == []
+
+
+async def test_subscriber_catches_up_in_batches(tmp_path):
+    machine, reducers = make_reducers(25)
+
+    seen = []
+
+    async def callback(state, entries):
+        seen.append(len(entries))
+
+    subscriber = reducers.add_side_effects("test", callback)
+    subscriber.batch_size = 10
+
+    machine.commit_index = 25
+    await reducers.step(machine)
+    await asyncio.sleep(0.01)
+
+    assert seen == [0, 10, 10, 5]
+    assert subscriber.cursor == 25
+    assert subscriber.lag == 0
+
+    await reducers.close()
+
+
+async def test_slow_subscriber_does_not_block_step():
+    machine, reducers = make_reducers()
+
+    release = asyncio.Event()
+    seen = []
+
+    async def callback(state, entries):
+        await release.wait()
+        seen.extend(entries)
+
+    reducers.add_side_effects("slow", callback)
+
+    machine.commit_index = 5
+    await reducers.step(machine)
+    await asyncio.sleep(0)
+
+    machine.commit_index = 10
+    await reducers.step(machine)
+    assert reducers.applied_index == 10
+    assert reducers.subscribers["slow"].lag == 10
+
+    release.set()
+    await asyncio.sleep(0.01)
+    assert len(seen) == 10
+    assert reducers.subscribers["slow"].lag == 0
+
+    await reducers.close()
+
+
+async def test_subscriber_handed_view_of_state():
+    machine, reducers = make_reducers()
+
+    release = asyncio.Event()
+    seen = []
+
+    async def callback(state, entries):
+        await release.wait()
+        seen.append((state.applied_index, len(entries)))
+
+    reducers.add_side_effects("slow", callback)
+
+    machine.commit_index = 5
+    await reducers.step(machine)
+    await asyncio.sleep(0)
+
+    # The state moves on while the callback is still busy with the first batch
+    machine.commit_index = 10
+    await reducers.step(machine)
+
+    release.set()
+    await asyncio.sleep(0.01)
+    assert seen == [(5, 0), (10, 10)]
+    assert reducers.subscribers["slow"].lag == 0
+
+    await reducers.close()
+
+
+async def test_subscriber_resumes_from_cursor(tmp_path):
+    machine, reducers = make_reducers()
+    reducers.cursors_directory = tmp_path
+
+    seen = []
+    reducers.add_side_effects("test", lambda state, entries: seen.extend(entries))
+
+    machine.commit_index = 6
+    await reducers.step(machine)
+    await asyncio.sleep(0)
+    await reducers.close()
+
+    assert (tmp_path / "test").read_text() == "6"
+
+    # After a restart only the entries we haven't seen are replayed
+    reducers = Reducers(machine, RegistryState(), tmp_path)
+    seen.clear()
+    reducers.add_side_effects("test", lambda state, entries: seen.extend(entries))
+
+    machine.commit_index = 10
+    await reducers.step(machine)
+    await asyncio.sleep(0)
+
+    assert len(seen) == 4
+
+    await reducers.close()
+
+
+async def test_subscriber_told_when_caught_up(tmp_path):
+    machine, reducers = make_reducers()
+    (tmp_path / "test").write_text("6")
+    reducers.cursors_directory = tmp_path
+
+    batches = []
+    reducers.add_side_effects("test", lambda state, entries: batches.append(entries))
+
+    machine.commit_index = 4
+    await reducers.step(machine)
+    await asyncio.sleep(0)
+    assert batches == []
+
+    machine.commit_index = 8
+    await reducers.step(machine)
+    await asyncio.sleep(0)
+    assert [len(entries) for entries in batches] == [0, 2]
+
+    await reducers.close()
+
+
+async def test_wait_for_applied():
+    machine, reducers = make_reducers()
+
+    waiter = asyncio.ensure_future(reducers.wait_for_applied(3))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    machine.commit_index = 3
+    await reducers.step(machine)
+    await waiter
+
+    # Already applied
+    await reducers.wait_for_applied(2)
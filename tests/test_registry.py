@@ -6,7 +6,9 @@ import os
 import pathlib
 
 import aiohttp
+from distribd import exceptions
 from distribd.machine import NodeState
+from distribd.raft import Raft
 from distribd.service import main
 from distribd.utils.registry import get_blob_path, get_manifest_path
 import pytest
@@ -263,6 +265,365 @@ async def test_put_blob_without_patches(fake_cluster):
         await assert_blob(fake_cluster, digest)
 
 
+def reject_next_proposal(monkeypatch):
+    check_admission = Raft.check_admission
+    rejected = []
+
+    def reject_once(self, entry_count=0, size=0):
+        # Handlers check with no entries, raft.append checks with the proposal
+        if entry_count and not rejected:
+            rejected.append(entry_count)
+            raise exceptions.TooManyRequests(1)
+        return check_admission(self, entry_count, size)
+
+    monkeypatch.setattr(Raft, "check_admission", reject_once)
+    return rejected
+
+
+async def test_put_blob_rejected_by_journal(fake_cluster, monkeypatch):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    digest = "bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
+    images = pathlib.Path(str(fake_cluster["node1"]["storage"]))
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"http://localhost:{port}/v2/alpine/blobs/uploads/"
+        ) as resp:
+            assert resp.status == 202
+            location = resp.headers["Location"]
+
+        async with session.patch(
+            f"http://localhost:{port}{location}", data=b"9080"
+        ) as resp:
+            assert resp.status == 202
+
+        rejected = reject_next_proposal(monkeypatch)
+
+        async with session.put(
+            f"http://localhost:{port}{location}?digest=sha256:{digest}"
+        ) as resp:
+            assert resp.status == 429
+            assert resp.headers["Retry-After"] == "1"
+
+        assert rejected
+        assert not get_blob_path(images, f"sha256:{digest}").exists()
+
+        # The session survives, so the client can finish it once it is admitted
+        async with session.get(f"http://localhost:{port}{location}") as resp:
+            assert resp.status == 204
+            assert resp.headers["Range"] == "0-4"
+
+        async with session.put(
+            f"http://localhost:{port}{location}?digest=sha256:{digest}"
+        ) as resp:
+            assert resp.status == 201
+
+        await assert_blob(fake_cluster, digest)
+
+
+async def test_put_blob_without_patches_rejected_by_journal(fake_cluster, monkeypatch):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    digest = "sha256:bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
+    images = pathlib.Path(str(fake_cluster["node1"]["storage"]))
+
+    reject_next_proposal(monkeypatch)
+
+    async with aiohttp.ClientSession() as session:
+        url = f"http://localhost:{port}/v2/alpine/blobs/uploads/?digest={digest}"
+        async with session.post(url, data=b"9080") as resp:
+            assert resp.status == 429
+
+    # Nothing is left behind in the uploads or the blob store
+    assert list((images / "uploads").iterdir()) == []
+    assert not get_blob_path(images, digest).exists()
+
+
+async def test_put_blob_coalesced(fake_cluster):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    digest = "sha256:bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
+
+    async with aiohttp.ClientSession() as session:
+
+        async def push(repository):
+            url = f"http://localhost:{port}/v2/{repository}/blobs/uploads/"
+            async with session.post(f"{url}?digest={digest}", data=b"9080") as resp:
+                assert resp.status == 201
+                assert resp.headers["Docker-Content-Digest"] == digest
+
+        await asyncio.gather(*[push("alpine") for i in range(5)])
+        await push("alpine")
+        await push("ubuntu")
+
+        # Claiming a stored digest isn't enough to get it into another repository
+        url = f"http://localhost:{port}/v2/debian/blobs/uploads/?digest={digest}"
+        async with session.post(url, data=b"0000") as resp:
+            assert resp.status == 400
+
+        url = f"http://localhost:{port}/v2/debian/blobs/{digest}"
+        async with session.head(url) as resp:
+            assert resp.status == 404
+
+    await assert_blob(fake_cluster, digest[7:])
+    await assert_blob(fake_cluster, digest[7:], repository="ubuntu")
+
+    # Only the first push and the first push to ubuntu changed anything
+    journal = pathlib.Path(str(fake_cluster["node1"]["storage"])) / "journal"
+    types = []
+    for line in journal.read_text().splitlines():
+        term, entry = json.loads(line)
+        if entry.get("hash") == digest and entry.get("location") in (None, "node1"):
+            types.append(entry["type"])
+
+    assert types.count("blob-mounted") == 2
+    assert types.count("blob-stat") == 1
+    assert types.count("blob-stored") == 1
+
+
+async def test_get_blob_range(fake_cluster):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    digest = "sha256:bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
+    url = f"http://localhost:{port}/v2/alpine/blobs/{digest}"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"http://localhost:{port}/v2/alpine/blobs/uploads/?digest={digest}",
+            data=b"9080",
+        ) as resp:
+            assert resp.status == 201
+
+        async with session.head(url) as resp:
+            assert resp.headers["Accept-Ranges"] == "bytes"
+            assert resp.headers["ETag"] == f'"{digest}"'
+
+        async with session.get(url, headers={"Range": "bytes=1-2"}) as resp:
+            assert resp.status == 206
+            assert resp.headers["Content-Range"] == "bytes 1-2/4"
+            assert resp.headers["Content-Length"] == "2"
+            assert resp.headers["ETag"] == f'"{digest}"'
+            assert await resp.read() == b"08"
+
+        async with session.get(url, headers={"Range": "bytes=2-"}) as resp:
+            assert resp.status == 206
+            assert resp.headers["Content-Range"] == "bytes 2-3/4"
+            assert await resp.read() == b"80"
+
+        async with session.get(url, headers={"Range": "bytes=-3"}) as resp:
+            assert resp.status == 206
+            assert resp.headers["Content-Range"] == "bytes 1-3/4"
+            assert await resp.read() == b"080"
+
+        async with session.get(url, headers={"Range": "bytes=4-"}) as resp:
+            assert resp.status == 416
+            assert resp.headers["Content-Range"] == "bytes */4"
+
+        async with session.get(
+            url, headers={"Range": "bytes=2-", "If-Range": f'"{digest}"'}
+        ) as resp:
+            assert resp.status == 206
+            assert await resp.read() == b"80"
+
+        # A stale validator means the client needs the whole blob
+        async with session.get(
+            url, headers={"Range": "bytes=2-", "If-Range": '"sha256:other"'}
+        ) as resp:
+            assert resp.status == 200
+            assert await resp.read() == b"9080"
+
+        async with session.get(url, headers={"If-None-Match": f'"{digest}"'}) as resp:
+            assert resp.status == 304
+
+
+async def test_mirror_resumes_download(fake_cluster):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    digest = "bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
+
+    # node2 was interrupted half way through, node3 has garbage that won't verify
+    for node, partial in (("node2", b"90"), ("node3", b"xx")):
+        uploads = pathlib.Path(str(fake_cluster[node]["storage"])) / "uploads"
+        uploads.mkdir(parents=True, exist_ok=True)
+        (uploads / f"mirror-{digest}").write_bytes(partial)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"http://localhost:{port}/v2/alpine/blobs/uploads/?digest=sha256:{digest}",
+            data=b"9080",
+        ) as resp:
+            assert resp.status == 201
+
+    await assert_blob(fake_cluster, digest)
+
+
+async def test_put_blob_across_nodes(fake_cluster):
+    port1 = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    port2 = fake_cluster["node2"]["registry"]["default"]["port"].get(int)
+    port3 = fake_cluster["node3"]["registry"]["default"]["port"].get(int)
+    digest = "bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"http://localhost:{port1}/v2/alpine/blobs/uploads/"
+        ) as resp:
+            assert resp.status == 202
+            location = resp.headers["Location"]
+            assert resp.headers["Blob-Upload-Session-ID"].startswith("node1.")
+
+        # Each request lands on a different node, like behind a load balancer
+        async with session.patch(
+            f"http://localhost:{port2}{location}",
+            data=b"90",
+            headers={"Content-Range": "0-1"},
+        ) as resp:
+            assert resp.status == 202
+            assert resp.headers["Range"] == "0-1"
+
+        async with session.patch(
+            f"http://localhost:{port3}{location}",
+            data=b"80",
+            headers={"Content-Range": "2-3"},
+        ) as resp:
+            assert resp.status == 202
+            assert resp.headers["Range"] == "0-3"
+
+        async with session.get(f"http://localhost:{port2}{location}") as resp:
+            assert resp.status == 204
+            assert resp.headers["Range"] == "0-4"
+
+        # A forwarded request is never forwarded again
+        async with session.get(
+            f"http://localhost:{port2}{location}",
+            headers={"Distribd-Forwarded-By": "node3"},
+        ) as resp:
+            assert resp.status == 404
+
+        async with session.put(
+            f"http://localhost:{port3}{location}?digest=sha256:{digest}"
+        ) as resp:
+            assert resp.status == 201
+            assert resp.headers["Docker-Content-Digest"] == f"sha256:{digest}"
+
+        await assert_blob(fake_cluster, digest)
+
+
+async def test_put_blob_out_of_order(fake_cluster):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    digest = "bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"http://localhost:{port}/v2/alpine/blobs/uploads/"
+        ) as resp:
+            assert resp.status == 202
+            location = resp.headers["Location"]
+
+        async with session.patch(
+            f"http://localhost:{port}{location}",
+            data=b"80",
+            headers={"Content-Range": "2-3"},
+        ) as resp:
+            assert resp.status == 202
+            assert resp.headers["Distribd-Missing-Ranges"] == "0-1"
+
+        # The gap is reported rather than finishing with a bad digest
+        async with session.put(
+            f"http://localhost:{port}{location}?digest=sha256:{digest}"
+        ) as resp:
+            assert resp.status == 416
+            assert resp.headers["Distribd-Missing-Ranges"] == "0-1"
+
+        async with session.patch(
+            f"http://localhost:{port}{location}",
+            data=b"90",
+            headers={"Content-Range": "0-1"},
+        ) as resp:
+            assert resp.status == 202
+            assert resp.headers["Range"] == "0-3"
+            assert "Distribd-Missing-Ranges" not in resp.headers
+
+        sending = asyncio.Event()
+        release = asyncio.Event()
+
+        async def chunk():
+            yield b"8"
+            sending.set()
+            await release.wait()
+            yield b"0"
+
+        async def patch():
+            async with session.patch(
+                f"http://localhost:{port}{location}",
+                data=chunk(),
+                headers={"Content-Range": "2-3"},
+            ) as resp:
+                assert resp.status == 202
+
+        # A client retrying a chunk that already arrived
+        patching = asyncio.ensure_future(patch())
+        await sending.wait()
+        await asyncio.sleep(0.1)
+
+        # Can't finish while a chunk is still being written
+        async with aiohttp.ClientSession() as other:
+            async with other.put(
+                f"http://localhost:{port}{location}?digest=sha256:{digest}"
+            ) as resp:
+                assert resp.status == 416
+
+        release.set()
+        await patching
+
+        async with session.put(
+            f"http://localhost:{port}{location}?digest=sha256:{digest}"
+        ) as resp:
+            assert resp.status == 201
+            assert resp.headers["Docker-Content-Digest"] == f"sha256:{digest}"
+
+        await assert_blob(fake_cluster, digest)
+
+
+@pytest.fixture
+def no_mirroring(monkeypatch):
+    from distribd.mirror import Mirrorer
+
+    monkeypatch.setattr(Mirrorer, "dispatch_entries", lambda self, state, entries: None)
+
+
+async def test_get_blob_read_through(no_mirroring, fake_cluster):
+    port1 = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    port2 = fake_cluster["node2"]["registry"]["default"]["port"].get(int)
+    digest = "sha256:bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"http://localhost:{port1}/v2/alpine/blobs/uploads/?digest={digest}",
+            data=b"9080",
+        ) as resp:
+            assert resp.status == 201
+
+        for i in range(100):
+            async with session.head(
+                f"http://localhost:{port2}/v2/alpine/blobs/{digest}"
+            ) as resp:
+                if resp.status == 404:
+                    await asyncio.sleep(0.1)
+                    continue
+                break
+
+        storage = pathlib.Path(str(fake_cluster["node2"]["storage"]))
+
+        async def fetch():
+            async with session.get(
+                f"http://localhost:{port2}/v2/alpine/blobs/{digest}"
+            ) as resp:
+                assert resp.status == 200
+                assert resp.headers["Docker-Content-Digest"] == digest
+                return await resp.read()
+
+        assert await asyncio.gather(fetch(), fetch()) == [b"9080", b"9080"]
+
+        # The copy was kept so later requests are served locally
+        assert get_blob_path(storage, digest).read_bytes() == b"9080"
+
+
 async def test_put_blob_with_cross_mount(fake_cluster):
     port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
     digest = "bd2079738bf102a1b4e223346f69650f1dcbe685994da65bf92d5207eb44e1cc"
@@ -452,6 +813,13 @@ async def test_list_tags_pagination(fake_cluster):
 
         await assert_manifest(fake_cluster, hash, manifest)
 
+        # Every tag points at the same manifest, so wait for the followers to
+        # apply the last tag as well
+        for i in range(100):
+            if await check_consensus(fake_cluster, session):
+                break
+            await asyncio.sleep(0.1)
+
         for node in fake_cluster.values():
             port = node["registry"]["default"]["port"].get(int)
 
@@ -465,6 +833,50 @@ async def test_list_tags_pagination(fake_cluster):
                     == '/v2/alpine/tags/list?n=1&last=3.10; rel="next"'
                 )
 
+            async with session.get(
+                f"http://localhost:{port}/v2/alpine/tags/list?n=2&last=3.10"
+            ) as resp:
+                body = await resp.json()
+                assert body == {"name": "alpine", "tags": ["3.11", "3.12"]}
+                assert "Link" not in resp.headers
+
+
+async def test_catalog(fake_cluster):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+
+    manifest = {
+        "manifests": [],
+        "mediaType": "application/vnd.docker.distribution.manifest.list.v2+json",
+        "schemaVersion": 2,
+    }
+
+    async with aiohttp.ClientSession() as session:
+        for repository in ("debian", "alpine"):
+            url = f"http://localhost:{port}/v2/{repository}/manifests/latest"
+
+            async with session.put(url, json=manifest) as resp:
+                assert resp.status == 201
+                hash = resp.headers["Docker-Content-Digest"].split(":", 1)[1]
+
+        await assert_manifest(fake_cluster, hash, manifest)
+
+        for node in fake_cluster.values():
+            port = node["registry"]["default"]["port"].get(int)
+
+            async with session.get(f"http://localhost:{port}/v2/_catalog?n=1") as resp:
+                body = await resp.json()
+                assert body == {"repositories": ["alpine"]}
+                assert (
+                    resp.headers["Link"] == '/v2/_catalog?n=1&last=alpine; rel="next"'
+                )
+
+            async with session.get(
+                f"http://localhost:{port}/v2/_catalog?n=1&last=alpine"
+            ) as resp:
+                body = await resp.json()
+                assert body == {"repositories": ["debian"]}
+                assert "Link" not in resp.headers
+
 
 async def test_delete_manifest(fake_cluster):
     port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
@@ -548,6 +960,79 @@ async def test_full_manifest_round_trip(fake_cluster):
     assert body == manifest
 
 
+async def test_manifest_not_modified(fake_cluster):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+
+    manifest = {
+        "manifests": [],
+        "mediaType": "application/vnd.docker.distribution.manifest.list.v2+json",
+        "schemaVersion": 2,
+    }
+
+    url = f"http://localhost:{port}/v2/alpine/manifests/3.11"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.put(url, json=manifest) as resp:
+            assert resp.status == 201
+            digest = resp.headers["Docker-Content-Digest"]
+
+        async with session.get(url) as resp:
+            assert resp.status == 200
+            assert resp.headers["ETag"] == f'"{digest}"'
+
+        headers = {"If-None-Match": f'"{digest}"'}
+
+        async with session.get(url, headers=headers) as resp:
+            assert resp.status == 304
+            assert resp.headers["Docker-Content-Digest"] == digest
+
+        async with session.head(url, headers=headers) as resp:
+            assert resp.status == 304
+
+        async with session.get(url, headers={"If-None-Match": '"sha256:00"'}) as resp:
+            assert resp.status == 200
+            assert await resp.json() == manifest
+
+
+async def test_watch_tags(fake_cluster):
+    port1 = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    port2 = fake_cluster["node2"]["registry"]["default"]["port"].get(int)
+
+    manifest = {
+        "manifests": [],
+        "mediaType": "application/vnd.docker.distribution.manifest.list.v2+json",
+        "schemaVersion": 2,
+    }
+
+    async with aiohttp.ClientSession() as session:
+        watch_url = f"http://localhost:{port2}/v2/alpine/tags/watch"
+
+        async with session.get(watch_url, params={"timeout": "0"}) as resp:
+            assert resp.status == 200
+            payload = await resp.json()
+            assert payload["tags"] == {}
+            since = payload["index"]
+
+        async def watch():
+            params = {"since": str(since), "tag": "3.11", "timeout": "30"}
+            async with session.get(watch_url, params=params) as resp:
+                assert resp.status == 200
+                return await resp.json()
+
+        watcher = asyncio.ensure_future(watch())
+        await asyncio.sleep(0.1)
+        assert not watcher.done()
+
+        url = f"http://localhost:{port1}/v2/alpine/manifests/3.11"
+        async with session.put(url, json=manifest) as resp:
+            assert resp.status == 201
+            digest = resp.headers["Docker-Content-Digest"]
+
+        payload = await watcher
+        assert payload["tags"] == {"3.11": digest}
+        assert payload["index"] > since
+
+
 async def create_test_blob_from_json(fake_cluster, obj):
     port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
 
@@ -570,6 +1055,67 @@ async def create_test_blob_from_json(fake_cluster, obj):
     return digest
 
 
+async def test_referrers(fake_cluster):
+    port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
+    prometheus_port = fake_cluster["node1"]["prometheus"]["port"].get(int)
+
+    config = await create_test_blob_from_json(
+        fake_cluster, {"history": [], "rootfs": {"type": "layers"}}
+    )
+    layer = await create_test_blob_from_json(fake_cluster, {"layer": True})
+
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+        "config": {
+            "mediaType": "application/vnd.docker.container.image.v1+json",
+            "size": 42,
+            "digest": config,
+        },
+        "layers": [
+            {
+                "mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                "size": 15,
+                "digest": layer,
+            }
+        ],
+    }
+
+    headers = {"Content-Type": "application/vnd.docker.distribution.manifest.v2+json"}
+
+    async with aiohttp.ClientSession() as session:
+        url = f"http://localhost:{port}/v2/alpine/manifests/latest"
+        async with session.put(url, json=manifest, headers=headers) as resp:
+            assert resp.status == 201
+            digest = resp.headers["Docker-Content-Digest"]
+
+        url = f"http://localhost:{port}/v2/alpine/referrers/{layer}"
+        async with session.get(url) as resp:
+            assert resp.status == 200
+            body = await resp.json()
+            assert body["mediaType"] == "application/vnd.oci.image.index.v1+json"
+            assert [m["digest"] for m in body["manifests"]] == [digest]
+
+        url = f"http://localhost:{port}/v2/debian/referrers/{layer}"
+        async with session.get(url) as resp:
+            body = await resp.json()
+            assert body["manifests"] == []
+
+        url = f"http://localhost:{prometheus_port}/referrers/{layer}"
+        async with session.get(url) as resp:
+            assert resp.status == 200
+            assert await resp.json() == {
+                "digest": layer,
+                "users": [
+                    {
+                        "digest": digest,
+                        "repositories": ["alpine"],
+                        "tags": [{"repository": "alpine", "tag": "latest"}],
+                    }
+                ],
+            }
+
+
 async def test_validation_of_inner_manifest_works(fake_cluster):
     port = fake_cluster["node1"]["registry"]["default"]["port"].get(int)
 
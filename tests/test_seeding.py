@@ -1,5 +1,11 @@
 from confuse import Configuration
-from distribd.seeding import Seeder
+from distribd.seeding import (
+    DEAD_PROBE_INTERVAL,
+    GENERATIONS_PER_SESSION,
+    SUSPICION_TIMEOUT,
+    Liveness,
+    Seeder,
+)
 
 
 def test_exchange_receive_initial():
@@ -32,7 +38,8 @@ def test_exchange_receive_initial():
         "node1": {
             "raft": {"address": "127.0.0.1", "port": 8080},
             "registry": {"address": "127.0.0.1", "port": 9080},
-            "generation": 1,
+            "generation": GENERATIONS_PER_SESSION + 1,
+            "capabilities": ["digest"],
         }
     }
 
@@ -67,6 +74,194 @@ def test_exchange_receive_ancestor():
         "node1": {
             "raft": {"address": "127.0.0.1", "port": 8080},
             "registry": {"address": "127.0.0.1", "port": 9080},
-            "generation": 1,
+            "generation": GENERATIONS_PER_SESSION + 1,
+            "capabilities": ["digest"],
         }
     }
+
+
+def make_seeder():
+    c = Configuration("distribd", __name__)
+    c["node"]["identifier"].set("node1")
+    c["seeding"]["urls"].set(["http://127.0.0.1:8080", "http://127.0.0.1:8081"])
+
+    s = Seeder(c, 1, None)
+    s.process_state_change(
+        {
+            "raft": {"address": "127.0.0.1", "port": 8080},
+            "registry.default": {"address": "127.0.0.1", "port": 9080},
+        }
+    )
+    return s
+
+
+def test_exchange_digest():
+    s = make_seeder()
+    s.update_from_gossip(
+        {
+            "node2": {
+                "raft": {"address": "127.0.0.1", "port": 8081},
+                "registry": {"address": "127.0.0.1", "port": 9081},
+                "generation": 3,
+            },
+            "node3": {
+                "raft": {"address": "127.0.0.1", "port": 8082},
+                "registry": {"address": "127.0.0.1", "port": 9082},
+                "generation": 1,
+            },
+        }
+    )
+
+    generation = GENERATIONS_PER_SESSION + 1
+    result = s.exchange_digest(
+        {"digest": {"node1": generation, "node2": 3, "node3": 2}}
+    )
+
+    # Only the rumour they are missing is sent, and we ask for the newer node3
+    assert result == {
+        "rumours": {},
+        "wanted": ["node3"],
+    }
+
+    result = s.exchange_digest({"digest": {"node2": 2}})
+
+    assert set(result["rumours"]) == {"node1", "node2", "node3"}
+    assert result["wanted"] == []
+
+
+def test_exchange_digest_push():
+    s = make_seeder()
+
+    result = s.exchange_digest(
+        {
+            "rumours": {
+                "node2": {
+                    "raft": {"address": "127.0.0.1", "port": 8081},
+                    "registry": {"address": "127.0.0.1", "port": 9081},
+                    "generation": 2,
+                }
+            }
+        }
+    )
+
+    assert result == {}
+    assert s.digest == {"node1": GENERATIONS_PER_SESSION + 1, "node2": 2}
+
+
+def test_state_change_bumps_generation():
+    s = make_seeder()
+    generation = s.digest["node1"]
+
+    s.process_state_change({"registry.default": {"port": 9090}})
+
+    # Peers that have our old rumour are sent the new one
+    result = s.exchange_digest({"digest": {"node1": generation}})
+    assert result["rumours"]["node1"]["registry"]["port"] == 9090
+    assert result["rumours"]["node1"]["generation"] == generation + 1
+
+    # A restart starts above anything announced before
+    restarted = Seeder(s.config, 2, None)
+    assert restarted.current_state["generation"] > generation + 1
+
+
+async def test_gossip_round_with_older_node():
+    sent = []
+
+    async def spread(url, payload):
+        sent.append((url, payload))
+        return {
+            "node2": {
+                "raft": {"address": "127.0.0.1", "port": 8081},
+                "registry": {"address": "127.0.0.1", "port": 9081},
+                "generation": 2,
+            }
+        }
+
+    s = make_seeder()
+    s.spread = spread
+
+    # A seed we don't know yet is sent the full map, as older nodes expect
+    assert await s.gossip_round()
+    assert sent == [("http://127.0.0.1:8081", {"node1": s.current_state})]
+
+    # node2 doesn't advertise digests, so it keeps getting the full map
+    assert not s.understands_digest("node2")
+    sent.clear()
+    assert not await s.gossip_round()
+    assert "digest" not in sent[0][1]
+
+
+def test_gossip_targets_use_announced_protocol():
+    s = make_seeder()
+    s.update_from_gossip(
+        {
+            "node2": {
+                "raft": {"address": "127.0.0.1", "port": 8082, "protocol": "https"},
+                "registry": {"address": "127.0.0.1", "port": 9082},
+                "generation": 2,
+                "capabilities": ["digest"],
+            }
+        }
+    )
+
+    assert s.gossip_targets()["https://127.0.0.1:8082"] == "node2"
+    assert s.understands_digest("node2")
+
+
+def test_gossip_targets_exclude_self():
+    s = make_seeder()
+
+    assert s.gossip_targets() == {"http://127.0.0.1:8081": None}
+
+    s.update_from_gossip(
+        {
+            "node2": {
+                "raft": {"address": "127.0.0.1", "port": 8081},
+                "registry": {"address": "127.0.0.1", "port": 9081},
+                "generation": 2,
+            }
+        }
+    )
+
+    assert s.gossip_targets() == {"http://127.0.0.1:8081": "node2"}
+
+
+def test_liveness():
+    s = make_seeder()
+
+    assert s.liveness("node2") == Liveness.ALIVE
+
+    s.mark_failed("node2")
+    assert s.liveness("node2") == Liveness.SUSPECT
+    assert s.should_contact("node2")
+
+    # Suspicion times out
+    s.health["node2"].suspected_at -= SUSPICION_TIMEOUT
+    s.mark_failed("node2")
+    assert s.liveness("node2") == Liveness.DEAD
+    assert not s.should_contact("node2")
+
+    # Dead peers are still probed every now and then
+    s.health["node2"].last_failure -= DEAD_PROBE_INTERVAL
+    assert s.should_contact("node2")
+
+    assert s.rank_peers(["node2", "node3"]) == ["node3", "node2"]
+
+    s.mark_alive("node2")
+    assert s.liveness("node2") == Liveness.ALIVE
+
+
+def test_newer_generation_refutes_suspicion():
+    s = make_seeder()
+    rumour = {
+        "raft": {"address": "127.0.0.1", "port": 8081},
+        "registry": {"address": "127.0.0.1", "port": 9081},
+        "generation": 1,
+    }
+    s.update_from_gossip({"node2": rumour})
+
+    s.mark_failed("node2")
+    assert s.liveness("node2") == Liveness.SUSPECT
+
+    s.update_from_gossip({"node2": dict(rumour, generation=2)})
+    assert s.liveness("node2") == Liveness.ALIVE
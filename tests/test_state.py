@@ -1,3 +1,5 @@
+import random
+
 from distribd.actions import RegistryActions
 from distribd.state import RegistryState
 import pytest
@@ -76,7 +78,7 @@ def test_blob_dependencies():
         ]
     )
 
-    assert set(registry_state.graph.successors("abcdefgh")) == {"sha256:abcdefg"}
+    assert registry_state.get_dependencies("abcdefgh") == {"sha256:abcdefg"}
 
 
 def test_blob_available_after_delete_and_restore():
@@ -459,3 +461,708 @@ def test_tag_available():
         ]
     )
     assert registry_state.get_tag("alpine", "3.11") == "abcdefgh"
+
+
+def test_getitem():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "abcdefgh",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_STORED,
+                    "hash": "abcdefgh",
+                    "location": "node1",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_INFO,
+                    "hash": "abcdefgh",
+                    "content_type": "application/json",
+                    "dependencies": ["base"],
+                },
+            ],
+        ]
+    )
+
+    assert "abcdefgh" in registry_state
+    assert registry_state["abcdefgh"] == {
+        "type": "manifest",
+        "repositories": {"alpine"},
+        "locations": {"node1"},
+        "dependencies": ["base"],
+        "content_type": "application/json",
+    }
+
+    # Dependencies that haven't been pushed yet aren't objects in their own right
+    assert "base" not in registry_state
+    with pytest.raises(KeyError):
+        registry_state["base"]
+
+
+def test_dependencies_survive_dependency_being_removed():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "base",
+                },
+            ],
+            [1, {"type": RegistryActions.BLOB_STORED, "hash": "base", "location": "n"}],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "manifest",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_INFO,
+                    "hash": "manifest",
+                    "content_type": "application/json",
+                    "dependencies": ["base"],
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_UNSTORED,
+                    "hash": "base",
+                    "location": "n",
+                },
+            ],
+        ]
+    )
+
+    assert "base" not in registry_state
+    assert registry_state.get_dependencies("manifest") == {"base"}
+
+    # When it is pushed again it is still referenced by the manifest
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "base",
+                },
+            ],
+        ]
+    )
+    assert registry_state.get_orphaned_objects() == {"manifest"}
+
+
+def test_retagging_releases_placeholder():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "alpine",
+                    "tag": "3.11",
+                    "hash": "abcdefgh",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "alpine",
+                    "tag": "3.11",
+                    "hash": "ijklmnop",
+                },
+            ],
+        ]
+    )
+
+    assert registry_state.get_tag("alpine", "3.11") == "ijklmnop"
+    with pytest.raises(KeyError):
+        registry_state.get_dependencies("abcdefgh")
+
+
+def test_get_tags_page():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "alpine",
+                    "tag": tag,
+                    "hash": "abcdefgh",
+                },
+            ]
+            for tag in ("3.12", "3.10", "latest", "3.11")
+        ]
+    )
+
+    assert registry_state.get_tags("alpine") == ["3.10", "3.11", "3.12", "latest"]
+    assert registry_state.get_tags_page("alpine", n=2) == (["3.10", "3.11"], True)
+    assert registry_state.get_tags_page("alpine", "3.11", 2) == (
+        ["3.12", "latest"],
+        False,
+    )
+    assert registry_state.get_tags_page("alpine", "3.105") == (
+        ["3.11", "3.12", "latest"],
+        False,
+    )
+
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "abcdefgh",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_UNMOUNTED,
+                    "repository": "alpine",
+                    "hash": "abcdefgh",
+                },
+            ],
+        ]
+    )
+
+    with pytest.raises(KeyError):
+        registry_state.get_tags_page("alpine")
+
+
+def test_indexes_maintained_incrementally():
+    """
+    The orphan set and catalog always match what a full scan would find, and views
+    are unaffected by entries applied after they were taken.
+    """
+    rng = random.Random(0)
+    registry_state = RegistryState()
+
+    hashes = [f"hash{i}" for i in range(20)]
+
+    def edges(state):
+        # Placeholders have edges too, so this can't just check `digest in state`
+        edges = {}
+        for digest in hashes:
+            try:
+                edges[digest] = (
+                    state.get_dependencies(digest),
+                    state.get_referrers(digest),
+                )
+            except KeyError:
+                pass
+        return edges
+
+    def fingerprint(state):
+        return (
+            state.get_orphaned_objects(),
+            state.get_catalog_page(),
+            state.get_storage_usage(),
+            state.get_missing_objects("node1"),
+            state.get_missing_objects("node2"),
+            state.get_missing_objects("node3"),
+            state.get_replication_backlog(),
+            {digest: state[digest] for digest in hashes if digest in state},
+            edges(state),
+        )
+
+    views = []
+
+    for i in range(2000):
+        if i % 100 == 0:
+            view = registry_state.view()
+            views.append((view, fingerprint(view)))
+
+        hash = rng.choice(hashes)
+        action = rng.choice(
+            [
+                {"type": RegistryActions.BLOB_MOUNTED, "repository": "debian"},
+                {"type": RegistryActions.BLOB_STORED, "location": "node1"},
+                {"type": RegistryActions.BLOB_UNSTORED, "location": "node1"},
+                {"type": RegistryActions.BLOB_STORED, "location": "node2"},
+                {"type": RegistryActions.BLOB_STORED, "location": "node3"},
+                {"type": RegistryActions.BLOB_STAT, "size": rng.randrange(100)},
+                {"type": RegistryActions.MANIFEST_STAT, "size": rng.randrange(100)},
+                {"type": RegistryActions.MANIFEST_MOUNTED, "repository": "alpine"},
+                {"type": RegistryActions.MANIFEST_UNMOUNTED, "repository": "alpine"},
+                {
+                    "type": RegistryActions.MANIFEST_INFO,
+                    "content_type": "application/json",
+                    "dependencies": rng.sample(hashes, 2),
+                },
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "alpine",
+                    "tag": rng.choice(["a", "b", "c"]),
+                },
+            ]
+        )
+        action["hash"] = hash
+        registry_state.dispatch_entries([[1, action]])
+
+        assert registry_state.get_orphaned_objects() == {
+            record.digest
+            for record in registry_state._records
+            if record is not None and record.orphaned
+        }
+
+        repositories = {
+            registry_state.repositories[id]
+            for record in registry_state._records
+            if record is not None
+            for id in record.repositories
+        }
+        repositories.update(
+            registry_state.repositories[id]
+            for id, tags in registry_state._tags.items()
+            if tags
+        )
+        assert registry_state.get_catalog_page() == (sorted(repositories), False)
+
+        records = [r for r in registry_state._records if r is not None]
+        usage = registry_state.get_storage_usage()
+        assert usage["physical"] == sum(r.size or 0 for r in records if r.type)
+        assert usage["logical"] == sum(
+            (r.size or 0) * len(r.repositories) for r in records
+        )
+        live = {r.digest for r in records if r.type and r.repositories and r.locations}
+        for location in ("node1", "node2", "node3"):
+            location_id = registry_state.locations.lookup(location)
+            assert registry_state.get_missing_objects(location) == {
+                r.digest
+                for r in records
+                if r.digest in live
+                and (location_id is None or not r.locations & (1 << location_id))
+            }
+
+        backlog = registry_state.get_replication_backlog()
+        for location, count in backlog.items():
+            assert count == len(registry_state.get_missing_objects(location))
+
+        for location in ("node1", "node2"):
+            location_id = registry_state.locations.lookup(location)
+            assert usage["locations"].get(location, 0) == sum(
+                r.size or 0
+                for r in records
+                if location_id is not None and r.locations & (1 << location_id)
+            )
+
+    # Views never see changes made after they were taken
+    for view, expected in views:
+        assert fingerprint(view) == expected
+
+
+def test_catalog():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": repository,
+                    "hash": "base",
+                },
+            ]
+            for repository in ("debian", "alpine", "ubuntu")
+        ]
+    )
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "alpine",
+                    "tag": "3.11",
+                    "hash": "abcdefgh",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_UNMOUNTED,
+                    "repository": "alpine",
+                    "hash": "base",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_UNMOUNTED,
+                    "repository": "ubuntu",
+                    "hash": "base",
+                },
+            ],
+        ]
+    )
+
+    # alpine still has a tag in it
+    assert registry_state.get_catalog_page() == (["alpine", "debian"], False)
+    assert registry_state.get_catalog_page(n=1) == (["alpine"], True)
+    assert registry_state.get_catalog_page("alpine", 1) == (["debian"], False)
+
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_STORED,
+                    "hash": "base",
+                    "location": "node1",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_UNSTORED,
+                    "hash": "base",
+                    "location": "node1",
+                },
+            ],
+        ]
+    )
+    assert registry_state.get_catalog_page() == (["alpine"], False)
+
+
+def test_view_is_isolated_from_later_entries():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "base",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "alpine",
+                    "tag": "3.11",
+                    "hash": "manifest",
+                },
+            ],
+        ],
+        2,
+    )
+
+    view = registry_state.view()
+    assert view.applied_index == 2
+    assert registry_state.view() is view
+
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": "debian",
+                    "hash": "base",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_STORED,
+                    "hash": "base",
+                    "location": "node1",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "alpine",
+                    "tag": "3.12",
+                    "hash": "manifest",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_INFO,
+                    "hash": "manifest",
+                    "content_type": "application/json",
+                    "dependencies": ["base"],
+                },
+            ],
+        ],
+        6,
+    )
+
+    assert registry_state.applied_index == 6
+    assert registry_state.view() is not view
+
+    # Entries that don't change anything still need a new view
+    current = registry_state.view()
+    registry_state.dispatch_entries([[1, {}]], 7)
+    assert current.applied_index == 6
+    assert registry_state.view().applied_index == 7
+
+    assert view["base"]["repositories"] == {"alpine"}
+    assert view["base"]["locations"] == set()
+    assert view.get_tags("alpine") == ["3.11"]
+    assert view.get_catalog_page() == (["alpine"], False)
+    assert view.get_orphaned_objects() == {"base"}
+    assert view.get_dependencies("manifest") == set()
+
+    assert registry_state["base"]["repositories"] == {"alpine", "debian"}
+    assert registry_state["base"]["locations"] == {"node1"}
+    assert registry_state.get_tags("alpine") == ["3.11", "3.12"]
+    assert registry_state.get_catalog_page() == (["alpine", "debian"], False)
+    assert registry_state.get_orphaned_objects() == set()
+    assert registry_state.get_dependencies("manifest") == {"base"}
+
+    with pytest.raises(RuntimeError):
+        view.dispatch_entries([[1, {"type": RegistryActions.BLOB_MOUNTED}]])
+
+
+def test_view_of_objects_seen_later():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [[1, {"type": RegistryActions.BLOB_MOUNTED, "repository": "a", "hash": "1"}]],
+        1,
+    )
+
+    view = registry_state.view()
+    registry_state.dispatch_entries(
+        [
+            [1, {"type": RegistryActions.BLOB_MOUNTED, "repository": "a", "hash": "2"}],
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_UNMOUNTED,
+                    "repository": "a",
+                    "hash": "1",
+                },
+            ],
+        ],
+        3,
+    )
+
+    assert view.is_blob_available("a", "1")
+    assert not view.is_blob_available("a", "2")
+    assert not registry_state.is_blob_available("a", "1")
+    assert registry_state.is_blob_available("a", "2")
+
+    # Once nothing holds the view, changes are no longer saved for it
+    del view
+    registry_state.dispatch_entries(
+        [[1, {"type": RegistryActions.BLOB_MOUNTED, "repository": "b", "hash": "3"}]],
+        4,
+    )
+    assert registry_state._undo is None
+
+
+def test_storage_usage():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": repository,
+                    "hash": "base",
+                },
+            ]
+            for repository in ("alpine", "debian")
+        ]
+        + [
+            [1, {"type": RegistryActions.BLOB_STAT, "hash": "base", "size": 100}],
+            [
+                1,
+                {"type": RegistryActions.BLOB_STORED, "hash": "base", "location": "n1"},
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "manifest",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_STORED,
+                    "hash": "manifest",
+                    "location": "n2",
+                },
+            ],
+            [
+                1,
+                {"type": RegistryActions.MANIFEST_STAT, "hash": "manifest", "size": 5},
+            ],
+        ]
+    )
+
+    assert registry_state["manifest"]["size"] == 5
+    assert registry_state.get_repository_size("alpine") == 105
+    assert registry_state.get_storage_usage() == {
+        "logical": 205,
+        "physical": 105,
+        "repositories": {"alpine": 105, "debian": 100},
+        "locations": {"n1": 100, "n2": 5},
+    }
+
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_UNSTORED,
+                    "hash": "manifest",
+                    "location": "n2",
+                },
+            ],
+        ]
+    )
+
+    assert registry_state.get_storage_usage() == {
+        "logical": 200,
+        "physical": 100,
+        "repositories": {"alpine": 100, "debian": 100},
+        "locations": {"n1": 100},
+    }
+
+
+def test_get_users():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "layer",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "manifest",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_INFO,
+                    "hash": "manifest",
+                    "content_type": "application/json",
+                    "dependencies": ["layer"],
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_MOUNTED,
+                    "repository": "debian",
+                    "hash": "list",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_INFO,
+                    "hash": "list",
+                    "content_type": "application/json",
+                    "dependencies": ["manifest"],
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "debian",
+                    "tag": "latest",
+                    "hash": "list",
+                },
+            ],
+        ]
+    )
+
+    assert registry_state.get_referrers("layer") == {"manifest"}
+    assert registry_state.get_users("layer") == [
+        {
+            "digest": "list",
+            "repositories": ["debian"],
+            "tags": [{"repository": "debian", "tag": "latest"}],
+        },
+        {"digest": "manifest", "repositories": ["alpine"], "tags": []},
+    ]
+    assert registry_state.get_users("list") == []
+
+    with pytest.raises(KeyError):
+        registry_state.get_users("missing")
+
+
+def test_is_stored():
+    registry_state = RegistryState()
+    registry_state.dispatch_entries(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "base",
+                },
+            ],
+            [1, {"type": RegistryActions.BLOB_STAT, "hash": "base", "size": 100}],
+            [
+                1,
+                {"type": RegistryActions.BLOB_STORED, "hash": "base", "location": "n1"},
+            ],
+            [
+                1,
+                {"type": RegistryActions.BLOB_STORED, "hash": "base", "location": "n2"},
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.BLOB_UNSTORED,
+                    "hash": "base",
+                    "location": "n2",
+                },
+            ],
+        ]
+    )
+
+    assert registry_state.is_stored("base", "n1")
+    assert not registry_state.is_stored("base", "n2")
+    assert not registry_state.is_stored("base", "n3")
+    assert not registry_state.is_stored("missing", "n1")
+
+    assert registry_state.get_size("base") == 100
+    assert registry_state.get_size("missing") is None
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import os
+import time
+
+from distribd.uploads import UploadSessions
+
+
+async def test_recover_session(tmp_path):
+    sessions = UploadSessions(tmp_path, "node1")
+    session = sessions.create("alpine")
+
+    with open(session.path, "wb") as fp:
+        fp.write(b"90")
+    session.update(b"90")
+    session.checkpoint()
+
+    # This chunk was written but the node went away before acknowledging it
+    with open(session.path, "ab") as fp:
+        fp.write(b"80")
+
+    restarted = UploadSessions(tmp_path, "node1")
+    recovered, again = await asyncio.gather(
+        restarted.get(session.session_id), restarted.get(session.session_id)
+    )
+
+    assert recovered is again
+    assert recovered.repository == "alpine"
+    assert recovered.size == 2
+    assert recovered.path.read_bytes() == b"90"
+
+    recovered.update(b"80")
+    assert recovered.hasher.hexdigest() == hashlib.sha256(b"9080").hexdigest()
+
+
+async def test_unknown_session(tmp_path):
+    sessions = UploadSessions(tmp_path, "node1")
+    assert await sessions.get("missing") is None
+
+
+def test_expire(tmp_path):
+    sessions = UploadSessions(tmp_path, "node1", expiry=60)
+
+    stale = sessions.create("alpine")
+    stale.path.write_bytes(b"90")
+
+    fresh = sessions.create("alpine")
+    fresh.path.write_bytes(b"90")
+
+    orphan = sessions.directory / "mirror-abcdef"
+    orphan.write_bytes(b"90")
+
+    past = time.time() - 120
+    for path in (stale.path, stale.checkpoint_path, fresh.path, orphan):
+        os.utime(path, (past, past))
+
+    sessions.expire()
+
+    assert not stale.path.exists()
+    assert not stale.checkpoint_path.exists()
+    assert not orphan.exists()
+
+    # The data is old but the session was checkpointed recently
+    assert fresh.path.exists()
+    assert fresh.checkpoint_path.exists()
+
+
+def test_owner(tmp_path):
+    sessions = UploadSessions(tmp_path, "node1")
+
+    session = sessions.create("alpine")
+    assert sessions.owner(session.session_id) == "node1"
+
+    assert sessions.owner("node2.example.com.2b5c4b1c") == "node2.example.com"
+    assert sessions.owner("2b5c4b1c-5bbb-4f4e-a1b6-1f1a3b9f4c2e") == "node1"
+
+
+async def test_ingest(tmp_path):
+    sessions = UploadSessions(tmp_path, "node1", ingest_chunk_size=3, ingest_buffers=1)
+    session = sessions.create("alpine")
+
+    content = asyncio.StreamReader()
+    content.feed_data(b"9080")
+    content.feed_data(b"7060")
+    content.feed_eof()
+
+    assert await session.ingest(content) == 8
+
+    assert session.size == 8
+    assert session.path.read_bytes() == b"90807060"
+    assert session.hasher.hexdigest() == hashlib.sha256(b"90807060").hexdigest()
+
+    assert sessions.ingest_count == 1
+    assert sessions.ingest_bytes == 8
+
+
+async def test_ingest_out_of_order(tmp_path):
+    sessions = UploadSessions(tmp_path, "node1")
+    session = sessions.create("alpine")
+
+    async def ingest(data, offset):
+        content = asyncio.StreamReader()
+        content.feed_data(data)
+        content.feed_eof()
+        return await session.ingest(content, offset, len(data))
+
+    assert await ingest(b"70", 4) == 2
+    assert await ingest(b"60", 6) == 2
+
+    assert session.size == 0
+    assert session.extents == [(4, 8)]
+    assert session.missing() == [(0, 4)]
+    assert await session.assemble() == [(0, 4)]
+
+    assert await ingest(b"90", 0) == 2
+    assert session.size == 2
+    assert session.contiguous == 2
+    assert session.missing() == [(2, 4)]
+
+    # A recovered session remembers what it had received
+    session.checkpoint()
+    sessions.reset(session.session_id)
+    session = await sessions.get(session.session_id)
+    assert session.size == 2
+    assert session.extents == [(4, 8)]
+
+    assert await ingest(b"80", 2) == 2
+    assert session.size == 4
+    assert session.contiguous == 8
+
+    assert await session.assemble() == []
+    assert session.size == 8
+    assert session.extents == []
+    assert session.path.read_bytes() == b"90807060"
+    assert session.hasher.hexdigest() == hashlib.sha256(b"90807060").hexdigest()
+
+
+def test_writable(tmp_path):
+    sessions = UploadSessions(tmp_path, "node1")
+    session = sessions.create("alpine")
+    session.size = 4
+
+    assert not session.writable(2, 6)
+    assert session.writable(4, 6)
+
+    session._writing.append((8, 10))
+    assert session.writable(4, 8)
+    assert not session.writable(9, 12)
+    assert not session.writable(6)
+
+
+async def test_storing(tmp_path):
+    sessions = UploadSessions(tmp_path, "node1")
+
+    lock = sessions.storing("sha256:abcd")
+    assert sessions.storing("sha256:abcd") is lock
+    assert sessions.storing("sha256:ef01") is not lock
+
+    async with lock:
+        assert sessions.storing("sha256:abcd").locked()
+
+    del lock
+    assert "sha256:abcd" not in sessions._storing
@@ -0,0 +1,88 @@
+import asyncio
+
+from distribd.actions import RegistryActions
+from distribd.watch import TagWatchers
+
+
+def tagged(repository, tag, hash="sha256:manifest"):
+    return [
+        1,
+        {
+            "type": RegistryActions.HASH_TAGGED,
+            "repository": repository,
+            "tag": tag,
+            "hash": hash,
+        },
+    ]
+
+
+def unmounted(repository, hash="sha256:manifest"):
+    return [
+        1,
+        {
+            "type": RegistryActions.MANIFEST_UNMOUNTED,
+            "repository": repository,
+            "hash": hash,
+        },
+    ]
+
+
+async def test_wait_for_tag():
+    watchers = TagWatchers()
+
+    waiter = asyncio.ensure_future(watchers.wait("alpine", 2, "3.12", timeout=10))
+    await asyncio.sleep(0)
+    assert watchers.waiting == 1
+
+    watchers.dispatch_entries([tagged("alpine", "3.11"), tagged("debian", "3.12")], 4)
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    watchers.dispatch_entries([tagged("alpine", "3.12")], 5)
+    assert await waiter == {"3.12": 5}
+    assert watchers.waiting == 0
+
+
+async def test_wait_for_any_tag():
+    watchers = TagWatchers()
+
+    waiter = asyncio.ensure_future(watchers.wait("alpine", 0, timeout=10))
+    await asyncio.sleep(0)
+
+    watchers.dispatch_entries([[1, {}], tagged("alpine", "3.11")], 2)
+    assert await waiter == {"3.11": 2}
+
+
+async def test_already_changed():
+    watchers = TagWatchers()
+    watchers.dispatch_entries([tagged("alpine", "3.11"), tagged("alpine", "3.12")], 2)
+
+    assert await watchers.wait("alpine", 1) == {"3.12": 2}
+    assert await watchers.wait("alpine", 0, "3.11") == {"3.11": 1}
+
+
+async def test_timeout():
+    watchers = TagWatchers()
+
+    assert await watchers.wait("alpine", 0, timeout=0.01) == {}
+    assert watchers.waiting == 0
+
+
+async def test_unmount_forgets_tags():
+    watchers = TagWatchers()
+    watchers.dispatch_entries(
+        [
+            tagged("alpine", "3.11", "sha256:old"),
+            tagged("alpine", "3.12", "sha256:old"),
+            tagged("alpine", "3.12", "sha256:new"),
+        ],
+        3,
+    )
+
+    watchers.dispatch_entries([unmounted("alpine", "sha256:old")], 4)
+    assert watchers.changes("alpine", 0) == {"3.12": 3}
+
+    watchers.dispatch_entries([unmounted("alpine", "sha256:new")], 5)
+    assert watchers.changes("alpine", 0) == {}
+    assert watchers._tagged == {}
+    assert watchers._manifests == {}
@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+
+import aiohttp
+from distribd import registry
+from distribd.actions import RegistryActions
+from distribd.cache import ManifestCache
+from distribd.machine import NodeState
+from distribd.service import main
+from distribd.watch import TagWatchers
+from distribd.worker import RegistryReplica, forward, worker_routes
+import pytest
+from yarl import URL
+
+
+def test_replica_apply():
+    manifest_cache = ManifestCache()
+    manifest_cache.put("sha256:manifest", b"{}")
+    tag_watchers = TagWatchers()
+
+    replica = RegistryReplica(None, None, manifest_cache, tag_watchers)
+    replica.apply(
+        [
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_MOUNTED,
+                    "repository": "alpine",
+                    "hash": "sha256:manifest",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.HASH_TAGGED,
+                    "repository": "alpine",
+                    "tag": "3.12",
+                    "hash": "sha256:manifest",
+                },
+            ],
+            [
+                1,
+                {
+                    "type": RegistryActions.MANIFEST_UNSTORED,
+                    "hash": "sha256:manifest",
+                    "location": "node1",
+                },
+            ],
+        ],
+        3,
+    )
+
+    assert replica.state.applied_index == 3
+    assert replica.state.get_tag("alpine", "3.12") == "sha256:manifest"
+    assert tag_watchers.changes("alpine", 0) == {"3.12": 2}
+    assert "sha256:manifest" not in manifest_cache
+
+
+def test_writes_are_forwarded():
+    handlers = {(route.method, route.path): route.handler for route in worker_routes()}
+
+    assert len(handlers) == len(list(registry.routes))
+
+    put_manifest = handlers[("PUT", "/v2/{repository:[^{}]+}/manifests/{tag}")]
+    assert put_manifest is forward
+
+    get_blob = handlers[("GET", "/v2/{repository:[^{}]+}/blobs/sha256:{hash}")]
+    assert get_blob is not forward
+
+    get_manifest_by_tag = handlers[("GET", "/v2/{repository:[^{}]+}/manifests/{tag}")]
+    assert get_manifest_by_tag is forward
+
+
+async def check_consensus(cluster_config, session):
+    states = set()
+    applied = set()
+
+    for config in cluster_config.values():
+        port = config["raft"]["port"].get(int)
+
+        try:
+            async with session.get(f"http://localhost:{port}/status") as resp:
+                payload = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+        if not payload["stable"]:
+            return False
+
+        applied.add(payload["applied_index"])
+        states.add(payload["state"])
+
+    return len(applied) == 1 and int(NodeState.LEADER) in states
+
+
+@pytest.fixture
+async def worker_cluster(loop, cluster_config, client_session):
+    from distribd import machine
+
+    machine.SCALE = 1000
+
+    cluster_config["node1"]["registry"]["default"]["workers"].set(1)
+
+    servers = asyncio.ensure_future(
+        asyncio.gather(*(main([], config) for config in cluster_config.values()))
+    )
+
+    await asyncio.sleep(0.1)
+
+    seeds = []
+    for config in cluster_config.values():
+        seeds.append(f"http://127.0.0.1:{config['raft']['port'].get(int)}")
+    for config in cluster_config.values():
+        config["seeding"]["urls"].set(seeds)
+
+    for i in range(100):
+        if await check_consensus(cluster_config, client_session):
+            break
+        await asyncio.sleep(0.1)
+    else:
+        raise RuntimeError("No consensus")
+
+    # Wait for the worker process to be started by the supervisor
+    for i in range(100):
+        if any(
+            p.name == "distribd-default-0" for p in multiprocessing.active_children()
+        ):
+            break
+        await asyncio.sleep(0.1)
+    else:
+        raise RuntimeError("Worker not started")
+
+    yield cluster_config
+
+    servers.cancel()
+    try:
+        await servers
+    except asyncio.CancelledError:
+        pass
+
+
+async def test_replica_follows_committed_entries(worker_cluster):
+    registry_config = worker_cluster["node1"]["registry"]["default"]
+    port = registry_config["port"].get(int)
+    internal_port = registry_config["internal"]["port"].get(int)
+
+    manifest = {
+        "manifests": [],
+        "mediaType": "application/vnd.docker.distribution.manifest.list.v2+json",
+        "schemaVersion": 2,
+    }
+
+    async with aiohttp.ClientSession() as session:
+        url = f"http://localhost:{port}/v2/alpine/manifests/3.12"
+        async with session.put(url, json=manifest) as resp:
+            assert resp.status == 201
+            digest = resp.headers["Docker-Content-Digest"]
+
+        upstream = URL(f"http://127.0.0.1:{internal_port}")
+        replica = RegistryReplica(session, upstream, ManifestCache(), TagWatchers())
+        follower = asyncio.ensure_future(replica.run_forever())
+
+        try:
+            for i in range(50):
+                if replica.state.is_manifest_available("alpine", digest):
+                    break
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("Replica didn't catch up")
+        finally:
+            follower.cancel()
+
+    assert replica.state.get_tag("alpine", "3.12") == digest
+
+
+async def test_worker_reads_own_writes(worker_cluster):
+    port = worker_cluster["node1"]["registry"]["default"]["port"].get(int)
+    url = f"http://localhost:{port}/v2/alpine/manifests"
+
+    manifest = {
+        "manifests": [],
+        "mediaType": "application/vnd.docker.distribution.manifest.list.v2+json",
+        "schemaVersion": 2,
+    }
+
+    # Every request gets its own connection so that the kernel spreads them
+    # between the raft process and the worker, which share the listener. Each
+    # push changes what the tag points at.
+    for indent in range(10):
+        body = json.dumps(manifest, indent=indent).encode("utf-8")
+        digest = "sha256:" + hashlib.sha256(body).hexdigest()
+
+        async with aiohttp.ClientSession() as session:
+            async with session.put(f"{url}/latest", data=body) as resp:
+                assert resp.status == 201
+                assert resp.headers["Docker-Content-Digest"] == digest
+
+        async with aiohttp.ClientSession() as session:
+            async with session.head(f"{url}/latest") as resp:
+                assert resp.status == 200
+                assert resp.headers["Docker-Content-Digest"] == digest
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{url}/{digest}") as resp:
+                assert resp.status == 200
+                assert await resp.read() == body
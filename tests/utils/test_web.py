@@ -0,0 +1,45 @@
+import aiohttp
+from aiohttp import web
+from distribd.utils.web import peer_url, proxy_request
+import pytest
+
+
+def test_peer_url():
+    assert peer_url({"address": "10.0.0.1", "port": 80}) == "http://10.0.0.1:80"
+
+    server = {"address": "10.0.0.1", "port": 443, "protocol": "https"}
+    assert peer_url(server) == "https://10.0.0.1:443"
+
+
+async def test_proxy_request_fails_part_way(aiohttp_server, aiohttp_client):
+    async def upstream_handler(request):
+        response = web.StreamResponse()
+        response.content_length = 8
+        await response.prepare(request)
+        await response.write(b"9080")
+        request.transport.close()
+        return response
+
+    upstream_app = web.Application()
+    upstream_app.router.add_get("/blob", upstream_handler)
+    upstream = await aiohttp_server(upstream_app)
+
+    async def proxy_handler(request):
+        async with aiohttp.ClientSession() as session:
+            try:
+                return await proxy_request(
+                    session, request, str(upstream.make_url("/blob"))
+                )
+            except aiohttp.ClientError:
+                raise web.HTTPServiceUnavailable()
+
+    proxy_app = web.Application()
+    proxy_app.router.add_get("/blob", proxy_handler)
+    client = await aiohttp_client(proxy_app)
+
+    # The status has already gone, so the client is cut off rather than sent an
+    # error or a short body that looks complete
+    resp = await client.get("/blob")
+    assert resp.status == 200
+    with pytest.raises(aiohttp.ClientPayloadError):
+        await resp.read()